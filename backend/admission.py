@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Cost class -> (max concurrent, max queued, queue timeout in seconds), overridable per class with
+# ADMISSION_<CLASS>_CONCURRENCY / _QUEUE / _TIMEOUT_SECONDS
+COST_CLASSES = {
+    'expensive': (4, 16, 2.0),
+    'cheap': (64, 256, 0.5),
+}
+# Routes that take a slot, by cost class; unlisted routes count as expensive
+ROUTE_COSTS = {
+    'appointments.list': 'expensive',
+    'appointments.upcoming': 'expensive',
+    'appointments.search': 'expensive',
+    'appointments.stats': 'expensive',
+    'appointments.today': 'cheap',
+    'patients.list': 'expensive',
+    'patients.import': 'expensive',
+    'patients.history': 'cheap',
+    'analytics.snapshot': 'expensive',
+}
+MAX_RETRY_AFTER_SECONDS = 30
+
+
+def class_limits(cost: str) -> Tuple[int, int, float]:
+    concurrency, queue, timeout = COST_CLASSES[cost]
+    prefix = f"ADMISSION_{cost.upper()}"
+    return (
+        int(os.environ.get(f'{prefix}_CONCURRENCY', concurrency)),
+        int(os.environ.get(f'{prefix}_QUEUE', queue)),
+        float(os.environ.get(f'{prefix}_TIMEOUT_SECONDS', timeout)),
+    )
+
+
+def parse_route_limits(spec: str) -> Dict[str, Tuple[int, int, float]]:
+    """ADMISSION_ROUTE_LIMITS: "route=concurrency/queue/timeout,..." e.g. "patients.list=2/4/1.5" """
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        route, _, values = item.partition('=')
+        concurrency, queue, timeout = values.split('/')
+        limits[route.strip()] = (int(concurrency), int(queue), float(timeout))
+    return limits
+
+
+class AdmissionLimiter:
+    """Bounded concurrency with a bounded, time-limited wait queue for one route.
+
+    A request runs at once when one of `max_concurrent` slots is free, waits when
+    fewer than `max_queue` requests are already waiting, and is shed otherwise, or
+    when it has waited `queue_timeout_seconds`: shedding answers 503 with a
+    Retry-After estimated from the route's recent service time and queue depth.
+    """
+
+    def __init__(self, route: str, cost: str, max_concurrent: int, max_queue: int, queue_timeout_seconds: float):
+        self.route = route
+        self.cost = cost
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.queued = 0
+        self.in_flight = 0
+        # Exponentially weighted mean time a request holds its slot
+        self.service_seconds = 0.0
+        self.queued_gauge = REGISTRY.gauge(f'admission.{route}.queued')
+        self.in_flight_gauge = REGISTRY.gauge(f'admission.{route}.in_flight')
+        self.wait_time = REGISTRY.histogram(f'admission.{route}.wait_ms')
+
+    def retry_after(self) -> int:
+        """Seconds until the queue ahead of a retry has likely drained"""
+        drain = self.service_seconds * (self.queued + 1) / self.max_concurrent
+        return max(1, min(MAX_RETRY_AFTER_SECONDS, math.ceil(drain)))
+
+    def _shed(self, reason: str):
+        REGISTRY.counter(f'admission.{self.route}.shed_{reason}').inc()
+        REGISTRY.counter('admission.shed').inc()
+        retry_after = self.retry_after()
+        logger.warning(f"Shed {self.route} request ({reason}; {self.in_flight} running, {self.queued} queued)")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Server busy ({self.route}), retry in {retry_after}s",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    async def _acquire(self):
+        if not self.slots.locked():
+            await self.slots.acquire()
+            return
+        if self.queued >= self.max_queue:
+            self._shed('queue_full')
+        self.queued += 1
+        self.queued_gauge.inc()
+        started = time.perf_counter()
+        # wait_for alone (before Python 3.12) can time out just as the acquire succeeds and drop
+        # that permit for good; shielded, a permit won at the last moment is kept or given back
+        acquire = asyncio.ensure_future(self.slots.acquire())
+        try:
+            await asyncio.wait_for(asyncio.shield(acquire), timeout=self.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            if acquire.cancel():
+                self._shed('timeout')
+        except asyncio.CancelledError:
+            if not acquire.cancel():
+                self.slots.release()
+            raise
+        finally:
+            self.queued -= 1
+            self.queued_gauge.dec()
+            self.wait_time.observe((time.perf_counter() - started) * 1000)
+
+    @asynccontextmanager
+    async def admit(self):
+        await self._acquire()
+        self.in_flight += 1
+        self.in_flight_gauge.inc()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.in_flight_gauge.dec()
+            self.slots.release()
+            self.service_seconds += 0.2 * ((time.perf_counter() - started) - self.service_seconds)
+
+    def describe(self) -> Dict:
+        return {
+            "cost": self.cost,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "queue_timeout_seconds": self.queue_timeout_seconds,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "service_ms": round(self.service_seconds * 1000, 1),
+        }
+
+
+class AdmissionController:
+    """One AdmissionLimiter per route, sized by the route's cost class.
+
+    Limits are process-wide: the event loop and the MongoDB pool they protect are
+    shared by every clinic. Cheap routes get their own generous limiters, so a burst
+    of expensive reads is shed at its own queue instead of delaying them.
+    """
+
+    def __init__(self, route_limits: Optional[Dict[str, Tuple[int, int, float]]] = None):
+        self.route_limits = route_limits if route_limits is not None else \
+            parse_route_limits(os.environ.get('ADMISSION_ROUTE_LIMITS', ''))
+        self.limiters: Dict[str, AdmissionLimiter] = {}
+
+    def limiter(self, route: str) -> AdmissionLimiter:
+        limiter = self.limiters.get(route)
+        if limiter is None:
+            cost = ROUTE_COSTS.get(route, 'expensive')
+            limits = self.route_limits.get(route) or class_limits(cost)
+            limiter = self.limiters[route] = AdmissionLimiter(route, cost, *limits)
+        return limiter
+
+    def describe(self) -> Dict[str, Dict]:
+        return {route: limiter.describe() for route, limiter in sorted(self.limiters.items())}
@@ -0,0 +1,330 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from fastapi import APIRouter, Depends, HTTPException, Query
+
+from rollups_service import ROLLUP_GROUP_BY
+
+logger = logging.getLogger(__name__)
+
+# Bookable minutes per doctor and working day, used as the utilization denominator
+CLINIC_DAY_MINUTES = int(os.environ.get('CLINIC_DAY_MINUTES', '480'))
+
+STATUSES = ['pending', 'confirmed', 'completed', 'cancelled', 'rescheduled']
+NO_SHOW_MARKERS = ('no acud', 'no asist', 'no present', 'no vino', 'falt', 'no show', 'no-show')
+GROUP_BY = ('month', 'week', 'doctor', 'treatment', 'status')
+
+SNAPSHOT_FIELDS = {"date": 1, "doctor": 1, "treatment": 1, "status": 1, "estado_cita": 1, "duration": 1, "duration_minutes": 1}
+
+def is_no_show(estado_cita: str) -> bool:
+    s = (estado_cita or "").lower()
+    return any(marker in s for marker in NO_SHOW_MARKERS)
+
+def to_day(value: Optional[str]) -> Optional[int]:
+    """YYYY-MM-DD -> days since epoch"""
+    if not value:
+        return None
+    try:
+        return (datetime.strptime(value, '%Y-%m-%d').date() - date(1970, 1, 1)).days
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid date: {value}")
+
+def from_day(day: int) -> str:
+    return (date(1970, 1, 1) + timedelta(days=int(day))).strftime('%Y-%m-%d')
+
+
+class AppointmentSnapshot:
+    """Columnar, dictionary-encoded copy of the appointments for one data generation.
+
+    Every column is a numpy array of equal length; doctor/treatment/status hold
+    integer codes into the matching vocabulary list. Status overrides made after
+    the build are applied in place (`apply_statuses`), so `generation` can move
+    ahead of the `data_generation` the rows were read at.
+    """
+
+    def __init__(self, generation: int, data_generation: int, frame: pd.DataFrame):
+        self.generation = generation
+        self.data_generation = data_generation
+        self.built_at = datetime.utcnow()
+        days = pd.to_datetime(frame['date'], format='%Y-%m-%d', errors='coerce')
+        valid = days.notna().to_numpy()
+        self.skipped = int((~valid).sum())
+        frame = frame[valid]
+        epoch = pd.Timestamp('1970-01-01')
+        self.day = ((days[valid] - epoch).dt.days).to_numpy(dtype=np.int32)
+        self.rows = {appointment_id: row for row, appointment_id in enumerate(frame['appointment_id'])}
+        self.duration = frame['duration_minutes'].to_numpy(dtype=np.int32)
+        self.doctor, self.doctors = self._encode(frame['doctor'])
+        self.treatment, self.treatments = self._encode(frame['treatment'])
+        status = frame['status'].fillna('pending')
+        self.statuses = list(STATUSES) + sorted(set(status.unique()) - set(STATUSES))
+        self.status = pd.Categorical(status, categories=self.statuses).codes.astype(np.int8)
+        # A writable copy: apply_statuses updates it in place
+        self.no_show = frame['estado_cita'].fillna('').map(is_no_show).to_numpy(dtype=bool, copy=True)
+
+    @staticmethod
+    def _encode(column: pd.Series):
+        codes, uniques = pd.factorize(column.fillna('').str.strip())
+        return codes.astype(np.int32), [str(u) for u in uniques]
+
+    def __len__(self) -> int:
+        return len(self.day)
+
+    def apply_statuses(self, changes: Dict[str, Tuple[str, str]], generation: int):
+        """Set {appointment_id: (status, estado_cita)} on the rows held; ids not held are skipped"""
+        for appointment_id, (status, estado_cita) in changes.items():
+            row = self.rows.get(appointment_id)
+            if row is None:
+                continue
+            if status not in self.statuses:
+                self.statuses.append(status)
+            self.status[row] = self.statuses.index(status)
+            self.no_show[row] = is_no_show(estado_cita)
+        self.generation = generation
+
+    def mask(self, start_day: Optional[int] = None, end_day: Optional[int] = None,
+             doctor: Optional[str] = None) -> np.ndarray:
+        m = np.ones(len(self.day), dtype=bool)
+        if start_day is not None:
+            m &= self.day >= start_day
+        if end_day is not None:
+            m &= self.day <= end_day
+        if doctor is not None:
+            code = self.doctors.index(doctor) if doctor in self.doctors else -2
+            m &= self.doctor == code
+        return m
+
+    def group_keys(self, by: str, m: np.ndarray):
+        """Return (codes, labels) for the rows selected by m"""
+        if by == 'doctor':
+            return self.doctor[m], self.doctors
+        if by == 'treatment':
+            return self.treatment[m], self.treatments
+        if by == 'status':
+            return self.status[m].astype(np.int32), self.statuses
+        if by == 'month':
+            months = self.day[m].astype('datetime64[D]').astype('datetime64[M]').astype(np.int32)
+            uniq, codes = np.unique(months, return_inverse=True)
+            labels = [str(np.datetime64(int(u), 'M')) for u in uniq]
+            return codes, labels
+        if by == 'week':
+            # 1970-01-01 was a Thursday; shift so weeks start on Monday
+            weeks = (self.day[m] + 3) // 7
+            uniq, codes = np.unique(weeks, return_inverse=True)
+            labels = [from_day(u * 7 - 3) for u in uniq]
+            return codes, labels
+        raise ValueError(f"Unsupported grouping: {by}")
+
+    def grouped(self, by: str, m: np.ndarray) -> List[Dict]:
+        codes, labels = self.group_keys(by, m)
+        n = len(labels)
+        status = self.status[m]
+        cancelled = status == self.statuses.index('cancelled')
+        completed = status == self.statuses.index('completed')
+        no_show = self.no_show[m]
+        booked = np.where(cancelled, 0, self.duration[m])
+        total = np.bincount(codes, minlength=n)
+        c_cancelled = np.bincount(codes, weights=cancelled, minlength=n)
+        c_completed = np.bincount(codes, weights=completed, minlength=n)
+        c_no_show = np.bincount(codes, weights=no_show, minlength=n)
+        minutes = np.bincount(codes, weights=booked, minlength=n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cancel_rate = np.where(total > 0, c_cancelled / total, 0.0)
+            no_show_rate = np.where(total > 0, c_no_show / total, 0.0)
+        rows = []
+        for i in np.flatnonzero(total):
+            rows.append({
+                "key": labels[i] or "(sin asignar)",
+                "total": int(total[i]),
+                "completed": int(c_completed[i]),
+                "cancelled": int(c_cancelled[i]),
+                "no_show": int(c_no_show[i]),
+                "cancellation_rate": round(float(cancel_rate[i]), 4),
+                "no_show_rate": round(float(no_show_rate[i]), 4),
+                "booked_minutes": int(minutes[i]),
+            })
+        return rows
+
+    def utilization(self, m: np.ndarray) -> List[Dict]:
+        """Booked minutes over available minutes per doctor, counting days the doctor worked"""
+        n = len(self.doctors)
+        active = m & (self.status != self.statuses.index('cancelled'))
+        booked = np.bincount(self.doctor[active], weights=self.duration[active], minlength=n)
+        pairs = np.unique(self.doctor[m].astype(np.int64) * 1_000_000 + self.day[m])
+        working_days = np.bincount((pairs // 1_000_000).astype(np.int64), minlength=n)
+        rows = []
+        for i in np.flatnonzero(working_days):
+            available = int(working_days[i]) * CLINIC_DAY_MINUTES
+            rows.append({
+                "doctor": self.doctors[i] or "(sin asignar)",
+                "working_days": int(working_days[i]),
+                "booked_minutes": int(booked[i]),
+                "available_minutes": available,
+                "utilization": round(float(booked[i]) / available, 4) if available else 0.0,
+            })
+        return rows
+
+
+class AnalyticsEngine:
+    """Keeps an AppointmentSnapshot in step with the sheets service.
+
+    The snapshot is rebuilt when the rows change (`data_generation`); status
+    overrides only move `generation`, and are replayed onto the snapshot from the
+    service's override log instead. A rebuild is still needed when the log no
+    longer reaches back to the snapshot's generation.
+    """
+
+    def __init__(self, sheets_service):
+        self.sheets_service = sheets_service
+        self._snapshot: Optional[AppointmentSnapshot] = None
+        self._lock = asyncio.Lock()
+        self.last_build_seconds: float = 0.0
+
+    def _catch_up(self) -> bool:
+        """Bring the snapshot to the service's generation without a rebuild, if it can be"""
+        service, snap = self.sheets_service, self._snapshot
+        if snap is None or snap.data_generation != service.data_generation:
+            return False
+        if snap.generation == service.generation:
+            return True
+        # With the rows unchanged, every later generation is one entry of the override log
+        entries = [(generation, changes) for generation, changes in service.override_log if generation > snap.generation]
+        if len(entries) != service.generation - snap.generation:
+            return False
+        for generation, changes in entries:
+            snap.apply_statuses(changes, generation)
+        return True
+
+    async def get_snapshot(self) -> AppointmentSnapshot:
+        if self._catch_up():
+            return self._snapshot
+        async with self._lock:
+            if not self._catch_up():
+                self._snapshot = await self._build()
+                # Overrides written while it was being built
+                self._catch_up()
+        return self._snapshot
+
+    async def _build(self) -> AppointmentSnapshot:
+        started = time.perf_counter()
+        service = self.sheets_service
+        generation, data_generation = service.generation, service.data_generation
+        docs = await service.scan_history(SNAPSHOT_FIELDS)
+        overrides = await service.repos.overrides.all()
+        records = []
+        for d in docs:
+            ov = overrides.get(str(d.get('_id')))
+            records.append((
+                str(d.get('_id')),
+                d.get('date'),
+                d.get('doctor') or '',
+                d.get('treatment') or '',
+                (ov or d).get('status') or 'pending',
+                (ov or d).get('estado_cita') or '',
+                service.appointment_minutes(d),
+            ))
+        frame = pd.DataFrame.from_records(records, columns=['appointment_id', 'date', 'doctor', 'treatment', 'status', 'estado_cita', 'duration_minutes'])
+        # CPU-bound encoding runs off the event loop
+        snapshot = await asyncio.to_thread(AppointmentSnapshot, generation, data_generation, frame)
+        self.last_build_seconds = time.perf_counter() - started
+        logger.info(f"Built analytics snapshot gen={generation} rows={len(snapshot)} in {self.last_build_seconds:.3f}s")
+        return snapshot
+
+
+def create_analytics_router(clinics):
+    """Analytics per clinic: one engine (and snapshot) per clinic the requests name"""
+    router = APIRouter(prefix="/api/analytics", tags=["analytics"])
+    engines = {service.clinic_id: AnalyticsEngine(service) for service in clinics}
+
+    async def clinic_snapshot(service=Depends(clinics.resolve)) -> AppointmentSnapshot:
+        async with clinics.slot(service, 'analytics.snapshot'):
+            return await engines[service.clinic_id].get_snapshot()
+
+    @router.get("/grouped")
+    async def get_grouped(
+        by: str = Query('month', description="month | week | doctor | treatment | status"),
+        start_date: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
+        end_date: Optional[str] = Query(None, description="End date (YYYY-MM-DD)"),
+        doctor: Optional[str] = Query(None, description="Restrict to one doctor"),
+        snap: AppointmentSnapshot = Depends(clinic_snapshot)
+    ):
+        if by not in GROUP_BY:
+            raise HTTPException(status_code=400, detail=f"Unsupported grouping: {by}")
+        m = snap.mask(to_day(start_date), to_day(end_date), doctor)
+        return {"by": by, "generation": snap.generation, "groups": snap.grouped(by, m)}
+
+    @router.get("/summary")
+    async def get_summary(
+        start_date: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
+        end_date: Optional[str] = Query(None, description="End date (YYYY-MM-DD)"),
+        snap: AppointmentSnapshot = Depends(clinic_snapshot)
+    ):
+        m = snap.mask(to_day(start_date), to_day(end_date))
+        totals = snap.grouped('status', m)
+        total = int(m.sum())
+        cancelled = sum(g['total'] for g in totals if g['key'] == 'cancelled')
+        no_show = sum(g['no_show'] for g in totals)
+        return {
+            "generation": snap.generation,
+            "total_appointments": total,
+            "by_status": {g['key']: g['total'] for g in totals},
+            "cancellation_rate": round(cancelled / total, 4) if total else 0.0,
+            "no_show_rate": round(no_show / total, 4) if total else 0.0,
+            "booked_minutes": sum(g['booked_minutes'] for g in totals),
+        }
+
+    @router.get("/utilization")
+    async def get_utilization(
+        start_date: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
+        end_date: Optional[str] = Query(None, description="End date (YYYY-MM-DD)"),
+        snap: AppointmentSnapshot = Depends(clinic_snapshot)
+    ):
+        m = snap.mask(to_day(start_date), to_day(end_date))
+        return {"generation": snap.generation, "day_minutes": CLINIC_DAY_MINUTES, "doctors": snap.utilization(m)}
+
+    @router.get("/snapshot")
+    async def get_snapshot_info(service=Depends(clinics.resolve)):
+        engine = engines[service.clinic_id]
+        snap = await clinic_snapshot(service)
+        return {
+            "clinic_id": service.clinic_id,
+            "generation": snap.generation,
+            "data_generation": snap.data_generation,
+            "rows": len(snap),
+            "skipped_rows": snap.skipped,
+            "doctors": len(snap.doctors),
+            "treatments": len(snap.treatments),
+            "built_at": snap.built_at.isoformat(),
+            "build_seconds": round(engine.last_build_seconds, 4),
+        }
+
+    @router.get("/rollups")
+    async def get_rollups(
+        by: str = Query('day', description="day | month | doctor | treatment | status"),
+        start_date: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
+        end_date: Optional[str] = Query(None, description="End date (YYYY-MM-DD)"),
+        service=Depends(clinics.resolve)
+    ):
+        """Long-range report served from the pre-aggregated daily_rollups collection"""
+        if by not in ROLLUP_GROUP_BY:
+            raise HTTPException(status_code=400, detail=f"Unsupported grouping: {by}")
+        to_day(start_date), to_day(end_date)  # validate format
+        if service.rollups is None:
+            raise HTTPException(status_code=503, detail="Rollups need the MongoDB repository backend")
+        return {"by": by, "groups": await service.rollups.report(start_date, end_date, by)}
+
+    @router.post("/rollups/rebuild")
+    async def rebuild_rollups(service=Depends(clinics.resolve)):
+        if service.rollups is None:
+            raise HTTPException(status_code=503, detail="Rollups need the MongoDB repository backend")
+        buckets = await service.rebuild_rollups()
+        return {"success": True, "buckets": buckets}
+
+    router.engines = engines
+    return router
@@ -0,0 +1,246 @@
+import re
+import sys
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from bson import ObjectId
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+EPOCH_NAIVE = datetime(1970, 1, 1)
+_HHMM = re.compile(r"^(\d{2}):(\d{2})$")
+_HEX40 = re.compile(r"^[0-9a-f]{40}$")
+
+
+class _Missing:
+    __slots__ = ()
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+
+
+def record_key(appointment_id):
+    """Storage key for an appointment id given as ObjectId, hex string or legacy string"""
+    if type(appointment_id) is ObjectId:
+        return appointment_id.binary
+    if type(appointment_id) is str and ObjectId.is_valid(appointment_id):
+        return bytes.fromhex(appointment_id)
+    return appointment_id
+
+
+def epoch_minutes(value: datetime) -> int:
+    """Sort key for starts_at; naive datetimes (as returned by Motor) are UTC"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int((value - EPOCH).total_seconds() // 60)
+
+
+# Each codec packs a document value into something smaller and restores an equal value,
+# except for two normalizations: starts_at comes back as a tz-aware UTC datetime (the same
+# instant), and created_at/updated_at as naive UTC truncated to milliseconds, the shape
+# MongoDB itself hands back. Values a codec cannot pack are stored untouched, and
+# decoders pass them through.
+def _intern(v):
+    return sys.intern(v) if type(v) is str else v
+
+
+def _enc_day(v):
+    if type(v) is str and len(v) == 10:
+        try:
+            day = date.fromisoformat(v)
+            if day.isoformat() == v:
+                return day.toordinal()
+        except ValueError:
+            pass
+    return _intern(v)
+
+
+def _dec_day(v):
+    return date.fromordinal(v).isoformat() if type(v) is int else v
+
+
+def _enc_hhmm(v):
+    m = _HHMM.match(v) if type(v) is str else None
+    return int(m.group(1)) * 60 + int(m.group(2)) if m else _intern(v)
+
+
+def _dec_hhmm(v):
+    return f"{v // 60:02d}:{v % 60:02d}" if type(v) is int else v
+
+
+def _enc_minute(v):
+    return epoch_minutes(v) if isinstance(v, datetime) and not v.second and not v.microsecond else v
+
+
+def _dec_minute(v):
+    return EPOCH + timedelta(minutes=v) if type(v) is int else v
+
+
+def _enc_millis(v):
+    if not isinstance(v, datetime):
+        return v
+    if v.tzinfo is not None:
+        v = v.astimezone(timezone.utc).replace(tzinfo=None)
+    return (v - EPOCH_NAIVE) // timedelta(milliseconds=1)
+
+
+def _dec_millis(v):
+    # Naive UTC at millisecond precision, the shape MongoDB hands back
+    return EPOCH_NAIVE + timedelta(milliseconds=v) if type(v) is int else v
+
+
+def _enc_oid(v):
+    return v.binary if type(v) is ObjectId else v
+
+
+def _dec_oid(v):
+    return ObjectId(v) if type(v) is bytes else v
+
+
+def _enc_hash(v):
+    return int(v, 16) if type(v) is str and _HEX40.match(v) else v
+
+
+def _dec_hash(v):
+    return f"{v:040x}" if type(v) is int else v
+
+
+def _enc_digits(v):
+    if type(v) is str and v.isdigit() and v.isascii() and str(int(v)) == v:
+        return int(v)
+    return v
+
+
+def _dec_digits(v):
+    return str(v) if type(v) is int else v
+
+
+def _enc_utf8(v):
+    # Non-ASCII text is held by CPython at 2-4 bytes per character; UTF-8 is denser
+    return v.encode('utf-8') if type(v) is str else v
+
+
+def _dec_utf8(v):
+    return v.decode('utf-8') if type(v) is bytes else v
+
+
+def _raw(v):
+    return v
+
+
+CODECS = {
+    '_id': (_enc_oid, _dec_oid),
+    'external_id': (_enc_utf8, _dec_utf8),
+    'date': (_enc_day, _dec_day),
+    'time': (_enc_hhmm, _dec_hhmm),
+    'starts_at': (_enc_minute, _dec_minute),
+    'duration_minutes': (_raw, _raw),
+    'quarantined': (_raw, _raw),
+    'quarantine_reason': (_raw, _raw),
+    'schema_version': (_raw, _raw),
+    # Low-cardinality and per-patient strings are interned so repeats share one object
+    'patient_name': (_intern, _raw),
+    'last_name': (_intern, _raw),
+    'treatment': (_intern, _raw),
+    'doctor': (_intern, _raw),
+    'status': (_intern, _raw),
+    'estado_cita': (_intern, _raw),
+    'phone': (_intern, _raw),
+    'notes': (_intern, _raw),
+    'num_paciente': (_intern, _raw),
+    'patient_key': (_intern, _raw),
+    'registro': (_enc_digits, _dec_digits),
+    'cit_mod': (_intern, _raw),
+    'fecha_alta': (_intern, _raw),
+    'duration': (_intern, _raw),
+    'source': (_intern, _raw),
+    'source_id': (_intern, _raw),
+    'clinic_id': (_intern, _raw),
+    'row_hash': (_enc_hash, _dec_hash),
+    'created_at': (_enc_millis, _dec_millis),
+    'updated_at': (_enc_millis, _dec_millis),
+}
+FIELDS = tuple(CODECS)
+_ENCODE = tuple((name, CODECS[name][0]) for name in FIELDS)
+_DECODE = tuple((name, CODECS[name][1]) for name in FIELDS)
+_STAMPS = ('created_at', 'updated_at')
+
+
+class AppointmentRecord:
+    """One stored appointment in packed form.
+
+    Known document fields live in slots: dates as date ordinals, times as minutes
+    of the day, starts_at as UTC epoch minutes, timestamps as epoch milliseconds,
+    ObjectIds and external ids as bytes, row hashes and numeric registro values as ints, and
+    repeated strings interned. Anything
+    else (legacy or quarantine-only fields) goes to `extra`. Dicts are produced
+    again only by `to_doc`, at serialization time.
+    """
+
+    __slots__ = FIELDS + ('extra',)
+
+    @classmethod
+    def from_doc(cls, doc: Dict, stamps: Optional[Dict[int, int]] = None) -> "AppointmentRecord":
+        """Pack one document. Loaders of many documents pass one `stamps` dict for the
+        whole batch: rows of one sync are stamped within a few milliseconds, so their
+        timestamp ints are shared instead of allocated per record."""
+        record = cls.__new__(cls)
+        setter = object.__setattr__
+        for name, encode in _ENCODE:
+            value = doc.get(name, MISSING)
+            setter(record, name, value if value is MISSING else encode(value))
+        if stamps is not None:
+            for name in _STAMPS:
+                value = getattr(record, name)
+                if type(value) is int:
+                    setter(record, name, stamps.setdefault(value, value))
+        extra = {k: v for k, v in doc.items() if k not in CODECS}
+        setter(record, 'extra', extra or None)
+        return record
+
+    def to_doc(self, fields: Optional[Dict] = None) -> Dict:
+        """The document as stored, optionally restricted to a Mongo-style inclusion projection"""
+        doc = {}
+        if fields:
+            wanted = [k for k, on in fields.items() if on]
+            if fields.get('_id', 1) and '_id' not in wanted:
+                wanted.append('_id')
+            for name in wanted:
+                codec = CODECS.get(name)
+                if codec is None:
+                    if self.extra and name in self.extra:
+                        doc[name] = self.extra[name]
+                    continue
+                value = getattr(self, name)
+                if value is not MISSING:
+                    doc[name] = codec[1](value)
+            return doc
+        for name, decode in _DECODE:
+            value = getattr(self, name)
+            if value is not MISSING:
+                doc[name] = decode(value)
+        if self.extra:
+            doc.update(self.extra)
+        return doc
+
+    @property
+    def key(self):
+        """Storage key: the 12 ObjectId bytes, or the raw _id for non-ObjectId ids"""
+        return self._id
+
+    @property
+    def start_minute(self) -> Optional[int]:
+        """UTC epoch minute for listed rows; None for quarantined or undated rows"""
+        if self.quarantined is not False:
+            return None
+        starts_at = self.starts_at
+        if isinstance(starts_at, datetime):
+            return epoch_minutes(starts_at)
+        return starts_at if type(starts_at) is int else None
+
+    @property
+    def status_key(self) -> str:
+        status = self.status
+        return status if type(status) is str and status else 'pending'
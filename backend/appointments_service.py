@@ -1,18 +1,32 @@
 import asyncio
-import aiohttp
+import base64
 import csv
-from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from datetime import datetime, timedelta, timezone
+from collections import deque
+from typing import Deque, List, Dict, Optional, Tuple
 import logging
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
-from fastapi import APIRouter, HTTPException, Query, Body
-from pydantic import BaseModel, Field
+from fastapi import APIRouter, Depends, HTTPException, Query, Body, Request, Response
+from pydantic import BaseModel, Field, TypeAdapter
 from zoneinfo import ZoneInfo
 from zoneinfo import ZoneInfo
 import uuid
 import re
-from uuid import uuid4, uuid5, NAMESPACE_DNS
+import hashlib
+import time
+from uuid import uuid4
+from rollups_service import DailyRollupService, ROLLUP_FIELDS
+from mongo_client import MongoClientProvider
+from metrics import REGISTRY
+from repositories import Repositories, create_repositories
+from outbox_service import OUTBOX_ROW_FIELDS, OutboxFlusher, SheetOutbox, create_sink_from_env
+from reminder_service import ReminderScheduler, create_reminder_sender_from_env
+from lifecycle import BackgroundTasks
+from patient_identity import PatientIdentityIndex, derived_patient_id, make_patient_key
+from patient_import import CsvRecords, JsonRecords, PatientImporter, iter_records
+from search_index import SEARCH_PROJECTION, AppointmentSearchIndex
+from archive_service import AppointmentArchiver, as_utc, merge_tiers
+from sheet_sources import DEFAULT_CLINIC_ID, DEFAULT_SOURCE_ID, SheetSnapshotStore, SheetSource, create_sources_from_env
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +43,11 @@ class AppointmentBase(BaseModel):
     status: str = "pending"  # pending, confirmed, completed, cancelled, rescheduled
     phone: str = ""
     notes: str = ""
+    # Canonical typed fields (schema_version 2)
+    starts_at: Optional[datetime] = None
+    duration_minutes: Optional[int] = None
+    quarantined: bool = False
+    quarantine_reason: Optional[str] = None
     # Extended fields from Google Sheets
     num_paciente: Optional[str] = ""
     last_name: Optional[str] = ""
@@ -38,6 +57,8 @@ class AppointmentBase(BaseModel):
     fecha_alta: Optional[str] = ""
     duration: Optional[str] = ""
     source: str = "google_sheets"
+    source_id: Optional[str] = None
+    clinic_id: Optional[str] = None
 
 class Appointment(AppointmentBase):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), alias="_id")
@@ -63,6 +84,10 @@ class SyncResult(BaseModel):
     synced: int
     message: str
     last_update: Optional[str] = None
+    added: int = 0
+    updated: int = 0
+    removed: int = 0
+    sources: Dict[str, Dict] = {}
 
 # Patients models
 class PatientBase(BaseModel):
@@ -88,61 +113,203 @@ class Patient(PatientBase):
 # =====================
 # Google Sheets Service
 # =====================
+DEFAULT_DURATION_MINUTES = int(os.environ.get('DEFAULT_DURATION_MINUTES', '30'))
+CLINIC_TZ = ZoneInfo(os.environ.get('CLINIC_TIMEZONE', 'Europe/Madrid'))
+SCHEMA_VERSION = 2
+# Fields that are bookkeeping rather than sheet content, or derived from it (patient_key); excluded from row hashes
+VOLATILE_FIELDS = ('_id', 'created_at', 'updated_at', 'row_hash', 'archived_at', 'patient_key')
+# Override writes remembered for readers catching up on status changes (see override_log)
+OVERRIDE_LOG_SIZE = 1024
+
+def row_hash(appointment: Dict) -> str:
+    content = [(k, appointment[k]) for k in sorted(appointment) if k not in VOLATILE_FIELDS]
+    return hashlib.sha1(repr(content).encode('utf-8')).hexdigest()
+
+def encode_cursor(doc: Dict) -> str:
+    """Opaque position after `doc` in a newest-first listing"""
+    position = f"{as_utc(doc['starts_at']).isoformat()}|{doc['_id']}"
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        starts_at, appointment_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|', 1)
+        return datetime.fromisoformat(starts_at), appointment_id
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def local_day_start(day: str) -> datetime:
+    """Midnight of a YYYY-MM-DD clinic day, as a UTC datetime"""
+    return datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=CLINIC_TZ).astimezone(timezone.utc)
+
+def date_range_query(start_date: Optional[str], end_date: Optional[str]) -> Dict:
+    """starts_at bounds covering whole clinic days, end day inclusive"""
+    bounds: Dict = {}
+    if start_date:
+        bounds["$gte"] = local_day_start(start_date)
+    if end_date:
+        bounds["$lt"] = local_day_start(end_date) + timedelta(days=1)
+    return bounds
+
+class SyncDiff:
+    """Rows touched by one sync: inserted docs, (old, new) pairs for changed rows, removed docs"""
+    def __init__(self):
+        self.added: List[Dict] = []
+        self.updated: List[tuple] = []
+        self.removed: List[Dict] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.updated or self.removed)
+
+    @classmethod
+    def merge(cls, diffs: List["SyncDiff"]) -> "SyncDiff":
+        merged = cls()
+        for diff in diffs:
+            merged.added.extend(diff.added)
+            merged.updated.extend(diff.updated)
+            merged.removed.extend(diff.removed)
+        return merged
+
 class GoogleSheetsService:
-    def __init__(self, db_client: AsyncIOMotorClient):
-        self.db = db_client[os.environ['DB_NAME']]
-        self.overrides = self.db.get_collection('appointment_overrides')
-        # Google Sheet CSV URLs
-        self.sheet_url = "https://docs.google.com/spreadsheets/d/1MBDBHQ08XGuf5LxVHCFhHDagIazFkpBnxwqyEQIBJrQ/export?format=csv&gid=0"
-        self.fallback_sheet_url = "https://docs.google.com/spreadsheets/d/1MBDBHQ08XGuf5LxVHCFhHDagIazFkpBnxwqyEQIBJrQ/export?format=csv"
+    """Sync, storage and queries of one clinic's appointments (see clinics.ClinicRegistry)"""
+
+    def __init__(self, mongo: MongoClientProvider, repositories: Optional[Repositories] = None,
+                 sources: Optional[List[SheetSource]] = None):
+        self.mongo = mongo
+        self.repos = repositories or create_repositories(mongo)
+        # The partition this service syncs and serves; every row it writes is tagged with it
+        self.clinic_id = self.repos.clinic_id
+        # Where the CSVs come from: the Google Sheet export by default (SHEET_SOURCES / SHEET_SOURCE)
+        self.sources = sources or [s for s in create_sources_from_env() if s.clinic_id == self.clinic_id]
+        # The clinic syncs on the shortest interval any of its sources asks for
+        intervals = [s.sync_interval_minutes for s in self.sources if s.sync_interval_minutes]
+        self.sync_interval_minutes = min(intervals) if intervals else SYNC_INTERVAL_MINUTES
+        # Caps how many sources are fetched at once
+        self.fetch_limit = asyncio.Semaphore(int(os.environ.get('SHEET_FETCH_CONCURRENCY', '4')))
+        self.source_status: Dict[str, Dict] = {}
+        # Last good CSV per source on local disk (SHEET_SNAPSHOT_DIR; SHEET_SNAPSHOTS=0 disables)
+        self.snapshots = SheetSnapshotStore.from_env()
+        # Set by source watchers to sync the changed sources without waiting for the interval
+        self.sync_requested = asyncio.Event()
+        self.pending_sources: set = set()
         self.last_update = None
+        # When the last sync attempt finished, successful or not (the sync loop's heartbeat)
+        self.last_sync_attempt: Optional[datetime] = None
         self.last_headers: List[str] = []
         self.last_raw_rows: int = 0
         self.last_fetch_message: str = ""
+        # Bumped whenever the appointment data visible to readers changes
+        self.generation: int = 0
+        # Bumped only when rows are added, changed or removed, not by status overrides
+        self.data_generation: int = 0
+        # (generation, {appointment_id: (status, estado_cita)}) per recent override write, so readers
+        # keyed on data_generation can apply them instead of re-reading everything
+        self.override_log: Deque[Tuple[int, Dict[str, Tuple[str, str]]]] = deque(maxlen=OVERRIDE_LOG_SIZE)
+        self.last_diff: Optional[SyncDiff] = None
+        # daily_rollups lives in MongoDB only; the standalone in-memory backend has none
+        self.rollups = DailyRollupService(mongo, self.appointment_minutes, self.clinic_id) if self.repos.uses_mongo else None
+        # App-side status changes queued for write-back to the sheet (MongoDB backends only)
+        self.outbox = SheetOutbox(mongo) if self.repos.uses_mongo else None
+        # Moves past appointments out of the hot collection (MongoDB backends only)
+        self.archiver = AppointmentArchiver(mongo, self.repos) if self.repos.archive is not None else None
+        # Patient keys grouped into people; fed with the rows each sync adds or changes
+        self.identities = PatientIdentityIndex(self.repos)
+        # Full-text index over names, treatment and notes; built on first search, then follows the sync diffs
+        self.search_index = AppointmentSearchIndex()
+        self.search_lock = asyncio.Lock()
+        self.search_backlog: Optional[List[Tuple]] = None
+        # Appointment reminders, when a sender is configured (REMINDER_SENDER_URL or REMINDERS=local)
+        sender = create_reminder_sender_from_env()
+        self.reminders = ReminderScheduler(mongo, self.repos, sender) if sender is not None else None
+
+    @property
+    def db(self):
+        return self.mongo.db
         
-    async def fetch_sheet_data(self) -> List[Dict]:
-        """Fetch data from Google Sheets CSV export"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.sheet_url) as response:
-                    if response.status == 200:
-                        csv_content = await response.text()
-                        return self.parse_csv_data(csv_content)
-                    else:
-                        # Try fallback without gid (first sheet)
-                        async with session.get(self.fallback_sheet_url) as r2:
-                            if r2.status == 200:
-                                csv_content = await r2.text()
-                                return self.parse_csv_data(csv_content)
-                        logger.error(f"Failed to fetch sheet data: HTTP {response.status}")
-                        return []
-        except Exception as e:
-            logger.error(f"Error fetching sheet data: {str(e)}")
+    async def fetch_sheet_data(self, source: SheetSource, use_remote: bool = True) -> List[Dict]:
+        """Fetch one source's CSV within its timeout and parse it into rows tagged with the source id.
+
+        The last good CSV is kept on disk; when nothing can be fetched and nothing
+        is stored for the source yet (cold start), that snapshot is served instead.
+        """
+        status = self.source_status.setdefault(source.source_id, {})
+        csv_content = None
+        if use_remote:
+            started = time.perf_counter()
+            try:
+                async with self.fetch_limit:
+                    csv_content = await asyncio.wait_for(source.fetch(), timeout=source.timeout_seconds)
+            except asyncio.TimeoutError:
+                logger.error(f"Fetching sheet source {source.source_id} timed out after {source.timeout_seconds}s")
+            status["fetch_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            REGISTRY.histogram('sync.fetch_ms').observe(status["fetch_ms"])
+            status["last_error"] = None if csv_content else "fetch failed"
+        origin = "remote"
+        if not csv_content and await self.needs_snapshot(source):
+            snapshot = await self.snapshots.load(source.source_id, source.location)
+            if snapshot is not None:
+                csv_content, origin = snapshot.text, "snapshot"
+                status["snapshot_age_seconds"] = round(snapshot.age_seconds, 1)
+                logger.warning(f"Serving sheet source {source.source_id} from its disk snapshot ({snapshot.meta['saved_at']})")
+        if not csv_content:
             return []
+        # Parsing is CPU-bound; in a worker thread a large sheet does not stall other clinics' requests
+        data, headers, raw_rows = await asyncio.to_thread(self.parse_csv_rows, csv_content, source.source_id)
+        status.update(headers=headers, raw_rows=raw_rows, origin=origin)
+        if origin == "remote" and self.snapshots is not None and source.snapshot:
+            await self.snapshots.save(source.source_id, source.location, csv_content, headers, raw_rows)
+        return data
+
+    async def needs_snapshot(self, source: SheetSource) -> bool:
+        """A snapshot only fills an empty store: anything already synced is at least as fresh"""
+        if self.snapshots is None or not source.snapshot or self.source_status.get(source.source_id, {}).get("last_update"):
+            return False
+        return not await self.repos.appointments.has_rows(source.source_id, source is self.sources[0])
+
+    async def restore_snapshots(self) -> Optional[Dict]:
+        """Load the disk snapshots of sources with nothing stored, before the first network fetch"""
+        if self.snapshots is None:
+            return None
+        ids = {s.source_id for s in self.sources if self.snapshots.exists(s.source_id) and await self.needs_snapshot(s)}
+        if not ids:
+            return None
+        logger.info(f"Restoring {len(ids)} sheet source(s) from disk snapshots")
+        return await self.sync_appointments(ids, use_remote=False)
     
-    def parse_csv_data(self, csv_content: str) -> List[Dict]:
+    def parse_csv_data(self, csv_content: str, source_id: str = DEFAULT_SOURCE_ID) -> List[Dict]:
         """Parse CSV content and map to appointment structure"""
+        appointments, self.last_headers, self.last_raw_rows = self.parse_csv_rows(csv_content, source_id)
+        return appointments
+
+    def parse_csv_rows(self, csv_content: str, source_id: str = DEFAULT_SOURCE_ID) -> Tuple[List[Dict], List[str], int]:
+        """(appointments, CSV headers, raw row count); leaves the service untouched, so it can run in a thread"""
         appointments: List[Dict] = []
         reader = csv.reader(csv_content.splitlines())
         rows = list(reader)
         if not rows:
-            self.last_headers = []
-            self.last_raw_rows = 0
-            return []
+            return [], [], 0
         headers = rows[0]
-        self.last_headers = headers
-        self.last_raw_rows = len(rows) - 1
         csv_reader = csv.DictReader(csv_content.splitlines())
+        seen: Dict[str, int] = {}
         
         for row in csv_reader:
             try:
                 appointment = self.map_appointment_data(row)
                 if appointment:
+                    # Identical date/time/name rows need distinct ids for the sync diff
+                    ext = appointment['external_id']
+                    seen[ext] = seen.get(ext, 0) + 1
+                    if seen[ext] > 1:
+                        appointment['external_id'] = f"{ext}#{seen[ext]}"
+                    appointment['source_id'] = source_id
+                    appointment['clinic_id'] = self.clinic_id
+                    appointment['patient_key'] = make_patient_key(
+                        appointment.get('num_paciente', ''), appointment.get('patient_name', ''), appointment.get('phone', ''))
+                    appointment['row_hash'] = row_hash(appointment)
                     appointments.append(appointment)
             except Exception as e:
                 logger.warning(f"Error parsing row: {row}, Error: {str(e)}")
                 continue
-        return appointments
+        return appointments, headers, len(rows) - 1
     
     def parse_time(self, time_str: str) -> str:
         """Normalize time to HH:MM (24h)"""
@@ -171,6 +338,27 @@ class GoogleSheetsService:
             return f"{hh}:{mm}"
         return cleaned
 
+    def appointment_minutes(self, appointment: Dict) -> int:
+        if appointment.get('duration_minutes'):
+            return appointment['duration_minutes']
+        return self.parse_duration_minutes(appointment.get('duration') or '') or DEFAULT_DURATION_MINUTES
+
+    def parse_duration_minutes(self, duration_str: str) -> Optional[int]:
+        """Parse durations like '30', '30 min', '1h', '1h 30' or '01:30' into minutes"""
+        if not duration_str:
+            return None
+        cleaned = str(duration_str).strip().lower()
+        if cleaned.isdigit():
+            return int(cleaned)
+        if ":" in cleaned:
+            parts = cleaned.split(":")
+            if len(parts) >= 2 and parts[0].isdigit() and parts[1].isdigit():
+                return int(parts[0]) * 60 + int(parts[1])
+        match = re.match(r"^(?:(\d+)\s*h(?:oras?|rs?)?)?\s*(?:(\d+)\s*(?:m|min|mins|minutos?)?)?$", cleaned)
+        if match and (match.group(1) or match.group(2)):
+            return int(match.group(1) or 0) * 60 + int(match.group(2) or 0)
+        return None
+
     def parse_date(self, date_str: str) -> Optional[str]:
         if not date_str:
             return None
@@ -181,7 +369,34 @@ class GoogleSheetsService:
             except ValueError:
                 continue
         logger.warning(f"Could not parse date: {date_str}")
-        return date_str
+        return None
+
+    def canonical_fields(self, date_str: str, time_str: str, duration_str: str) -> Dict:
+        """Typed schema fields; rows whose date or time cannot be parsed are quarantined"""
+        day = self.parse_date(date_str)
+        hhmm = self.parse_time(time_str)
+        fields = {
+            'date': day or "",
+            'time': hhmm,
+            'starts_at': None,
+            'duration_minutes': self.parse_duration_minutes(duration_str),
+            'quarantined': False,
+            'quarantine_reason': None,
+            'schema_version': SCHEMA_VERSION,
+        }
+        if not day:
+            fields.update(quarantined=True, quarantine_reason=f"unparseable date: {date_str!r}", date_raw=date_str or "")
+            return fields
+        hours, minutes = 0, 0
+        if hhmm:
+            match = re.match(r"^(\d{2}):(\d{2})$", hhmm)
+            if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+                fields.update(quarantined=True, quarantine_reason=f"unparseable time: {time_str!r}", time_raw=time_str)
+                return fields
+            hours, minutes = int(match.group(1)), int(match.group(2))
+        local = datetime.strptime(day, '%Y-%m-%d').replace(hour=hours, minute=minutes, tzinfo=CLINIC_TZ)
+        fields['starts_at'] = local.astimezone(timezone.utc)
+        return fields
 
     def parse_status(self, status_str: str) -> str:
         """Normalize status values (tolerant)."""
@@ -236,8 +451,7 @@ class GoogleSheetsService:
         full_name = " ".join([x for x in [mapped_data.get('nombre',''), mapped_data.get('apellidos','')] if x]).strip() or mapped_data.get('nombre','') or mapped_data.get('apellidos','')
         return {
             'external_id': f"{mapped_data.get('fecha','')}_{mapped_data.get('hora','')}_{full_name}".replace(' ','_'),
-            'date': self.parse_date(mapped_data.get('fecha','')),
-            'time': self.parse_time(mapped_data.get('hora','')),
+            **self.canonical_fields(mapped_data.get('fecha',''), mapped_data.get('hora',''), mapped_data.get('duracion','')),
             'patient_name': full_name,
             'last_name': mapped_data.get('apellidos',''),
             'treatment': mapped_data.get('tratamiento',''),
@@ -256,44 +470,204 @@ class GoogleSheetsService:
             'source': 'google_sheets'
         }
 
-    async def sync_appointments(self) -> Dict:
+    async def sync_appointments(self, source_ids: Optional[set] = None, use_remote: bool = True) -> Dict:
+        """Sync every source (or just `source_ids`): fetched concurrently, reconciled independently"""
         try:
-            logger.info("Starting appointments sync from Google Sheets")
-            data = await self.fetch_sheet_data()
-            if not data:
-                logger.warning("No appointments found in Google Sheets")
+            sources = [s for s in self.sources if source_ids is None or s.source_id in source_ids]
+            logger.info(f"Starting appointments sync of clinic {self.clinic_id} from {len(sources)} sheet source(s)")
+            datasets = await asyncio.gather(*(self.fetch_sheet_data(s, use_remote) for s in sources))
+            fetched = [(s, data) for s, data in zip(sources, datasets) if data]
+            if not fetched:
+                logger.warning(f"No appointments found in Google Sheets for clinic {self.clinic_id}")
                 return {"success": False, "message": "No data found", "synced": 0}
-            await self.db.appointments.delete_many({"source": "google_sheets"})
-            if data:
-                result = await self.db.appointments.insert_many(data)
-                synced_count = len(result.inserted_ids)
-            else:
-                synced_count = 0
+            rebuild_rollups = self.rollups is not None and await self.rollups.is_empty()
+            # Rows synced before sources were tagged belong to the first configured source
+            diffs = await asyncio.gather(*(
+                self.reconcile(data, s.source_id, adopt_untagged=s is self.sources[0]) for s, data in fetched
+            ))
+            diff = SyncDiff.merge(diffs)
+            if rebuild_rollups:
+                await self.rebuild_rollups()
+            elif diff and self.rollups is not None:
+                await self.apply_diff_to_rollups(diff)
+            if diff:
+                changes = (diff.added, [new for _, new in diff.updated], diff.removed, self.generation + 1)
+                if self.search_index.built:
+                    self.search_index.apply_diff(*changes)
+                elif self.search_backlog is not None:
+                    self.search_backlog.append(changes)
+            if diff.added or diff.updated:
+                try:
+                    await self.identities.observe(diff.added + [new for _, new in diff.updated])
+                except Exception as e:
+                    logger.error(f"Error updating patient identities: {str(e)}")
+            if diff and self.reminders is not None:
+                try:
+                    await self.reminders.apply_diff(diff.added, [new for _, new in diff.updated], diff.removed)
+                except Exception as e:
+                    logger.error(f"Error rescheduling reminders: {str(e)}")
+            synced_count = sum(len(data) for _, data in fetched)
             self.last_update = datetime.utcnow()
-            logger.info(f"Successfully synced {synced_count} appointments")
-            return {"success": True, "synced": synced_count, "last_update": self.last_update.isoformat(), "message": f"Successfully synced {synced_count} appointments"}
+            self.last_diff = diff
+            if diff:
+                self.generation += 1
+                self.data_generation += 1
+            per_source = {}
+            for (s, data), d in zip(fetched, diffs):
+                per_source[s.source_id] = {"synced": len(data), "added": len(d.added), "updated": len(d.updated), "removed": len(d.removed)}
+                self.source_status.setdefault(s.source_id, {}).update(per_source[s.source_id], last_update=self.last_update.isoformat())
+            self.last_headers = list(dict.fromkeys(h for st in self.source_status.values() for h in st.get("headers", [])))
+            self.last_raw_rows = sum(st.get("raw_rows", 0) for st in self.source_status.values())
+            logger.info(f"Successfully synced {synced_count} appointments of clinic {self.clinic_id} "
+                        f"(+{len(diff.added)} ~{len(diff.updated)} -{len(diff.removed)})")
+            return {
+                "success": True,
+                "synced": synced_count,
+                "added": len(diff.added),
+                "updated": len(diff.updated),
+                "removed": len(diff.removed),
+                "sources": per_source,
+                "last_update": self.last_update.isoformat(),
+                "message": f"Successfully synced {synced_count} appointments"
+            }
         except Exception as e:
-            logger.error(f"Error syncing appointments: {str(e)}")
+            logger.error(f"Error syncing appointments of clinic {self.clinic_id}: {str(e)}")
             return {"success": False, "message": str(e), "synced": 0}
+        finally:
+            self.last_sync_attempt = datetime.utcnow()
+
+    async def reconcile(self, data: List[Dict], source_id: Optional[str] = None, adopt_untagged: bool = False) -> SyncDiff:
+        """Write only the rows that differ from what is stored, keyed by external_id within the source"""
+        diff = SyncDiff()
+        projection = {"external_id": 1, "row_hash": 1, "created_at": 1, **ROLLUP_FIELDS}
+        existing: Dict[str, Dict] = {}
+        for doc in await self.repos.appointments.sync_state(projection, source_id, adopt_untagged):
+            if doc.get('external_id') in existing:
+                diff.removed.append(doc)  # duplicate left over from the old full-replace sync
+            else:
+                existing[doc.get('external_id')] = doc
+        updated, cold = [], []
+        for appointment in data:
+            old = existing.pop(appointment['external_id'], None)
+            if old is None and self.archiver is not None and self.archiver.is_cold(appointment):
+                cold.append(appointment)
+            elif old is None:
+                diff.added.append(appointment)
+            elif old.get('row_hash') != appointment['row_hash']:
+                appointment['_id'] = old['_id']
+                appointment['created_at'] = old.get('created_at') or appointment['created_at']
+                updated.append(appointment)
+                diff.updated.append((old, appointment))
+        diff.removed.extend(existing.values())
+        await self.repos.appointments.apply_sync(diff.removed, updated, diff.added)
+        if cold:
+            # Past rows not in the hot tier belong to the archive; the diff still reports them
+            # so rollups, search and patient identities see them
+            added, changed = await self.archiver.store(cold, source_id, adopt_untagged)
+            diff.added.extend(added)
+            diff.updated.extend(changed)
+        return diff
+
+    async def scan_history(self, fields: Dict, include_quarantined: bool = False) -> List[Dict]:
+        """Every appointment, hot and archived (for history-wide readers: rollups, analytics, search)"""
+        docs = await self.repos.appointments.scan(fields, include_quarantined)
+        if self.repos.archive is not None:
+            docs.extend(await self.repos.archive.scan(fields))
+        return docs
+
+    async def get_many_history(self, appointment_ids: List[str], fields: Optional[Dict] = None) -> Dict[str, Dict]:
+        docs = await self.repos.appointments.get_many(appointment_ids, fields)
+        missing = [i for i in appointment_ids if i not in docs]
+        if missing and self.repos.archive is not None:
+            docs.update(await self.repos.archive.get_many(missing, fields))
+        return docs
+
+    async def effective_statuses(self, docs: List[Dict]) -> Dict[str, str]:
+        ids = [str(d['_id']) for d in docs if d.get('_id') is not None]
+        if not ids:
+            return {}
+        overrides = await self.repos.overrides.get_many(ids)
+        return {appointment_id: doc.get("status") for appointment_id, doc in overrides.items()}
+
+    async def rebuild_rollups(self) -> int:
+        overrides = await self.repos.overrides.all()
+        docs = await self.scan_history(ROLLUP_FIELDS)
+        pairs = [(doc, (overrides.get(str(doc['_id'])) or doc).get('status')) for doc in docs]
+        return await self.rollups.rebuild(pairs)
+
+    async def apply_diff_to_rollups(self, diff: SyncDiff):
+        olds = diff.removed + [old for old, _ in diff.updated]
+        overridden = await self.effective_statuses(olds)
+        def status_of(doc):
+            return overridden.get(str(doc['_id'])) or doc.get('status')
+        removed = [(d, status_of(d)) for d in olds]
+        added = [(new, status_of(new)) for _, new in diff.updated] + [(d, d.get('status')) for d in diff.added]
+        await self.rollups.apply(removed, added)
 
     async def set_status_override(self, appointment_id: str, new_status: str, new_estado_cita: Optional[str] = None):
-        await self.overrides.update_one(
-            {"appointment_id": appointment_id},
-            {"$set": {
-                "appointment_id": appointment_id,
-                "status": new_status,
-                "estado_cita": new_estado_cita if new_estado_cita is not None else new_status,
-                "updated_at": datetime.utcnow()
-            }},
-            upsert=True
-        )
+        fields = {
+            "status": new_status,
+            "estado_cita": new_estado_cita if new_estado_cita is not None else new_status,
+            "updated_at": datetime.utcnow()
+        }
+        previous = await self.repos.overrides.upsert(appointment_id, fields)
+        # Archived appointments keep their rollup buckets, so their overrides adjust them too
+        appointment = (await self.get_many_history([appointment_id], {**ROLLUP_FIELDS, **OUTBOX_ROW_FIELDS})).get(appointment_id)
+        if appointment and self.outbox is not None:
+            await self.outbox.enqueue(
+                {appointment_id: {"status": fields["status"], "estado_cita": fields["estado_cita"]}},
+                {appointment_id: appointment}
+            )
+        if appointment and self.rollups is not None:
+            old_status = (previous or {}).get('status') or appointment.get('status')
+            await self.rollups.apply([(appointment, old_status)], [(appointment, new_status)])
+        if self.reminders is not None:
+            await self.reminders.apply_statuses({appointment_id: new_status})
+        self.generation += 1
+        self.override_log.append((self.generation, {appointment_id: (fields["status"], fields["estado_cita"])}))
+
+    async def set_status_overrides(self, updates: List[Dict]) -> Dict[str, Optional[str]]:
+        """Apply many overrides with one bulk write and a single generation bump.
+
+        `updates` holds appointment_id/status/estado_cita entries (the last entry for an
+        id wins); returns {appointment_id: error message or None}.
+        """
+        now = datetime.utcnow()
+        changes: Dict[str, Dict] = {}
+        for u in updates:
+            estado = u.get('estado_cita')
+            changes[u['appointment_id']] = {
+                "status": u['status'],
+                "estado_cita": estado if estado is not None else u['status'],
+                "updated_at": now
+            }
+        appointments = await self.get_many_history(list(changes), {**ROLLUP_FIELDS, **OUTBOX_ROW_FIELDS})
+        errors = {i: "Appointment not found" for i in changes if i not in appointments}
+        writable = {i: fields for i, fields in changes.items() if i in appointments}
+        previous, failed = await self.repos.overrides.upsert_many(writable)
+        errors.update(failed)
+        written = [i for i in writable if i not in failed]
+        if written and self.outbox is not None:
+            await self.outbox.enqueue(
+                {i: {"status": writable[i]["status"], "estado_cita": writable[i]["estado_cita"]} for i in written},
+                appointments
+            )
+        if written and self.rollups is not None:
+            removed = [(appointments[i], (previous.get(i) or {}).get('status') or appointments[i].get('status')) for i in written]
+            added = [(appointments[i], writable[i]['status']) for i in written]
+            await self.rollups.apply(removed, added)
+        if written and self.reminders is not None:
+            await self.reminders.apply_statuses({i: writable[i]['status'] for i in written})
+        if written:
+            self.generation += 1
+            self.override_log.append((self.generation, {i: (writable[i]["status"], writable[i]["estado_cita"]) for i in written}))
+        return {i: errors.get(i) for i in changes}
 
     async def apply_overrides(self, appointments: List[Dict]) -> List[Dict]:
         ids = [a.get('_id') for a in appointments if a.get('_id')]
         if not ids:
             return appointments
-        cursor = self.overrides.find({"appointment_id": {"$in": ids}})
-        overrides = {doc["appointment_id"]: doc async for doc in cursor}
+        overrides = await self.repos.overrides.get_many(ids)
         for a in appointments:
             ov = overrides.get(a.get('_id'))
             if ov:
@@ -305,55 +679,405 @@ class GoogleSheetsService:
                                start_date: Optional[str] = None,
                                end_date: Optional[str] = None,
                                status: Optional[str] = None,
-                               limit: int = 10000) -> List[Dict]:
+                               limit: int = 10000,
+                               include_archived: bool = False) -> List[Dict]:
         try:
-            query = {"source": "google_sheets"}
-            if start_date:
-                query["date"] = {"$gte": start_date}
-            if end_date:
-                if "date" in query:
-                    query["date"]["$lte"] = end_date
-                else:
-                    query["date"] = {"$lte": end_date}
-            if status:
-                query["status"] = status
-            cursor = self.db.appointments.find(query).sort([
-                ("date", 1),
-                ("time", 1)
-            ]).limit(limit)
-            appointments = await cursor.to_list(length=limit)
+            starts_at = date_range_query(start_date, end_date) if start_date or end_date else None
+            appointments = await self.repos.appointments.find(starts_at, status, limit=limit)
+            if self.archiver is not None and (include_archived or self.archiver.reaches(starts_at)):
+                # Only history views and ranges reaching back past the horizon touch the archive
+                archived = await self.archiver.find(starts_at, status, limit)
+                if archived:
+                    appointments = merge_tiers(appointments, archived, limit)
             for a in appointments:
                 a["_id"] = str(a["_id"])  # ObjectId -> str
+                if a.get("starts_at"):
+                    a["starts_at"] = a["starts_at"].replace(tzinfo=timezone.utc).astimezone(CLINIC_TZ)
             appointments = await self.apply_overrides(appointments)
             return appointments
         except Exception as e:
             logger.error(f"Error fetching appointments: {str(e)}")
             return []
 
-    async def start_auto_sync(self, interval_minutes: int = 5):
-        logger.info(f"Starting auto-sync every {interval_minutes} minutes")
+    async def get_patient_history(self, patient_keys: List[str], before: Optional[Tuple[datetime, str]] = None,
+                                  limit: int = 50) -> Tuple[List[Dict], Optional[str]]:
+        """One patient's appointments newest first from both tiers, with override statuses;
+        returns (page, cursor of the next page or None)"""
+        appointments = await self.repos.appointments.history(patient_keys, before, limit + 1)
+        # The archive only holds rows before the horizon: a full page of newer hot rows never needs it
+        if self.archiver is not None and (len(appointments) <= limit or self.archiver.is_cold(appointments[limit])):
+            archived = await self.repos.archive.history(patient_keys, before, limit + 1)
+            if archived:
+                appointments = merge_tiers(appointments, archived, limit + 1, newest_first=True)
+        page = appointments[:limit]
+        next_cursor = encode_cursor(page[-1]) if len(appointments) > limit else None
+        for a in page:
+            a["_id"] = str(a["_id"])
+            a["starts_at"] = as_utc(a["starts_at"]).astimezone(CLINIC_TZ)
+        return await self.apply_overrides(page), next_cursor
+
+    async def ensure_search_index(self):
+        """Build the search index off the event loop, then replay the sync diffs that landed meanwhile"""
+        async with self.search_lock:
+            if self.search_index.built:
+                return
+            self.search_backlog = []
+            docs = await self.scan_history(SEARCH_PROJECTION)
+            index = AppointmentSearchIndex()
+            await asyncio.to_thread(index.build, docs, self.generation)
+            # Replaying a diff the scan already saw is harmless: drops and re-adds are idempotent
+            for diff in self.search_backlog:
+                index.apply_diff(*diff)
+            self.search_backlog = None
+            self.search_index = index
+
+    async def search_appointments(self, query: str, offset: int = 0, limit: int = 20, order: str = 'relevance') -> Dict:
+        if not self.search_index.built:
+            await self.ensure_search_index()
+        started = time.perf_counter()
+        total, page = self.search_index.search(query, offset, limit, order)
+        took_ms = (time.perf_counter() - started) * 1000
+        docs = await self.get_many_history([appointment_id for appointment_id, _ in page])
+        results = []
+        for appointment_id, score in page:
+            doc = docs.get(appointment_id)
+            if doc is None:
+                continue
+            doc["_id"] = appointment_id
+            doc["score"] = score
+            if doc.get("starts_at"):
+                doc["starts_at"] = doc["starts_at"].replace(tzinfo=timezone.utc).astimezone(CLINIC_TZ)
+            results.append(doc)
+        return {
+            "query": query,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "took_ms": round(took_ms, 3),
+            "results": await self.apply_overrides(results),
+        }
+
+    async def start_auto_sync(self, interval_minutes: Optional[float] = None, initial_sync: bool = True):
+        """Sync loop; with `initial_sync=False` (the lifespan already ran the first sync) it starts by waiting"""
+        interval_minutes = interval_minutes or self.sync_interval_minutes
+        logger.info(f"Starting auto-sync of clinic {self.clinic_id} every {interval_minutes} minutes")
+        watchers = [asyncio.create_task(self.watch_source(s)) for s in self.sources if s.watchable]
+        try:
+            if initial_sync:
+                try:
+                    await self.restore_snapshots()
+                except Exception as e:
+                    logger.error(f"Error restoring sheet snapshots: {str(e)}")
+            requested = None
+            run_now = initial_sync
+            while True:
+                try:
+                    if run_now:
+                        await self.sync_appointments(requested)
+                    run_now = True
+                    # A watched source wakes the loop early for just that source; the interval
+                    # stays as a safety net and syncs everything
+                    try:
+                        await asyncio.wait_for(self.sync_requested.wait(), timeout=interval_minutes * 60)
+                        requested = set(self.pending_sources)
+                    except asyncio.TimeoutError:
+                        requested = None
+                        # The safety net does not trust incremental reads: it re-reads sources in full
+                        for source in self.sources:
+                            source.invalidate()
+                    self.sync_requested.clear()
+                    self.pending_sources.clear()
+                except Exception as e:
+                    logger.error(f"Error in auto-sync of clinic {self.clinic_id}: {str(e)}")
+                    await asyncio.sleep(60)
+        finally:
+            for watcher in watchers:
+                watcher.cancel()
+
+    async def watch_source(self, source: SheetSource):
+        """Request a sync of `source` whenever it reports a change"""
         while True:
             try:
-                await self.sync_appointments()
-                await asyncio.sleep(interval_minutes * 60)
+                async for _ in source.watch():
+                    self.pending_sources.add(source.source_id)
+                    self.sync_requested.set()
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logger.error(f"Error in auto-sync: {str(e)}")
-                await asyncio.sleep(60)
+                logger.error(f"Error watching sheet source {source.source_id}: {str(e)}")
+            await asyncio.sleep(5)
+
+    def describe_sources(self) -> List[Dict]:
+        return [{**s.describe(), **self.source_status.get(s.source_id, {})} for s in self.sources]
+
+    async def close(self):
+        for source in self.sources:
+            await source.close()
+
+# =====================
+# Appointments Router
+# =====================
+VALID_STATUSES = {'pending', 'confirmed', 'completed', 'cancelled', 'rescheduled'}
+SYNC_INTERVAL_MINUTES = 5
+MAX_BULK_STATUS_UPDATES = 1000
+
+class StatusUpdateItem(BaseModel):
+    appointment_id: str
+    status: str
+    estado_cita: Optional[str] = None
+
+class BulkStatusUpdate(BaseModel):
+    updates: List[StatusUpdateItem]
+
+APPOINTMENT_LIST = TypeAdapter(List[Appointment])
+
+def appointments_response(appointments: List[Dict]) -> Response:
+    """A listing validated and serialized as its response_model would be, but by the caller,
+    so the work happens while it still holds its admission slot"""
+    body = APPOINTMENT_LIST.dump_json(APPOINTMENT_LIST.validate_python(appointments), by_alias=True)
+    return Response(content=body, media_type="application/json")
+
+def clinic_today() -> str:
+    return datetime.now(CLINIC_TZ).strftime('%Y-%m-%d')
+
+def create_appointments_router(mongo: MongoClientProvider, clinics):
+    """Appointment endpoints; each request is served by the clinic it names (clinics.ClinicRegistry)"""
+    router = APIRouter(prefix="/api/appointments", tags=["appointments"])
+    clinic = Depends(clinics.resolve)
+
+    @router.get("/", response_model=List[Appointment])
+    async def get_appointments(
+        start_date: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
+        end_date: Optional[str] = Query(None, description="End date (YYYY-MM-DD)"),
+        status: Optional[str] = Query(None, description="Appointment status"),
+        patient: Optional[str] = Query(None, description="Patient name filter"),
+        limit: int = Query(10000, ge=1, le=50000, description="Maximum number of appointments"),
+        include_archived: bool = Query(False, description="Also list archived appointments when no start date bounds the range"),
+        service: GoogleSheetsService = clinic
+    ):
+        try:
+            # The slot is held until the body is serialized: for large listings that is most of the work
+            async with clinics.slot(service, 'appointments.list'):
+                appointments = await service.get_appointments(start_date, end_date, status, limit=limit,
+                                                              include_archived=include_archived)
+                if patient:
+                    patient_lower = patient.lower()
+                    appointments = [
+                        apt for apt in appointments
+                        if patient_lower in apt.get('patient_name', '').lower()
+                    ]
+                return appointments_response(appointments)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error fetching appointments: {str(e)}")
+
+    @router.get("/today", response_model=List[Appointment])
+    async def get_today_appointments(service: GoogleSheetsService = clinic):
+        today = clinic_today()
+        try:
+            async with clinics.slot(service, 'appointments.today'):
+                return appointments_response(await service.get_appointments(start_date=today, end_date=today))
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error fetching today's appointments: {str(e)}")
+
+    @router.get("/stats", response_model=AppointmentStats)
+    async def get_appointment_stats(service: GoogleSheetsService = clinic):
+        try:
+            repo = service.repos.appointments
+            async with clinics.slot(service, 'appointments.stats'):
+                # Archived counts are cached by the archiver until the archive changes
+                archived = await service.archiver.counts() if service.archiver is not None else {}
+                total = await repo.count() + archived.get('total', 0)
+                today = clinic_today()
+                today_count = await repo.count(starts_at=date_range_query(today, today))
+                counts = {}
+                for s in ['confirmed', 'pending', 'completed', 'cancelled']:
+                    counts[s] = await repo.count(status=s) + archived.get(s, 0)
+            return AppointmentStats(
+                total_appointments=total,
+                today_appointments=today_count,
+                confirmed_appointments=counts['confirmed'],
+                pending_appointments=counts['pending'],
+                completed_appointments=counts['completed'],
+                cancelled_appointments=counts['cancelled']
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error fetching stats: {str(e)}")
+
+    @router.post("/sync", response_model=SyncResult)
+    async def sync_appointments(service: GoogleSheetsService = clinic):
+        try:
+            result = await service.sync_appointments()
+            return SyncResult(**result)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Sync failed: {str(e)}")
+
+    @router.get("/sync/status")
+    async def get_sync_status(service: GoogleSheetsService = clinic):
+        return {
+            "clinic_id": service.clinic_id,
+            "last_update": service.last_update.isoformat() if service.last_update else None,
+            "auto_sync_active": True,
+            "sync_interval_minutes": service.sync_interval_minutes,
+            "generation": service.generation,
+            "headers": service.last_headers,
+            "row_count": service.last_raw_rows,
+            "sources": service.describe_sources()
+        }
+
+    @router.get("/clinics")
+    async def get_clinics():
+        """Configured clinics with their sources, sync state and queries in flight"""
+        return {"default": clinics.default_id, "clinics": clinics.describe()}
+
+    @router.get("/quarantine")
+    async def get_quarantined_appointments(limit: int = Query(500, ge=1, le=5000), service: GoogleSheetsService = clinic):
+        """Rows whose date or time could not be parsed and are hidden from listings"""
+        docs = await service.repos.appointments.quarantined(
+            {"external_id": 1, "patient_name": 1, "date_raw": 1, "time_raw": 1, "quarantine_reason": 1}, limit
+        )
+        for d in docs:
+            d["_id"] = str(d["_id"])
+        return docs
+
+    @router.get("/search")
+    async def search_appointments(
+        q: str = Query(..., min_length=1, description="Words or word prefixes, all of which must match"),
+        limit: int = Query(20, ge=1, le=200),
+        offset: int = Query(0, ge=0),
+        sort: str = Query("relevance", pattern="^(relevance|date)$", description="relevance, or date (most recent first)"),
+        service: GoogleSheetsService = clinic
+    ):
+        """Full-text search over patient names, treatment, notes and doctor"""
+        async with clinics.slot(service, 'appointments.search'):
+            return await service.search_appointments(q, offset, limit, sort)
+
+    @router.get("/archive")
+    async def get_archive_status(service: GoogleSheetsService = clinic):
+        if service.archiver is None:
+            return {"enabled": False}
+        return {"enabled": True, **await service.archiver.stats()}
+
+    @router.post("/archive/run")
+    async def run_archive(service: GoogleSheetsService = clinic):
+        """Move appointments past the horizon to the archive now"""
+        if service.archiver is None:
+            raise HTTPException(status_code=400, detail="Archiving needs a MongoDB repository backend")
+        return {"moved": await service.archiver.run_once()}
+
+    @router.get("/reminders")
+    async def get_reminders_status(limit: int = Query(20, ge=0, le=500), service: GoogleSheetsService = clinic):
+        """Pending appointment reminders and the next ones due"""
+        if service.reminders is None:
+            return {"enabled": False}
+        return {
+            "enabled": True,
+            **service.reminders.stats(),
+            "upcoming": service.reminders.upcoming(limit),
+            "metrics": REGISTRY.snapshot('reminders.'),
+        }
+
+    @router.get("/search/stats")
+    async def get_search_stats(service: GoogleSheetsService = clinic):
+        return service.search_index.stats()
+
+    @router.get("/sync/headers")
+    async def get_sync_headers(service: GoogleSheetsService = clinic):
+        return {"headers": service.last_headers, "row_count": service.last_raw_rows}
+
+    @router.get("/upcoming", response_model=List[Appointment])
+    async def get_upcoming_appointments(days: int = Query(7, description="Number of days ahead"),
+                                        service: GoogleSheetsService = clinic):
+        try:
+            today = datetime.now(CLINIC_TZ).date()
+            async with clinics.slot(service, 'appointments.upcoming'):
+                appointments = await service.get_appointments(
+                    start_date=today.strftime('%Y-%m-%d'),
+                    end_date=(today + timedelta(days=days)).strftime('%Y-%m-%d')
+                )
+                return appointments_response([apt for apt in appointments if apt.get('status') in ['confirmed', 'pending']])
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error fetching upcoming appointments: {str(e)}")
+
+    @router.post("/status/bulk")
+    async def update_appointment_statuses(payload: BulkStatusUpdate = Body(...), service: GoogleSheetsService = clinic):
+        """Apply many status overrides in one round trip; results follow the request order"""
+        if len(payload.updates) > MAX_BULK_STATUS_UPDATES:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_STATUS_UPDATES} updates per request")
+        valid = [u.dict() for u in payload.updates if u.status in VALID_STATUSES]
+        errors = await service.set_status_overrides(valid) if valid else {}
+        results = []
+        for u in payload.updates:
+            error = errors.get(u.appointment_id) if u.status in VALID_STATUSES else f"Invalid status: {u.status}"
+            results.append({"appointment_id": u.appointment_id, "status": u.status, "success": error is None, "error": error})
+        succeeded = sum(1 for r in results if r["success"])
+        return {
+            "success": succeeded == len(results),
+            "updated": succeeded,
+            "failed": len(results) - succeeded,
+            "generation": service.generation,
+            "results": results
+        }
+
+    @router.post("/{appointment_id}/status")
+    async def update_appointment_status(
+        appointment_id: str,
+        new_status: str = Query(..., description="New normalized status"),
+        estado_cita_text: Optional[str] = Query(None, description="Raw EstadoCita text"),
+        service: GoogleSheetsService = clinic
+    ):
+        if new_status not in VALID_STATUSES:
+            raise HTTPException(status_code=400, detail=f"Invalid status: {new_status}")
+        await service.set_status_override(appointment_id, new_status, estado_cita_text)
+        return {"success": True, "appointment_id": appointment_id, "status": new_status}
+
+    @router.get("/outbox")
+    async def get_outbox_status():
+        """Write-back queue towards the source sheets (shared by every clinic)"""
+        outbox = clinics.default.outbox
+        if outbox is None:
+            return {"enabled": False}
+        flusher = router.outbox_flusher
+        return {
+            "enabled": True,
+            "flusher_running": flusher is not None,
+            "last_error": flusher.last_error if flusher else None,
+            "counts": await outbox.counts(),
+            "oldest_pending_age_seconds": await outbox.oldest_pending_age_seconds(),
+            "metrics": REGISTRY.snapshot('outbox.'),
+        }
+
+    async def start_background_sync(tasks: BackgroundTasks, service: GoogleSheetsService, initial_sync: bool = True):
+        """Start one clinic's sync loop, archiver and reminders; the shared outbox flusher starts with the first clinic"""
+        tasks.start(f'sync_loop:{service.clinic_id}', service.start_auto_sync(initial_sync=initial_sync))
+        if service.archiver is not None:
+            tasks.start(f'archiver:{service.clinic_id}', service.archiver.run())
+        if service.reminders is not None:
+            tasks.start(f'reminders:{service.clinic_id}', service.reminders.run())
+        if router.outbox_flusher is not None or service.outbox is None:
+            return
+        sink = create_sink_from_env()
+        if sink is not None:
+            router.outbox_flusher = OutboxFlusher(service.outbox, sink)
+            tasks.start('outbox_flusher', router.outbox_flusher.run())
+
+    # server.py drives the background sync per clinic
+    router.clinics = clinics
+    router.start_background_sync = start_background_sync
+    router.outbox_flusher = None
+    return router
 
 # =====================
 # Patients Router
 # =====================
-def normalize_phone(phone: str) -> str:
-    if not phone:
-        return ""
-    return re.sub(r"\D+", "", phone)
-
-def make_patient_key(num_paciente: str, full_name: str, phone: str) -> str:
-    if num_paciente:
-        return f"num:{num_paciente.strip()}"
-    name_key = (full_name or "").strip().lower()
-    phone_key = normalize_phone(phone)
-    return f"np:{name_key}|{phone_key}"
+PATIENT_FIELDS = {"_id": 0, "patient_name": 1, "phone": 1, "num_paciente": 1}
 
 def split_name(full_name: str) -> Dict[str,str]:
     parts = (full_name or "").strip().split()
@@ -369,17 +1093,27 @@ class PatientCreate(PatientBase):
 class PatientUpdate(PatientBase):
     pass
 
-def create_patients_router(db_client: AsyncIOMotorClient):
+def create_patients_router(mongo: MongoClientProvider, clinics):
+    """Patient endpoints, scoped like the appointments router to the clinic a request names"""
     router = APIRouter(prefix="/api/patients", tags=["patients"])
-    db = db_client[os.environ['DB_NAME']]
+    clinic = Depends(clinics.resolve)
 
     @router.get("/")
-    async def list_patients():
+    async def list_patients(service: GoogleSheetsService = clinic):
+        async with clinics.slot(service, 'patients.list'):
+            return await derive_patients(service.repos, service.identities)
+
+    async def derive_patients(repos: Repositories, identities: PatientIdentityIndex) -> List[Dict]:
+        # One entry per identity cluster, so a person seen under several keys is listed once
+        await identities.ensure_loaded()
         # 1) Load manual patients first (take precedence)
-        manual_docs = await db.patients.find().to_list(5000)
+        manual_docs = await repos.patients.list(5000)
         patients_map: Dict[str, Dict] = {}
         for doc in manual_docs:
-            key = make_patient_key(doc.get('num_paciente',''), doc.get('full_name','') or f"{doc.get('first_name','')} {doc.get('last_name','')}", doc.get('phone',''))
+            key = identities.cluster_id(make_patient_key(doc.get('num_paciente',''), doc.get('full_name','') or f"{doc.get('first_name','')} {doc.get('last_name','')}", doc.get('phone','')))
+            if key in patients_map:
+                # Two manual records of one person: both stay visible
+                key = f"manual:{doc.get('_id')}"
             out = {
                 "_id": str(doc.get('_id')),
                 "first_name": doc.get('first_name',''),
@@ -391,15 +1125,19 @@ def create_patients_router(db_client: AsyncIOMotorClient):
                 "num_paciente": doc.get('num_paciente',''),
                 "notes": doc.get('notes',''),
                 "source": "manual",
+                "cluster_id": key,
             }
             patients_map[key] = out
         # 2) Derive from appointments and fill gaps
-        cursor = db.appointments.find({}, {"patient_name":1, "last_name":1, "phone":1, "num_paciente":1})
-        async for a in cursor:
+        # Served from the hot tier once warm; in MongoDB it is covered by the (clinic_id, source, num_paciente, patient_name, phone) index
+        rows = await repos.appointments.scan(PATIENT_FIELDS, include_quarantined=True)
+        if repos.archive is not None:
+            rows.extend(await repos.archive.scan(PATIENT_FIELDS))
+        for a in rows:
             full_name = a.get('patient_name','')
             phone = a.get('phone','')
             nump = a.get('num_paciente','')
-            key = make_patient_key(nump, full_name, phone)
+            key = identities.cluster_id(make_patient_key(nump, full_name, phone))
             if key in patients_map:
                 # fill missing fields only
                 p = patients_map[key]
@@ -412,7 +1150,7 @@ def create_patients_router(db_client: AsyncIOMotorClient):
                 continue
             # create derived entry
             name_parts = split_name(full_name)
-            derived_id = str(uuid5(NAMESPACE_DNS, key))
+            derived_id = derived_patient_id(key)
             patients_map[key] = {
                 "_id": derived_id,
                 "first_name": name_parts['first_name'],
@@ -424,11 +1162,51 @@ def create_patients_router(db_client: AsyncIOMotorClient):
                 "num_paciente": nump,
                 "notes": "",
                 "source": "derived",
+                "cluster_id": key,
             }
         return list(patients_map.values())
 
+    @router.get("/{patient_id}/appointments")
+    async def get_patient_appointments(
+        patient_id: str,
+        limit: int = Query(50, ge=1, le=500),
+        cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+        service: GoogleSheetsService = clinic,
+    ):
+        """A patient's appointments newest first, under every key of their identity cluster"""
+        before = decode_cursor(cursor) if cursor else None
+        keys = await patient_keys(service, patient_id)
+        async with clinics.slot(service, 'patients.history'):
+            appointments, next_cursor = await service.get_patient_history(keys, before, limit)
+        return {"patient_id": patient_id, "patient_keys": keys, "appointments": appointments, "next_cursor": next_cursor}
+
+    async def patient_keys(service: GoogleSheetsService, patient_id: str) -> List[str]:
+        """Keys of a listed patient: a derived id names its cluster, a manual one its record"""
+        identities = service.identities
+        await identities.ensure_loaded()
+        cluster = identities.cluster_of_patient_id(patient_id)
+        if cluster is None:
+            doc = await service.repos.patients.get(patient_id)
+            if doc is None:
+                raise HTTPException(status_code=404, detail="Patient not found")
+            full_name = doc.get('full_name') or f"{doc.get('first_name', '')} {doc.get('last_name', '')}".strip()
+            cluster = doc.get('key') or make_patient_key(doc.get('num_paciente', ''), full_name, doc.get('phone', ''))
+        return identities.keys_of(cluster)
+
+    @router.get("/identities")
+    async def get_identity_stats(service: GoogleSheetsService = clinic):
+        """Identity clusters: keys, clusters, merges and blocking statistics"""
+        await service.identities.ensure_loaded()
+        return service.identities.stats()
+
+    @router.post("/identities/rebuild")
+    async def rebuild_identities(service: GoogleSheetsService = clinic):
+        """Re-resolve every patient identity from appointments and manual patients"""
+        return await service.identities.rebuild()
+
     @router.post("/", response_model=Patient)
-    async def create_patient(payload: PatientCreate = Body(...)):
+    async def create_patient(payload: PatientCreate = Body(...), service: GoogleSheetsService = clinic):
+        repos, identities = service.repos, service.identities
         now = datetime.utcnow()
         full_name = payload.full_name or f"{payload.first_name} {payload.last_name}".strip()
         key = make_patient_key(payload.num_paciente, full_name, payload.phone)
@@ -444,21 +1222,17 @@ def create_patients_router(db_client: AsyncIOMotorClient):
             "notes": payload.notes,
             "key": key,
             "source": "manual",
-            "created_at": now,
             "updated_at": now,
         }
-        existing = await db.patients.find_one({"key": key})
-        if existing:
-            await db.patients.update_one({"_id": existing["_id"]}, {"$set": doc})
-            existing.update(doc)
-            existing["_id"] = str(existing["_id"])
-            return Patient(**existing)
-        result = await db.patients.insert_one(doc)
-        doc["_id"] = str(result.inserted_id)
-        return Patient(**doc)
+        await identities.observe([doc])
+        # One atomic round trip: concurrent creates of the same patient converge on one record
+        patient = await repos.patients.upsert_by_key(key, doc, now)
+        patient["_id"] = str(patient["_id"])
+        return Patient(**patient)
 
     @router.put("/{patient_id}", response_model=Patient)
-    async def update_patient(patient_id: str, payload: PatientUpdate = Body(...)):
+    async def update_patient(patient_id: str, payload: PatientUpdate = Body(...), service: GoogleSheetsService = clinic):
+        repos, identities = service.repos, service.identities
         # If patient exists manual -> update; if it's a derived id (uuid5), create or upsert manual by key
         full_name = payload.full_name or f"{payload.first_name} {payload.last_name}".strip()
         key = make_patient_key(payload.num_paciente, full_name, payload.phone)
@@ -476,23 +1250,21 @@ def create_patients_router(db_client: AsyncIOMotorClient):
             "source": "manual",
             "updated_at": now,
         }
-        existing = await db.patients.find_one({"_id": patient_id})
-        if existing:
-            await db.patients.update_one({"_id": patient_id}, {"$set": doc_update})
-            existing.update(doc_update)
-            existing["_id"] = str(existing["_id"])
-            return Patient(**existing)
-        # Upsert by key
-        existing_by_key = await db.patients.find_one({"key": key})
-        if existing_by_key:
-            await db.patients.update_one({"_id": existing_by_key["_id"]}, {"$set": doc_update})
-            existing_by_key.update(doc_update)
-            existing_by_key["_id"] = str(existing_by_key["_id"])
-            return Patient(**existing_by_key)
-        # Create new manual entry
-        doc_update["created_at"] = now
-        result = await db.patients.insert_one(doc_update)
-        doc_update["_id"] = str(result.inserted_id)
-        return Patient(**doc_update)
+        await identities.observe([doc_update])
+        patient = await repos.patients.update(patient_id, doc_update)
+        if patient is None:
+            # A derived id (uuid5): create or update the manual patient by key
+            patient = await repos.patients.upsert_by_key(key, doc_update, now)
+        patient["_id"] = str(patient["_id"])
+        return Patient(**patient)
+
+    @router.post("/import")
+    async def import_patients(request: Request, service: GoogleSheetsService = clinic):
+        """Bulk upsert patients from a CSV (header row first), JSON array or NDJSON body,
+        chosen by Content-Type and parsed as it streams in; returns per-row errors"""
+        content_type = request.headers.get('content-type', '').split(';')[0].strip().lower()
+        records = JsonRecords() if 'json' in content_type else CsvRecords()
+        async with clinics.slot(service, 'patients.import'):
+            return await PatientImporter(service.repos, service.identities).run(iter_records(request.stream(), records))
 
     return router
\ No newline at end of file
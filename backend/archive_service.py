@@ -0,0 +1,168 @@
+import asyncio
+import heapq
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+
+from metrics import REGISTRY
+from repositories import MongoAppointmentRepository, Repositories
+from rollups_service import ROLLUP_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+def as_utc(value: datetime) -> datetime:
+    """MongoDB hands back naive UTC datetimes, parsed sheet rows carry tz-aware ones"""
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+class AppointmentArchiver:
+    """Hot/cold tiering for appointments.
+
+    The hot `appointments` collection (and the in-memory tier in front of it) holds
+    the recent and future window; appointments that started more than `after_days`
+    ago are moved to `appointments_archive` in batches, keeping their _id so status
+    overrides still apply. Sheet rows already past the horizon that are not in the
+    hot collection are written straight to the archive by the sync (`store`), so
+    years of history in the sheet never flow back into the hot tier. The archive is
+    history: rows that disappear from the sheet are not deleted from it.
+    """
+
+    def __init__(self, mongo, repositories: Repositories, after_days: Optional[int] = None,
+                 batch_size: Optional[int] = None, interval_seconds: Optional[float] = None):
+        self.repos = repositories
+        self.archive: MongoAppointmentRepository = repositories.archive
+        # Full documents are read from MongoDB, not the hot tier's packed records
+        self.hot = MongoAppointmentRepository(mongo, clinic_id=repositories.clinic_id)
+        self.after_days = after_days or int(os.environ.get('APPOINTMENT_ARCHIVE_AFTER_DAYS', '180'))
+        self.batch_size = batch_size or int(os.environ.get('APPOINTMENT_ARCHIVE_BATCH_SIZE', '1000'))
+        self.interval_seconds = interval_seconds or float(os.environ.get('APPOINTMENT_ARCHIVE_INTERVAL_SECONDS', '3600'))
+        # Cached against the archive's latest archived_at, which every archive write (by any worker) moves
+        self._counts: Optional[Tuple[Optional[datetime], Dict[str, int]]] = None
+        self.last_run: Dict = {}
+
+    def horizon(self) -> datetime:
+        return datetime.now(timezone.utc) - timedelta(days=self.after_days)
+
+    def is_cold(self, appointment: Dict) -> bool:
+        starts_at = appointment.get('starts_at')
+        return starts_at is not None and as_utc(starts_at) < self.horizon()
+
+    def reaches(self, starts_at: Optional[Dict]) -> bool:
+        """Whether a starts_at range query reaches back past the horizon; an unbounded
+        listing does not (it asks for history explicitly, see get_appointments)"""
+        if not starts_at:
+            return False
+        lower = starts_at.get('$gte')
+        return lower is None or as_utc(lower) < self.horizon()
+
+    async def run_once(self) -> int:
+        """Move every hot appointment past the horizon to the archive; returns how many moved"""
+        horizon = self.horizon()
+        moved = 0
+        while True:
+            docs = await self.hot.find({"$lt": horizon}, limit=self.batch_size)
+            if not docs:
+                break
+            now = datetime.utcnow()
+            # Upsert by _id first, delete second: a crash in between leaves a copy in both
+            # tiers, which the next run resolves and readers deduplicate meanwhile
+            await self.archive.collection.bulk_write(
+                [ReplaceOne({"_id": d["_id"]}, {**d, "archived_at": now}, upsert=True) for d in docs], ordered=False
+            )
+            await self.repos.appointments.apply_sync(docs, [], [])
+            moved += len(docs)
+            if len(docs) < self.batch_size:
+                break
+        REGISTRY.counter('archive.moved').inc(moved)
+        self.last_run = {"at": datetime.utcnow().isoformat(), "moved": moved, "horizon": horizon.isoformat()}
+        if moved:
+            logger.info(f"Archived {moved} appointments older than {horizon.date()}")
+        return moved
+
+    async def store(self, rows: List[Dict], source_id: str, adopt_untagged: bool = False) -> Tuple[List[Dict], List[Tuple[Dict, Dict]]]:
+        """Write sheet rows past the horizon to the archive: new rows are inserted and
+        changed ones updated in place. Returns (added, [(old, new)]) for the sync's diff consumers."""
+        if not rows:
+            return [], []
+        source = {"$in": [source_id, None]} if adopt_untagged else source_id
+        projection = {"external_id": 1, "row_hash": 1, "created_at": 1, **ROLLUP_FIELDS}
+        cursor = self.archive.collection.find(
+            {**self.archive.base, "source_id": source, "external_id": {"$in": [r['external_id'] for r in rows]}}, projection
+        )
+        existing = {doc['external_id']: doc async for doc in cursor}
+        ops, added, updated = [], [], []
+        now = datetime.utcnow()
+        for row in rows:
+            old = existing.get(row['external_id'])
+            row['archived_at'] = now
+            if old is None:
+                ops.append(InsertOne(row))
+                added.append(row)
+            elif old.get('row_hash') != row['row_hash']:
+                row['_id'] = old['_id']
+                row['created_at'] = old.get('created_at') or row['created_at']
+                ops.append(UpdateOne({"_id": old['_id']}, {"$set": {k: v for k, v in row.items() if k != '_id'}}))
+                updated.append((old, row))
+        if ops:
+            await self.archive.collection.bulk_write(ops, ordered=False)
+        return added, updated
+
+    async def find(self, starts_at: Optional[Dict], status: Optional[str], limit: int) -> List[Dict]:
+        """The archived part of a listing: the range clipped to before the horizon"""
+        horizon = self.horizon()
+        clipped = dict(starts_at or {})
+        if clipped.get('$lt') is None or as_utc(clipped['$lt']) > horizon:
+            clipped['$lt'] = horizon
+        return await self.archive.find(clipped, status, limit=limit)
+
+    async def last_archived_at(self) -> Optional[datetime]:
+        latest = await self.archive.collection.find_one(self.archive.base, {"archived_at": 1}, sort=[("archived_at", -1)])
+        return (latest or {}).get("archived_at")
+
+    async def counts(self) -> Dict[str, int]:
+        """Archived appointments in total and per status, cached until the archive changes"""
+        version = await self.last_archived_at()
+        if self._counts is None or self._counts[0] != version:
+            pipeline = [{"$match": {**self.archive.base, "quarantined": False}}, {"$group": {"_id": "$status", "count": {"$sum": 1}}}]
+            rows = await self.archive.collection.aggregate(pipeline).to_list(length=None)
+            by_status = {r["_id"]: r["count"] for r in rows}
+            by_status["total"] = sum(r["count"] for r in rows)
+            self._counts = (version, by_status)
+        return self._counts[1]
+
+    async def run(self):
+        logger.info(f"Starting appointment archiver (after {self.after_days} days, every {self.interval_seconds}s)")
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error archiving appointments: {str(e)}")
+            await asyncio.sleep(self.interval_seconds)
+
+    async def stats(self) -> Dict:
+        return {
+            "after_days": self.after_days,
+            "horizon": self.horizon().isoformat(),
+            "archived": (await self.counts()).get("total", 0),
+            "hot": await self.hot.count(),
+            "last_run": self.last_run,
+        }
+
+
+def merge_tiers(hot: List[Dict], cold: List[Dict], limit: int, newest_first: bool = False) -> List[Dict]:
+    """Listings from both tiers merged by starts_at; a row caught mid-move appears once"""
+    merged, seen = [], set()
+    for doc in heapq.merge(cold, hot, key=lambda d: (as_utc(d['starts_at']), str(d['_id'])), reverse=newest_first):
+        if doc['_id'] in seen:
+            continue
+        seen.add(doc['_id'])
+        merged.append(doc)
+        if len(merged) >= limit:
+            break
+    return merged
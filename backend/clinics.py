@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Dict, Iterator, List, Optional
+
+from fastapi import Header, HTTPException, Query
+
+from admission import AdmissionController
+from appointments_service import GoogleSheetsService
+from repositories import create_repositories
+from sheet_sources import SheetSource, create_sources_from_env
+
+logger = logging.getLogger(__name__)
+
+
+class ClinicRegistry:
+    """One partition per clinic, each served by its own GoogleSheetsService.
+
+    Sources are grouped by their clinic_id. Every clinic gets its own repositories
+    (MongoDB queries scoped by clinic_id, separate in-memory tiers), search index,
+    patient identities, rollups and archiver, and its own sync loop on its own
+    interval, so clinics sync concurrently and independently.
+
+    Requests name their clinic with the `clinic_id` query parameter or the
+    X-Clinic-Id header, falling back to the first configured clinic. Reads go
+    through admission control per route (admission.AdmissionController), which
+    sheds with 503 once a route's queue is full; expensive ones (listings, search,
+    patients, analytics) then take one of the clinic's `max_concurrent_queries`
+    slots, so a burst against one clinic queues behind itself instead of taking the
+    database pool and event loop from the others.
+    """
+
+    def __init__(self, mongo, backend: Optional[str] = None, sources: Optional[List[SheetSource]] = None,
+                 max_concurrent_queries: Optional[int] = None):
+        by_clinic: Dict[str, List[SheetSource]] = {}
+        for source in sources or create_sources_from_env():
+            by_clinic.setdefault(source.clinic_id, []).append(source)
+        self.services: Dict[str, GoogleSheetsService] = {
+            clinic_id: GoogleSheetsService(mongo, create_repositories(mongo, backend, clinic_id), clinic_sources)
+            for clinic_id, clinic_sources in by_clinic.items()
+        }
+        # Rows synced before clinics existed belong to the clinic of the first configured source
+        self.default_id = next(iter(self.services))
+        self.max_concurrent_queries = max_concurrent_queries or int(os.environ.get('CLINIC_MAX_CONCURRENT_QUERIES', '8'))
+        self.query_slots = {clinic_id: asyncio.Semaphore(self.max_concurrent_queries) for clinic_id in self.services}
+        self.queries_in_flight = {clinic_id: 0 for clinic_id in self.services}
+        self.admission = AdmissionController()
+        logger.info(f"Serving {len(self.services)} clinic(s): {', '.join(self.services)}")
+
+    def __iter__(self) -> Iterator[GoogleSheetsService]:
+        return iter(self.services.values())
+
+    @property
+    def default(self) -> GoogleSheetsService:
+        return self.services[self.default_id]
+
+    @property
+    def uses_mongo(self) -> bool:
+        return self.default.repos.uses_mongo
+
+    def source_clinics(self) -> Dict[str, str]:
+        """{source_id: clinic_id} over every configured source"""
+        return {s.source_id: service.clinic_id for service in self for s in service.sources}
+
+    def get(self, clinic_id: Optional[str] = None) -> GoogleSheetsService:
+        service = self.services.get(clinic_id or self.default_id)
+        if service is None:
+            raise HTTPException(status_code=404, detail=f"Unknown clinic: {clinic_id}")
+        return service
+
+    async def resolve(self, clinic_id: Optional[str] = Query(None, description="Clinic (default: the first configured one)"),
+                      x_clinic_id: Optional[str] = Header(None)) -> GoogleSheetsService:
+        """FastAPI dependency: the service of the clinic a request names"""
+        return self.get(clinic_id or x_clinic_id)
+
+    @asynccontextmanager
+    async def slot(self, service: GoogleSheetsService, route: str):
+        """Admission for one read of `route` against one clinic (`async with clinics.slot(service, route):`);
+        raises a 503 HTTPException when the route is overloaded"""
+        limiter = self.admission.limiter(route)
+        async with limiter.admit():
+            if limiter.cost == 'cheap':
+                yield
+                return
+            async with self.query_slots[service.clinic_id]:
+                self.queries_in_flight[service.clinic_id] += 1
+                try:
+                    yield
+                finally:
+                    self.queries_in_flight[service.clinic_id] -= 1
+
+    def describe(self) -> List[Dict]:
+        return [
+            {
+                "clinic_id": service.clinic_id,
+                "default": service.clinic_id == self.default_id,
+                "sources": [s.source_id for s in service.sources],
+                "sync_interval_minutes": service.sync_interval_minutes,
+                "last_update": service.last_update.isoformat() if service.last_update else None,
+                "generation": service.generation,
+                "queries_in_flight": self.queries_in_flight[service.clinic_id],
+            }
+            for service in self
+        ]
+
+    async def close(self):
+        for service in self:
+            await service.close()
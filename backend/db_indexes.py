@@ -0,0 +1,364 @@
+"""Declarative MongoDB index registry and query-plan regression checks.
+
+Every query shape issued by the routers is listed in QUERY_SHAPES together
+with a representative filter. `check_query_plans` runs explain() for each
+shape and reports any plan that falls back to a COLLSCAN or examines far
+more documents than it returns.
+
+    python db_indexes.py --check [--rows 20000] [--max-ratio 3]
+
+seeds a scratch database (<DB_NAME>_plan_check), builds the indexes, checks
+every shape and exits non-zero on a regression.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from outbox_service import OUTBOX_RETENTION_DAYS
+from patient_identity import make_patient_key
+from reminder_service import REMINDER_LOG_RETENTION_DAYS
+
+logger = logging.getLogger(__name__)
+
+
+class IndexSpec:
+    def __init__(self, collection: str, keys: List[Tuple[str, int]], unique: bool = False,
+                 expire_after_seconds: Optional[int] = None):
+        self.collection = collection
+        self.keys = keys
+        self.unique = unique
+        self.expire_after_seconds = expire_after_seconds
+
+    @property
+    def options(self) -> Dict:
+        options = {"name": self.name, "unique": self.unique, "background": True}
+        if self.expire_after_seconds is not None:
+            options["expireAfterSeconds"] = self.expire_after_seconds
+        return options
+
+    @property
+    def name(self) -> str:
+        return "_".join(f"{field}_{direction}" for field, direction in self.keys)
+
+
+class QueryShape:
+    """A query issued by the API; `sample` builds a representative filter"""
+
+    def __init__(self, name: str, collection: str, sample: Callable[[Dict], Dict],
+                 kind: str = 'find', sort: Optional[List[Tuple[str, int]]] = None,
+                 projection: Optional[Dict] = None):
+        self.name = name
+        self.collection = collection
+        self.sample = sample
+        self.kind = kind
+        self.sort = sort
+        self.projection = projection
+
+
+# Every appointment, override, patient, identity and rollup query is scoped to one clinic,
+# so their compound indexes lead with clinic_id: a clinic's queries only walk its own keys
+INDEXES: List[IndexSpec] = [
+    # listings, today, upcoming and stats: equality on clinic/source/quarantined, range + sort on starts_at
+    IndexSpec('appointments', [("clinic_id", 1), ("source", 1), ("quarantined", 1), ("starts_at", 1)]),
+    IndexSpec('appointments', [("clinic_id", 1), ("source", 1), ("quarantined", 1), ("status", 1), ("starts_at", 1)]),
+    # sync reconciliation by external id, per sheet source
+    IndexSpec('appointments', [("clinic_id", 1), ("source", 1), ("source_id", 1), ("external_id", 1)]),
+    # covering index for deriving patients from appointments
+    IndexSpec('appointments', [("clinic_id", 1), ("source", 1), ("num_paciente", 1), ("patient_name", 1), ("phone", 1)]),
+    # one patient's history, newest first, paged by (starts_at, _id)
+    IndexSpec('appointments', [("clinic_id", 1), ("source", 1), ("quarantined", 1), ("patient_key", 1), ("starts_at", -1), ("_id", -1)]),
+    # archive tier: listings reaching past the horizon, status counts and their cache key (latest archived_at),
+    # sync of past rows, patient derivation and history
+    IndexSpec('appointments_archive', [("clinic_id", 1), ("source", 1), ("quarantined", 1), ("starts_at", 1)]),
+    IndexSpec('appointments_archive', [("clinic_id", 1), ("source", 1), ("quarantined", 1), ("status", 1), ("starts_at", 1)]),
+    IndexSpec('appointments_archive', [("clinic_id", 1), ("source", 1), ("source_id", 1), ("external_id", 1)]),
+    IndexSpec('appointments_archive', [("clinic_id", 1), ("source", 1), ("num_paciente", 1), ("patient_name", 1), ("phone", 1)]),
+    IndexSpec('appointments_archive', [("clinic_id", 1), ("source", 1), ("quarantined", 1), ("patient_key", 1), ("starts_at", -1), ("_id", -1)]),
+    IndexSpec('appointments_archive', [("clinic_id", 1), ("source", 1), ("archived_at", -1)]),
+    IndexSpec('appointment_overrides', [("clinic_id", 1), ("appointment_id", 1)], unique=True),
+    IndexSpec('patients', [("clinic_id", 1), ("key", 1)], unique=True),
+    IndexSpec('patients', [("clinic_id", 1), ("num_paciente", 1)]),
+    IndexSpec('patients', [("clinic_id", 1), ("phone", 1)]),
+    # patient identity clusters: every key of one person
+    IndexSpec('patient_identities', [("clinic_id", 1), ("cluster_id", 1)]),
+    IndexSpec('daily_rollups', [("clinic_id", 1), ("date", 1), ("doctor", 1), ("treatment", 1), ("status", 1)], unique=True),
+    # write-back outbox: due entries, per-row coalescing on enqueue, claims, expiry of delivered entries
+    IndexSpec('sheet_outbox', [("state", 1), ("next_attempt_at", 1)]),
+    IndexSpec('sheet_outbox', [("appointment_id", 1), ("state", 1)]),
+    IndexSpec('sheet_outbox', [("claimed_by", 1)]),
+    IndexSpec('sheet_outbox', [("sent_at", 1)], expire_after_seconds=OUTBOX_RETENTION_DAYS * 86400),
+    # reminder delivery log: claims expire some days after the appointment
+    IndexSpec('reminder_log', [("starts_at", 1)], expire_after_seconds=REMINDER_LOG_RETENTION_DAYS * 86400),
+]
+
+# Superseded by the registry above; dropped when present. The unique ones from before
+# clinic partitioning would reject the same key or bucket in a second clinic.
+OBSOLETE_INDEXES: List[Tuple[str, str]] = [
+    ('appointments', 'date_1_time_1'),
+    ('appointments', 'status_1'),
+    ('appointments', 'source_1_external_id_1'),
+    *[(collection, name) for collection in ('appointments', 'appointments_archive') for name in (
+        'source_1_quarantined_1_starts_at_1',
+        'source_1_quarantined_1_status_1_starts_at_1',
+        'source_1_source_id_1_external_id_1',
+        'source_1_num_paciente_1_patient_name_1_phone_1',
+    )],
+    ('appointment_overrides', 'appointment_id_1'),
+    ('patients', 'key_1'),
+    ('patients', 'num_paciente_1'),
+    ('patients', 'phone_1'),
+    ('patient_identities', 'cluster_id_1'),
+    ('daily_rollups', 'date_1_doctor_1_treatment_1_status_1'),
+]
+
+CLINIC = {"clinic_id": "default"}
+APPOINTMENTS_BASE = {**CLINIC, "source": "google_sheets", "quarantined": False}
+PATIENT_PROJECTION = {"_id": 0, "patient_name": 1, "phone": 1, "num_paciente": 1}
+
+
+def _range(ctx: Dict, days: int) -> Dict:
+    start = ctx['day_start']
+    return {"$gte": start, "$lt": start + timedelta(days=days)}
+
+
+QUERY_SHAPES: List[QueryShape] = [
+    QueryShape('appointments.listing', 'appointments',
+               lambda ctx: {**APPOINTMENTS_BASE, "starts_at": _range(ctx, 31)}, sort=[("starts_at", 1)]),
+    QueryShape('appointments.listing_small_clinic', 'appointments',
+               lambda ctx: {**APPOINTMENTS_BASE, "clinic_id": "norte", "starts_at": _range(ctx, 31)}, sort=[("starts_at", 1)]),
+    QueryShape('appointments.listing_by_status', 'appointments',
+               lambda ctx: {**APPOINTMENTS_BASE, "status": "confirmed", "starts_at": _range(ctx, 31)}, sort=[("starts_at", 1)]),
+    QueryShape('appointments.today', 'appointments',
+               lambda ctx: {**APPOINTMENTS_BASE, "starts_at": _range(ctx, 1)}, sort=[("starts_at", 1)]),
+    QueryShape('appointments.upcoming', 'appointments',
+               lambda ctx: {**APPOINTMENTS_BASE, "starts_at": _range(ctx, 8)}, sort=[("starts_at", 1)]),
+    QueryShape('appointments.stats_total', 'appointments', lambda ctx: dict(APPOINTMENTS_BASE), kind='count'),
+    QueryShape('appointments.stats_by_status', 'appointments',
+               lambda ctx: {**APPOINTMENTS_BASE, "status": "pending"}, kind='count'),
+    QueryShape('appointments.stats_today', 'appointments',
+               lambda ctx: {**APPOINTMENTS_BASE, "starts_at": _range(ctx, 1)}, kind='count'),
+    QueryShape('appointments.sync_reconcile', 'appointments',
+               lambda ctx: {**CLINIC, "source": "google_sheets"}, projection={"external_id": 1, "row_hash": 1}),
+    QueryShape('appointments.sync_reconcile_by_source', 'appointments',
+               lambda ctx: {**CLINIC, "source": "google_sheets", "source_id": "default"}, projection={"external_id": 1, "row_hash": 1}),
+    QueryShape('archive.listing', 'appointments_archive',
+               lambda ctx: {**APPOINTMENTS_BASE, "starts_at": _range(ctx, 31)}, sort=[("starts_at", 1)]),
+    QueryShape('archive.sync_past_rows', 'appointments_archive',
+               lambda ctx: {**CLINIC, "source": "google_sheets", "source_id": "default", "external_id": {"$in": ctx['external_ids']}},
+               projection={"external_id": 1, "row_hash": 1}),
+    QueryShape('archive.last_archived_at', 'appointments_archive',
+               lambda ctx: {**CLINIC, "source": "google_sheets"}, sort=[("archived_at", -1)], projection={"archived_at": 1}),
+    QueryShape('archive.move_due', 'appointments',
+               lambda ctx: {**APPOINTMENTS_BASE, "starts_at": {"$lt": ctx['day_start']}}, sort=[("starts_at", 1)]),
+    QueryShape('overrides.by_ids', 'appointment_overrides',
+               lambda ctx: {**CLINIC, "appointment_id": {"$in": ctx['override_ids']}}),
+    QueryShape('patients.derive_from_appointments', 'appointments',
+               lambda ctx: {**CLINIC, "source": "google_sheets"}, projection=PATIENT_PROJECTION),
+    QueryShape('patients.by_key', 'patients', lambda ctx: {**CLINIC, "key": ctx['patient_key']}),
+    QueryShape('patients.history', 'appointments',
+               lambda ctx: {**APPOINTMENTS_BASE, "patient_key": {"$in": [ctx['patient_key'], ctx['patient_alt_key']]}},
+               sort=[("starts_at", -1), ("_id", -1)]),
+    QueryShape('patients.history_next_page', 'appointments',
+               lambda ctx: {**APPOINTMENTS_BASE, "patient_key": ctx['patient_key'],
+                            "$or": [{"starts_at": {"$lt": ctx['day_start']}},
+                                    {"starts_at": ctx['day_start'], "_id": {"$lt": ctx['max_id']}}]},
+               sort=[("starts_at", -1), ("_id", -1)]),
+    QueryShape('archive.patient_history', 'appointments_archive',
+               lambda ctx: {**APPOINTMENTS_BASE, "patient_key": ctx['patient_key']}, sort=[("starts_at", -1), ("_id", -1)]),
+    QueryShape('rollups.range', 'daily_rollups',
+               lambda ctx: {**CLINIC, "date": {"$gte": ctx['day'], "$lte": ctx['day_plus_30']}}),
+    QueryShape('outbox.due', 'sheet_outbox',
+               lambda ctx: {"state": "pending", "next_attempt_at": {"$lte": ctx['now']}},
+               sort=[("next_attempt_at", 1)], projection={"_id": 1}),
+    QueryShape('outbox.pending_for_row', 'sheet_outbox',
+               lambda ctx: {"appointment_id": ctx['override_ids'][0], "state": "pending"}),
+]
+
+
+async def drop_obsolete_indexes(db) -> List[str]:
+    dropped = []
+    for collection, name in OBSOLETE_INDEXES:
+        try:
+            existing = await db[collection].index_information()
+            if name in existing:
+                await db[collection].drop_index(name)
+                dropped.append(f"{collection}.{name}")
+                logger.info(f"Dropped obsolete index {collection}.{name}")
+        except Exception as e:
+            logger.warning(f"Could not drop index {collection}.{name}: {e}")
+    return dropped
+
+
+async def ensure_indexes(db, on_progress: Optional[Callable[..., None]] = None) -> List[str]:
+    """Create every registered index (background builds) and drop superseded ones.
+
+    `on_progress(done=..., total=...)` is called after each index, for startup reporting.
+    """
+    created = []
+    for i, spec in enumerate(INDEXES, 1):
+        try:
+            name = await db[spec.collection].create_index(spec.keys, **spec.options)
+            created.append(f"{spec.collection}.{name}")
+        except Exception as e:
+            logger.error(f"Failed to create index {spec.collection}.{spec.name}: {e}")
+        if on_progress is not None:
+            on_progress(done=i, total=len(INDEXES))
+    await drop_obsolete_indexes(db)
+    logger.info(f"MongoDB indexes ensured: {len(created)}/{len(INDEXES)}")
+    return created
+
+
+def _plan_stages(plan: Dict) -> List[str]:
+    stages = []
+    stack = [plan.get('queryPlan', plan)]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        if 'stage' in node:
+            stages.append(node['stage'])
+        if 'inputStage' in node:
+            stack.append(node['inputStage'])
+        stack.extend(node.get('inputStages', []))
+    return stages
+
+
+async def explain_shape(db, shape: QueryShape, ctx: Dict) -> Dict:
+    query = shape.sample(ctx)
+    if shape.kind == 'count':
+        result = await db.command({"explain": {"count": shape.collection, "query": query}, "verbosity": "executionStats"})
+    else:
+        cursor = db[shape.collection].find(query, shape.projection)
+        if shape.sort:
+            cursor = cursor.sort(shape.sort)
+        result = await cursor.explain()
+    stats = result.get('executionStats', {})
+    stages = _plan_stages(result.get('queryPlanner', {}).get('winningPlan', {}))
+    n_returned = stats.get('nReturned', 0)
+    if shape.kind == 'count':
+        n_returned = await db[shape.collection].count_documents(query)
+    return {
+        "shape": shape.name,
+        "stages": stages,
+        "docs_examined": stats.get('totalDocsExamined', 0),
+        "keys_examined": stats.get('totalKeysExamined', 0),
+        "returned": n_returned,
+    }
+
+
+async def check_query_plans(db, ctx: Dict, max_ratio: float = 3.0, slack: int = 50) -> Tuple[List[Dict], List[str]]:
+    """Explain every registered shape; returns (reports, failures)"""
+    reports, failures = [], []
+    for shape in QUERY_SHAPES:
+        report = await explain_shape(db, shape, ctx)
+        reports.append(report)
+        if 'COLLSCAN' in report['stages']:
+            failures.append(f"{shape.name}: COLLSCAN ({' <- '.join(report['stages'])})")
+        elif report['docs_examined'] > max(report['returned'] * max_ratio, slack):
+            failures.append(f"{shape.name}: examined {report['docs_examined']} docs to return {report['returned']}")
+    return reports, failures
+
+
+async def seed(db, rows: int) -> Dict:
+    """Populate a scratch database with synthetic appointments, overrides, patients and rollups"""
+    rng = random.Random(42)
+    statuses = ['pending', 'confirmed', 'completed', 'cancelled', 'rescheduled']
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    docs = []
+    for i in range(rows):
+        starts_at = today + timedelta(days=rng.randint(-730, 60), minutes=rng.randint(9 * 60, 19 * 60))
+        docs.append({
+            "external_id": f"seed_{i}",
+            # A large clinic and a small one, so plans are checked against the other clinic's rows too
+            "clinic_id": "norte" if i % 5 == 0 else "default",
+            "source": "google_sheets",
+            "quarantined": i % 500 == 0,
+            "status": rng.choice(statuses),
+            "starts_at": starts_at,
+            "date": starts_at.strftime('%Y-%m-%d'),
+            "time": starts_at.strftime('%H:%M'),
+            "patient_name": f"Paciente {i % (rows // 3 + 1)}",
+            "num_paciente": str(i % (rows // 3 + 1)) if i % 4 else "",
+            "phone": f"6{i % 100000000:08d}",
+            "row_hash": str(i),
+        })
+        docs[-1]["patient_key"] = make_patient_key(docs[-1]["num_paciente"], docs[-1]["patient_name"], docs[-1]["phone"])
+    await db.appointments.insert_many(docs)
+    horizon = today - timedelta(days=180)
+    await db.appointments_archive.insert_many([dict(d) for d in docs if d['starts_at'] < horizon])
+    ids = [str(d['_id']) for d in docs[:200]]
+    await db.appointment_overrides.insert_many([
+        {"clinic_id": d["clinic_id"], "appointment_id": str(d["_id"]), "status": "confirmed"} for d in docs[:200:2]
+    ])
+    await db.patients.insert_many([
+        {"clinic_id": clinic, "key": f"num:{i}", "num_paciente": str(i), "phone": ""}
+        for clinic in ("default", "norte") for i in range(rows // 10)
+    ])
+    rollups = {}
+    for d in docs:
+        k = (d['clinic_id'], d['date'], '', '', d['status'])
+        rollups[k] = rollups.get(k, 0) + 1
+    await db.daily_rollups.insert_many([
+        {"clinic_id": k[0], "date": k[1], "doctor": k[2], "treatment": k[3], "status": k[4], "count": c} for k, c in rollups.items()
+    ])
+    now = datetime.utcnow()
+    await db.sheet_outbox.insert_many([
+        {"appointment_id": a, "state": "sent" if i % 10 else "pending", "changes": {"status": "confirmed"},
+         "enqueued_at": now, "next_attempt_at": now + timedelta(seconds=i - 100), "sent_at": now}
+        for i, a in enumerate(ids)
+    ])
+    return {
+        "now": now,
+        "day_start": today,
+        "day": today.strftime('%Y-%m-%d'),
+        "day_plus_30": (today + timedelta(days=30)).strftime('%Y-%m-%d'),
+        "override_ids": ids[:50],
+        "patient_key": "num:7",
+        "patient_alt_key": docs[4]["patient_key"],
+        "max_id": docs[-1]["_id"],
+        "external_ids": [d['external_id'] for d in docs[:50]],
+    }
+
+
+async def main(argv: List[str]) -> int:
+    from dotenv import load_dotenv
+    from mongo_client import MongoClientProvider
+
+    parser = argparse.ArgumentParser(description="MongoDB index management")
+    parser.add_argument('--check', action='store_true', help="seed a scratch database and verify query plans")
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--max-ratio', type=float, default=3.0)
+    args = parser.parse_args(argv)
+
+    load_dotenv(Path(__file__).parent / '.env')
+    mongo = MongoClientProvider()
+    client = mongo.client
+    try:
+        if not args.check:
+            await ensure_indexes(client[os.environ['DB_NAME']])
+            return 0
+        scratch_name = f"{os.environ['DB_NAME']}_plan_check"
+        await client.drop_database(scratch_name)
+        db = client[scratch_name]
+        ctx = await seed(db, args.rows)
+        await ensure_indexes(db)
+        reports, failures = await check_query_plans(db, ctx, max_ratio=args.max_ratio)
+        for r in reports:
+            print(f"{r['shape']:<40} {'/'.join(r['stages']):<40} keys={r['keys_examined']:<7} docs={r['docs_examined']:<7} returned={r['returned']}")
+        for f in failures:
+            print(f"FAIL {f}")
+        await client.drop_database(scratch_name)
+        return 1 if failures else 0
+    finally:
+        mongo.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(sys.argv[1:])))
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import statistics
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, Optional
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from lifecycle import BackgroundTasks
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """Event-loop lag, measured as how late a periodic short sleep wakes up"""
+
+    def __init__(self, interval_seconds: float = 0.25, window: int = 20):
+        self.interval_seconds = interval_seconds
+        self.samples = deque(maxlen=window)
+        self.histogram = REGISTRY.histogram('loop.lag_ms')
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval_seconds)
+            lag = max(0.0, (loop.time() - started - self.interval_seconds) * 1000)
+            self.samples.append(lag)
+            self.histogram.observe(lag)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self) -> Dict:
+        """Median and max over the last `window` samples (about five seconds)"""
+        if not self.samples:
+            return {"median_ms": 0.0, "max_ms": 0.0, "samples": 0}
+        return {
+            "median_ms": round(statistics.median(self.samples), 3),
+            "max_ms": round(max(self.samples), 3),
+            "samples": len(self.samples),
+        }
+
+
+class HealthChecker:
+    """Liveness and readiness from real measurements.
+
+    Ready means: startup work marked as required finished without failing and every
+    clinic's in-memory tiers are warm, MongoDB answers a ping within `mongo_timeout_ms` (MongoDB backends),
+    each clinic's sync loop completed an attempt within its max sync age (three of its
+    sync intervals unless HEALTH_MAX_SYNC_AGE_SECONDS is set), and sustained loop lag
+    is under `max_loop_lag_ms`. A sheet that cannot be fetched only degrades the
+    report: stored data is still served, and failing every instance over a sheet
+    outage would take the whole service down.
+    """
+
+    def __init__(self, mongo, clinics, lag_monitor: LoopLagMonitor, tasks: Optional[BackgroundTasks] = None):
+        self.mongo = mongo
+        self.tasks = tasks
+        self.clinics = clinics
+        self.lag_monitor = lag_monitor
+        self.mongo_timeout_ms = float(os.environ.get('HEALTH_MONGO_TIMEOUT_MS', '1000'))
+        self.max_loop_lag_ms = float(os.environ.get('HEALTH_MAX_LOOP_LAG_MS', '500'))
+        configured = os.environ.get('HEALTH_MAX_SYNC_AGE_SECONDS')
+        self.max_sync_age_seconds = {
+            service.clinic_id: float(configured) if configured else service.sync_interval_minutes * 60 * 3
+            for service in clinics
+        }
+        self.ping_latency = REGISTRY.histogram('health.mongo_ping_ms')
+        self.started_at = time.monotonic()
+
+    def liveness(self) -> Dict:
+        return {
+            "status": "alive",
+            "uptime_seconds": round(time.monotonic() - self.started_at, 1),
+            "loop_lag": self.lag_monitor.snapshot(),
+            "timestamp": datetime.utcnow().isoformat(),
+        }
+
+    async def check_mongo(self) -> Dict:
+        if not self.clinics.uses_mongo:
+            return {"ok": True, "skipped": "memory repositories"}
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.mongo.client.admin.command('ping'), timeout=self.mongo_timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            return {"ok": False, "error": f"ping timed out after {self.mongo_timeout_ms:g}ms"}
+        except Exception as e:
+            return {"ok": False, "error": f"{e.__class__.__name__}: {str(e)}"}
+        latency = (time.perf_counter() - started) * 1000
+        self.ping_latency.observe(latency)
+        return {"ok": True, "latency_ms": round(latency, 3)}
+
+    def check_clinic_sync(self, service) -> Dict:
+        now = datetime.utcnow()
+        age = lambda t: round((now - t).total_seconds(), 1) if t else None
+        attempt_age = age(service.last_sync_attempt)
+        max_age = self.max_sync_age_seconds[service.clinic_id]
+        return {
+            "ok": attempt_age is not None and attempt_age <= max_age,
+            "last_success_age_seconds": age(service.last_update),
+            "last_attempt_age_seconds": attempt_age,
+            "max_age_seconds": max_age,
+            "fresh": service.last_update is not None and age(service.last_update) <= max_age,
+        }
+
+    def check_sync(self) -> Dict:
+        clinics = {service.clinic_id: self.check_clinic_sync(service) for service in self.clinics}
+        return {
+            "ok": all(c["ok"] for c in clinics.values()),
+            "fresh": all(c["fresh"] for c in clinics.values()),
+            "clinics": clinics,
+        }
+
+    def check_warm(self) -> Dict:
+        tiers = {service.clinic_id: service.repos.warm_state() for service in self.clinics}
+        # Without lifespan-tracked startup (e.g. tests), the first sync attempts stand in for it
+        if self.tasks is not None:
+            started, failed = self.tasks.ready, self.tasks.failed
+        else:
+            started, failed = all(service.last_sync_attempt is not None for service in self.clinics), {}
+        return {
+            "ok": started and all(all(t.values()) for t in tiers.values()),
+            "startup_done": started,
+            "startup_failed": failed,
+            "first_sync_done": all(service.last_update is not None for service in self.clinics),
+            "tiers": tiers,
+        }
+
+    def check_loop(self) -> Dict:
+        lag = self.lag_monitor.snapshot()
+        return {"ok": lag["median_ms"] <= self.max_loop_lag_ms, "max_lag_ms": self.max_loop_lag_ms, **lag}
+
+    async def readiness(self) -> Dict:
+        checks = {
+            "warm": self.check_warm(),
+            "mongo": await self.check_mongo(),
+            "sync": self.check_sync(),
+            "event_loop": self.check_loop(),
+        }
+        ready = all(c["ok"] for c in checks.values())
+        return {
+            "status": "ready" if ready else "not_ready",
+            "ready": ready,
+            "degraded": ready and not checks["sync"]["fresh"],
+            "checks": checks,
+            "timestamp": datetime.utcnow().isoformat(),
+        }
+
+
+def create_health_router(mongo, clinics, tasks: Optional[BackgroundTasks] = None):
+    router = APIRouter(prefix="/api/health", tags=["health"])
+    lag_monitor = LoopLagMonitor()
+    checker = HealthChecker(mongo, clinics, lag_monitor, tasks)
+
+    @router.get("")
+    async def health_check():
+        """Summary for dashboards; always 200 (use /ready for routing decisions)"""
+        report = await checker.readiness()
+        checks = report["checks"]
+        return {
+            "status": "healthy" if report["ready"] and not report["degraded"] else ("degraded" if report["ready"] else "unhealthy"),
+            "database": "connected" if checks["mongo"]["ok"] else "unreachable",
+            "google_sheets_sync": "active" if checks["sync"]["fresh"] else ("pending" if not checks["warm"]["first_sync_done"] else "stale"),
+            "checks": checks,
+            "timestamp": report["timestamp"],
+        }
+
+    @router.get("/live")
+    async def liveness():
+        """Answers as long as the event loop does"""
+        return checker.liveness()
+
+    @router.get("/startup")
+    async def startup_progress():
+        """State and progress of the startup and background tasks"""
+        return {"ready": tasks.ready if tasks is not None else None, "tasks": tasks.describe() if tasks is not None else {}}
+
+    @router.get("/ready")
+    async def readiness():
+        """503 until warm, and whenever MongoDB, the sync loop or the event loop is unhealthy"""
+        report = await checker.readiness()
+        return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+    # server.py starts and stops the lag monitor in the app lifespan
+    router.lag_monitor = lag_monitor
+    router.checker = checker
+    return router
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Awaitable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TrackedTask:
+    def __init__(self, name: str, required: bool):
+        self.name = name
+        self.required = required
+        self.state = 'running'
+        self.started_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+        self.error: Optional[str] = None
+        self.progress: Dict = {}
+        self.task: Optional[asyncio.Task] = None
+        self._started = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+
+    def describe(self) -> Dict:
+        return {
+            "state": self.state,
+            "required_for_ready": self.required,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "duration_ms": self.duration_ms,
+            "error": self.error,
+            "progress": self.progress,
+        }
+
+
+class BackgroundTasks:
+    """Named tasks started from the app lifespan.
+
+    Startup work (index builds, migration, first sync) and long-running loops
+    are started here instead of being awaited, so the app serves right away.
+    Each task reports its state and progress; tasks marked `required` must
+    finish before the instance reports ready. `shutdown` cancels whatever is
+    still running and waits for it to unwind.
+    """
+
+    def __init__(self):
+        self.tasks: Dict[str, TrackedTask] = {}
+
+    def start(self, name: str, coro: Awaitable, required: bool = False) -> TrackedTask:
+        tracked = TrackedTask(name, required)
+        self.tasks[name] = tracked
+        tracked.task = asyncio.create_task(self._run(tracked, coro), name=name)
+        return tracked
+
+    async def _run(self, tracked: TrackedTask, coro: Awaitable):
+        try:
+            result = await coro
+            tracked.state = 'done'
+            if isinstance(result, dict):
+                tracked.progress.update(result)
+        except asyncio.CancelledError:
+            tracked.state = 'cancelled'
+            raise
+        except Exception as e:
+            tracked.state = 'failed'
+            tracked.error = f"{e.__class__.__name__}: {str(e)}"
+            logger.error(f"Background task {tracked.name} failed: {tracked.error}")
+        finally:
+            tracked.finished_at = datetime.utcnow()
+            tracked.duration_ms = round((time.perf_counter() - tracked._started) * 1000, 3)
+
+    def progress(self, name: str, **fields):
+        if name in self.tasks:
+            self.tasks[name].progress.update(fields)
+
+    @property
+    def ready(self) -> bool:
+        """Every required task finished successfully; a failed one keeps the instance not ready"""
+        return all(t.state == 'done' for t in self.tasks.values() if t.required)
+
+    @property
+    def failed(self) -> Dict[str, str]:
+        """{name: error} of required tasks that failed"""
+        return {name: t.error for name, t in self.tasks.items() if t.required and t.state == 'failed'}
+
+    def describe(self) -> Dict:
+        return {name: t.describe() for name, t in self.tasks.items()}
+
+    async def shutdown(self, timeout_seconds: float = 10):
+        running = [t.task for t in self.tasks.values() if t.task is not None and not t.task.done()]
+        for task in running:
+            task.cancel()
+        if running:
+            done, pending = await asyncio.wait(running, timeout=timeout_seconds)
+            if pending:
+                logger.warning(f"{len(pending)} background task(s) did not stop within {timeout_seconds}s")
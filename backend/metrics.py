@@ -0,0 +1,149 @@
+import bisect
+import threading
+import time
+from typing import Dict, Optional
+
+# Histogram bucket upper bounds in milliseconds
+DEFAULT_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, float('inf'))
+# Response size bucket upper bounds in bytes
+SIZE_BOUNDS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, float('inf'))
+
+
+class Histogram:
+    """Fixed-bucket latency histogram; percentiles are interpolated within buckets.
+
+    Observations may come from pymongo monitoring threads as well as the event
+    loop, so updates are guarded by a lock.
+    """
+
+    def __init__(self, bounds=DEFAULT_BOUNDS_MS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q: float) -> float:
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            for i, c in enumerate(self.counts):
+                if c and seen + c >= rank:
+                    lower = self.bounds[i - 1] if i else 0.0
+                    upper = min(self.bounds[i], self.max)
+                    return lower + (upper - lower) * max(rank - seen, 0) / c
+                seen += c
+            return self.max
+
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50": round(self.percentile(0.50), 3),
+            "p95": round(self.percentile(0.95), 3),
+            "p99": round(self.percentile(0.99), 3),
+            "max": round(self.max, 3),
+        }
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(Counter):
+    def dec(self, amount: int = 1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class MetricsRegistry:
+    """Process-wide named metrics, exposed as a JSON snapshot"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name: str, factory):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, factory())
+        return metric
+
+    def histogram(self, name: str, bounds=DEFAULT_BOUNDS_MS) -> Histogram:
+        return self._get(name, lambda: Histogram(bounds))
+
+    def counter(self, name: str) -> Counter:
+        return self._get(name, Counter)
+
+    def gauge(self, name: str) -> Gauge:
+        return self._get(name, Gauge)
+
+    def snapshot(self, prefix: Optional[str] = None) -> Dict:
+        out = {}
+        for name, metric in sorted(self._metrics.items()):
+            if prefix and not name.startswith(prefix):
+                continue
+            out[name] = metric.snapshot() if isinstance(metric, Histogram) else metric.value
+        return out
+
+
+REGISTRY = MetricsRegistry()
+
+
+class TimingMiddleware:
+    """ASGI middleware recording per-route latency, status classes, response sizes and in-flight requests.
+
+    Routes are keyed by their path template (e.g. /api/patients/{patient_id}) so
+    path parameters do not explode the number of series.
+    """
+
+    def __init__(self, app, registry: MetricsRegistry = REGISTRY):
+        self.app = app
+        self.registry = registry
+        self.in_flight = registry.gauge('http.in_flight')
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        response = {"status": 500, "size": 0}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["size"] += len(message.get("body", b""))
+            await send(message)
+
+        self.in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.in_flight.dec()
+            route = scope.get("route")
+            key = f"http.{scope['method']} {getattr(route, 'path', 'unmatched')}"
+            self.registry.histogram(f"{key}.latency_ms").observe((time.perf_counter() - started) * 1000)
+            self.registry.histogram(f"{key}.response_bytes", SIZE_BOUNDS).observe(response["size"])
+            self.registry.counter(f"{key}.status_{response['status'] // 100}xx").inc()
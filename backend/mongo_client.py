@@ -0,0 +1,225 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class MongoSettings:
+    """Connection pool configuration, read from the environment"""
+
+    def __init__(self):
+        self.url = os.environ['MONGO_URL']
+        self.db_name = os.environ['DB_NAME']
+        self.max_pool_size = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+        self.min_pool_size = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+        self.max_idle_time_ms = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000'))
+        self.wait_queue_timeout_ms = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '5000'))
+        self.server_selection_timeout_ms = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+        self.connect_timeout_ms = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+        self.socket_timeout_ms = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '30000'))
+
+    def client_kwargs(self) -> Dict:
+        return {
+            "maxPoolSize": self.max_pool_size,
+            "minPoolSize": self.min_pool_size,
+            "maxIdleTimeMS": self.max_idle_time_ms,
+            "waitQueueTimeoutMS": self.wait_queue_timeout_ms,
+            "serverSelectionTimeoutMS": self.server_selection_timeout_ms,
+            "connectTimeoutMS": self.connect_timeout_ms,
+            "socketTimeoutMS": self.socket_timeout_ms,
+        }
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """Checkout wait time and connection counts.
+
+    Motor runs pymongo operations on executor threads and a checkout starts and
+    completes on the same thread, so the start time is kept thread-locally.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self.checkout_wait = REGISTRY.histogram('mongo.pool.checkout_wait_ms')
+        self.checked_out = REGISTRY.gauge('mongo.pool.checked_out')
+        self.open_connections = REGISTRY.gauge('mongo.pool.connections')
+        self.checkout_failures = REGISTRY.counter('mongo.pool.checkout_failures')
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, 'started', None)
+        if started is not None:
+            self.checkout_wait.observe((time.perf_counter() - started) * 1000)
+            self._local.started = None
+        self.checked_out.inc()
+
+    def connection_check_out_failed(self, event):
+        self._local.started = None
+        self.checkout_failures.inc()
+        logger.warning(f"MongoDB connection checkout failed: {event.reason}")
+
+    def connection_checked_in(self, event):
+        self.checked_out.dec()
+
+    def connection_created(self, event):
+        self.open_connections.inc()
+
+    def connection_closed(self, event):
+        self.open_connections.dec()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        logger.warning(f"MongoDB pool cleared for {event.address}")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """Server-reported latency per command name"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        REGISTRY.histogram(f'mongo.command.{event.command_name}_ms').observe(event.duration_micros / 1000)
+
+    def failed(self, event):
+        REGISTRY.counter(f'mongo.command.{event.command_name}.failures').inc()
+
+
+# Commands whose filter lives under a different key
+FILTER_KEYS = {'find': 'filter', 'count': 'query', 'distinct': 'query', 'findAndModify': 'query', 'findandmodify': 'query'}
+SLOW_QUERY_IGNORED = {'hello', 'isMaster', 'ismaster', 'ping', 'getMore', 'endSessions', 'killCursors', 'buildInfo'}
+
+
+def query_shape(value):
+    """Replace literal values with their type name, keeping field names and operators"""
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [query_shape(v) for v in value[:3]] if value and isinstance(value[0], dict) else f"<{type(value).__name__}[{len(value)}]>"
+    return f"<{type(value).__name__}>"
+
+
+def command_shape(command_name: str, command: Dict) -> Dict:
+    if command_name in FILTER_KEYS:
+        shape = {"filter": query_shape(command.get(FILTER_KEYS[command_name]) or {})}
+        if command.get('sort'):
+            shape["sort"] = dict(command['sort'])
+        return shape
+    if command_name == 'aggregate':
+        return {"pipeline": [query_shape(stage) if '$match' in stage else list(stage)[0] for stage in command.get('pipeline', [])]}
+    if command_name in ('update', 'delete'):
+        ops = command.get('updates' if command_name == 'update' else 'deletes') or []
+        return {"filter": query_shape(ops[0].get('q', {})) if ops else {}, "ops": len(ops)}
+    if command_name == 'insert':
+        return {"documents": len(command.get('documents') or [])}
+    return {}
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """Keeps the most recent commands slower than the threshold, with their filter shape"""
+
+    def __init__(self, threshold_ms: Optional[float] = None, capacity: int = 200):
+        self.threshold_ms = threshold_ms if threshold_ms is not None else float(os.environ.get('SLOW_QUERY_MS', '100'))
+        self.entries = deque(maxlen=capacity)
+        self._pending: Dict = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name in SLOW_QUERY_IGNORED:
+            return
+        collection = event.command.get(event.command_name)
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (
+                collection if isinstance(collection, str) else None,
+                command_shape(event.command_name, event.command),
+            )
+
+    def _finish(self, event, failed: bool):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+        duration_ms = event.duration_micros / 1000
+        if pending is None or duration_ms < self.threshold_ms:
+            return
+        collection, shape = pending
+        entry = {
+            "at": datetime.utcnow().isoformat(),
+            "command": event.command_name,
+            "collection": collection,
+            "shape": shape,
+            "duration_ms": round(duration_ms, 2),
+            "failed": failed,
+        }
+        self.entries.append(entry)
+        logger.warning(f"Slow MongoDB {event.command_name} on {collection}: {duration_ms:.1f}ms {shape}")
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+    def recent(self, limit: int = 50) -> List[Dict]:
+        return list(self.entries)[-limit:][::-1]
+
+
+class MongoClientProvider:
+    """Owns the single AsyncIOMotorClient shared by every router and service.
+
+    The client is created on `connect()` (called from the app lifespan) or on
+    first use, never at import time.
+    """
+
+    def __init__(self, settings: Optional[MongoSettings] = None):
+        self.settings = settings or MongoSettings()
+        self._client: Optional[AsyncIOMotorClient] = None
+        self.slow_queries = SlowQueryListener()
+        self.listeners = [PoolMetricsListener(), CommandMetricsListener(), self.slow_queries]
+
+    def connect(self) -> AsyncIOMotorClient:
+        if self._client is None:
+            s = self.settings
+            self._client = AsyncIOMotorClient(s.url, event_listeners=self.listeners, **s.client_kwargs())
+            logger.info(f"MongoDB client created (maxPoolSize={s.max_pool_size}, minPoolSize={s.min_pool_size})")
+        return self._client
+
+    @property
+    def client(self) -> AsyncIOMotorClient:
+        return self.connect()
+
+    @property
+    def db(self):
+        return self.client[self.settings.db_name]
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def pool_stats(self) -> Dict:
+        return {
+            "max_pool_size": self.settings.max_pool_size,
+            "min_pool_size": self.settings.min_pool_size,
+            **REGISTRY.snapshot('mongo.pool.'),
+        }
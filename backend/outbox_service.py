@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+import aiohttp
+from pymongo import DeleteMany, UpdateMany, UpdateOne
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_COLLECTION = 'sheet_outbox'
+# Appointment fields sent along with each change so the receiver can locate the sheet row
+OUTBOX_ROW_FIELDS = {"external_id": 1, "clinic_id": 1, "source_id": 1, "registro": 1, "num_paciente": 1,
+                     "patient_name": 1, "date": 1, "time": 1}
+OUTBOX_RETENTION_DAYS = int(os.environ.get('OUTBOX_RETENTION_DAYS', '7'))
+BATCH_BOUNDS = (1, 5, 10, 25, 50, 100, 250, 500, float('inf'))
+
+
+class OutboxSink:
+    """Destination for coalesced sheet changes; `send` raises to have the batch retried"""
+
+    async def send(self, changes: List[Dict]):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class HttpSink(OutboxSink):
+    """POSTs {"changes": [...]} as JSON, e.g. to an Apps Script web app that edits the sheet"""
+
+    def __init__(self, url: str, timeout_seconds: float = 15):
+        self.url = url
+        self.timeout = aiohttp.ClientTimeout(total=timeout_seconds)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def send(self, changes: List[Dict]):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        async with self._session.post(self.url, json={"changes": changes}) as response:
+            if response.status >= 300:
+                raise RuntimeError(f"Write-back sink returned HTTP {response.status}")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class SheetOutbox:
+    """Durable queue of app-side changes waiting to be written back to the source sheet.
+
+    Edits to a row that is still waiting are merged into its pending entry, so a row
+    changed five times before the next flush is sent once with its latest values.
+    """
+
+    def __init__(self, mongo):
+        self.mongo = mongo
+
+    @property
+    def collection(self):
+        return self.mongo.db.get_collection(OUTBOX_COLLECTION)
+
+    async def enqueue(self, changes: Dict[str, Dict], rows: Dict[str, Dict]) -> int:
+        """Queue {appointment_id: changed fields}; `rows` holds each appointment's OUTBOX_ROW_FIELDS"""
+        now = datetime.utcnow()
+        ops = []
+        for appointment_id, fields in changes.items():
+            row = {k: v for k, v in (rows.get(appointment_id) or {}).items() if k != '_id'}
+            ops.append(UpdateOne(
+                {"appointment_id": appointment_id, "state": "pending"},
+                {
+                    "$set": {**{f"changes.{k}": v for k, v in fields.items()}, "row": row, "updated_at": now},
+                    "$setOnInsert": {"enqueued_at": now, "next_attempt_at": now, "attempts": 0},
+                },
+                upsert=True
+            ))
+        if ops:
+            await self.collection.bulk_write(ops, ordered=False)
+            REGISTRY.counter('outbox.enqueued').inc(len(ops))
+        return len(ops)
+
+    async def counts(self) -> Dict[str, int]:
+        pipeline = [{"$group": {"_id": "$state", "count": {"$sum": 1}}}]
+        rows = await self.collection.aggregate(pipeline).to_list(length=None)
+        return {r["_id"]: r["count"] for r in rows}
+
+    async def oldest_pending_age_seconds(self) -> Optional[float]:
+        doc = await self.collection.find_one({"state": "pending"}, {"enqueued_at": 1}, sort=[("enqueued_at", 1)])
+        if not doc:
+            return None
+        return round((datetime.utcnow() - doc["enqueued_at"]).total_seconds(), 3)
+
+
+def coalesce(entries: List[Dict]) -> List[Dict]:
+    """One change per appointment, later entries overriding earlier ones field by field"""
+    merged: Dict[str, Dict] = {}
+    for entry in sorted(entries, key=lambda e: e["enqueued_at"]):
+        current = merged.setdefault(entry["appointment_id"], {"appointment_id": entry["appointment_id"], "row": {}, "changes": {}})
+        current["row"].update(entry.get("row") or {})
+        current["changes"].update(entry.get("changes") or {})
+        current["enqueued_at"] = entry["enqueued_at"].isoformat()
+    return list(merged.values())
+
+
+class OutboxFlusher:
+    """Background task delivering outbox entries to a sink in batches.
+
+    Entries are claimed with a per-flush token (so several workers can share the
+    outbox), coalesced per row and sent together. A failed batch is retried with
+    exponential backoff and jitter; entries that exhaust their attempts are parked
+    in state "failed". Claims left behind by a crashed worker expire after
+    `lease_seconds`.
+    """
+
+    def __init__(self, outbox: SheetOutbox, sink: OutboxSink,
+                 batch_size: Optional[int] = None, interval_seconds: Optional[float] = None,
+                 max_attempts: Optional[int] = None, base_backoff_seconds: float = 2.0,
+                 max_backoff_seconds: float = 300.0, lease_seconds: float = 300.0):
+        self.outbox = outbox
+        self.sink = sink
+        self.batch_size = batch_size or int(os.environ.get('OUTBOX_BATCH_SIZE', '100'))
+        self.interval_seconds = interval_seconds or float(os.environ.get('OUTBOX_FLUSH_INTERVAL_SECONDS', '2'))
+        self.max_attempts = max_attempts or int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.lease_seconds = lease_seconds
+        self.latency = REGISTRY.histogram('outbox.delivery_latency_ms')
+        self.send_time = REGISTRY.histogram('outbox.send_ms')
+        self.batch_sizes = REGISTRY.histogram('outbox.batch_size', BATCH_BOUNDS)
+        self.last_error: Optional[str] = None
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.base_backoff_seconds * 2 ** max(attempts - 1, 0), self.max_backoff_seconds)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def claim(self, now: datetime) -> List[Dict]:
+        collection = self.outbox.collection
+        await collection.update_many(
+            {"state": "sending", "claimed_at": {"$lt": now - timedelta(seconds=self.lease_seconds)}},
+            {"$set": {"state": "pending"}}
+        )
+        due = await collection.find(
+            {"state": "pending", "next_attempt_at": {"$lte": now}}, {"_id": 1}
+        ).sort([("next_attempt_at", 1)]).limit(self.batch_size).to_list(length=self.batch_size)
+        if not due:
+            return []
+        token = uuid4().hex
+        await collection.update_many(
+            {"_id": {"$in": [d["_id"] for d in due]}, "state": "pending"},
+            {"$set": {"state": "sending", "claimed_by": token, "claimed_at": now}}
+        )
+        return await collection.find({"claimed_by": token, "state": "sending"}).to_list(length=None)
+
+    async def flush_once(self) -> int:
+        """Deliver one batch; returns how many outbox entries were sent"""
+        now = datetime.utcnow()
+        entries = await self.claim(now)
+        if not entries:
+            return 0
+        batch = coalesce(entries)
+        started = time.perf_counter()
+        try:
+            await self.sink.send(batch)
+        except Exception as e:
+            self.last_error = str(e)
+            await self.reschedule(entries, str(e))
+            return 0
+        self.send_time.observe((time.perf_counter() - started) * 1000)
+        self.batch_sizes.observe(len(batch))
+        sent_at = datetime.utcnow()
+        await self.outbox.collection.update_many(
+            {"_id": {"$in": [e["_id"] for e in entries]}},
+            {"$set": {"state": "sent", "sent_at": sent_at}, "$unset": {"claimed_by": "", "claimed_at": ""}}
+        )
+        for e in entries:
+            self.latency.observe((sent_at - e["enqueued_at"]).total_seconds() * 1000)
+        REGISTRY.counter('outbox.sent').inc(len(entries))
+        self.last_error = None
+        return len(entries)
+
+    async def reschedule(self, entries: List[Dict], error: str):
+        """Put a failed batch back with backoff, or park entries that ran out of attempts.
+
+        A row edited again while its batch was in flight already has a newer pending
+        entry; the failed changes are folded into it underneath the newer values,
+        so a retry can never overwrite a later edit with an older one.
+        """
+        now = datetime.utcnow()
+        by_row: Dict[str, List[Dict]] = {}
+        for e in entries:
+            by_row.setdefault(e["appointment_id"], []).append(e)
+        ops = []
+        parked = 0
+        for appointment_id, group in by_row.items():
+            attempts = max(e.get("attempts", 0) for e in group) + 1
+            ids = [e["_id"] for e in group]
+            if attempts >= self.max_attempts:
+                parked += len(group)
+                ops.append(UpdateMany(
+                    {"_id": {"$in": ids}},
+                    {"$set": {"state": "failed", "attempts": attempts, "last_error": error, "updated_at": now},
+                     "$unset": {"claimed_by": "", "claimed_at": ""}}
+                ))
+                continue
+            merged = coalesce(group)[0]
+            enqueued_at = min(e["enqueued_at"] for e in group)
+            ops.append(DeleteMany({"_id": {"$in": ids}}))
+            ops.append(UpdateOne(
+                {"appointment_id": appointment_id, "state": "pending"},
+                [{"$set": {
+                    "appointment_id": appointment_id,
+                    "state": "pending",
+                    # Fields already present on the pending entry are newer and win
+                    **{f"changes.{k}": {"$ifNull": [f"$changes.{k}", {"$literal": v}]} for k, v in merged["changes"].items()},
+                    "row": {"$ifNull": ["$row", {"$literal": merged["row"]}]},
+                    "enqueued_at": {"$min": ["$enqueued_at", enqueued_at]},
+                    "attempts": attempts,
+                    "last_error": {"$literal": error},
+                    "next_attempt_at": now + timedelta(seconds=self.backoff(attempts)),
+                    "updated_at": now,
+                }}],
+                upsert=True
+            ))
+        await self.outbox.collection.bulk_write(ops, ordered=True)
+        REGISTRY.counter('outbox.retried').inc(len(entries) - parked)
+        REGISTRY.counter('outbox.failed').inc(parked)
+        logger.warning(f"Write-back of {len(entries)} outbox entries failed ({error}); {parked} parked as failed")
+
+    async def run(self):
+        logger.info(f"Starting outbox flusher (batch {self.batch_size}, every {self.interval_seconds}s)")
+        try:
+            while True:
+                try:
+                    sent = await self.flush_once()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Error flushing outbox: {str(e)}")
+                    sent = 0
+                # A full batch suggests more is waiting; go again straight away
+                if sent < self.batch_size:
+                    await asyncio.sleep(self.interval_seconds)
+        finally:
+            await self.sink.close()
+
+
+def create_sink_from_env() -> Optional[OutboxSink]:
+    url = os.environ.get('SHEET_WRITEBACK_URL')
+    return HttpSink(url) if url else None
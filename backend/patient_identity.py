@@ -0,0 +1,389 @@
+import asyncio
+import logging
+import os
+import re
+import time
+import unicodedata
+from datetime import datetime
+from itertools import combinations
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from uuid import NAMESPACE_DNS, uuid5
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Connectives that say nothing about who a patient is ("María de la Fuente")
+NAME_PARTICLES = {"de", "del", "la", "las", "los", "y", "i", "da", "do", "dos", "van", "von"}
+# Blocks larger than this are too unspecific to compare within (very common surnames)
+MAX_BLOCK_SIZE = int(os.environ.get('PATIENT_IDENTITY_MAX_BLOCK', '200'))
+PHONE_SUFFIX_DIGITS = 9
+
+
+# =====================
+# Keys and normalization
+# =====================
+def normalize_phone(phone: str) -> str:
+    if not phone:
+        return ""
+    return re.sub(r"\D+", "", phone)
+
+def make_patient_key(num_paciente: str, full_name: str, phone: str) -> str:
+    if num_paciente:
+        return f"num:{num_paciente.strip()}"
+    name_key = (full_name or "").strip().lower()
+    phone_key = normalize_phone(phone)
+    return f"np:{name_key}|{phone_key}"
+
+def derived_patient_id(cluster_id: str) -> str:
+    """Id of a patient listed from appointments only, stable for as long as its cluster"""
+    return str(uuid5(NAMESPACE_DNS, cluster_id))
+
+def fold_name(name: str) -> Tuple[str, ...]:
+    """Accent-folded, lower-cased distinct name tokens without particles, in sorted order"""
+    decomposed = unicodedata.normalize('NFKD', name or "")
+    ascii_name = "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+    tokens = re.split(r"[^a-z0-9]+", ascii_name)
+    return tuple(sorted({t for t in tokens if t and t not in NAME_PARTICLES}))
+
+def phone_suffix(phone: str) -> str:
+    """National number: digits only, country prefix dropped (last nine digits); '' if too short to trust"""
+    digits = normalize_phone(phone)
+    return digits[-PHONE_SUFFIX_DIGITS:] if len(digits) >= 6 else ""
+
+def within_one_edit(a: str, b: str) -> bool:
+    """One insertion, deletion, substitution or swap of adjacent letters apart"""
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        diff = [i for i in range(len(a)) if a[i] != b[i]]
+        if len(diff) == 2 and diff[1] == diff[0] + 1 and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]]:
+            return True
+    if len(a) > len(b):
+        a, b = b, a
+    i = j = edits = 0
+    while i < len(a) and j < len(b):
+        if a[i] != b[j]:
+            edits += 1
+            if edits > 1:
+                return False
+            if len(a) == len(b):
+                i += 1
+            j += 1
+        else:
+            i += 1
+            j += 1
+    return edits + (len(b) - j) <= 1
+
+def tokens_match(a: str, b: str) -> bool:
+    """Equal, or one typo apart for words of four letters or more"""
+    return a == b or (min(len(a), len(b)) >= 4 and a.isalpha() and b.isalpha() and within_one_edit(a, b))
+
+def contained_tokens(x: Tuple[str, ...], y: Tuple[str, ...]) -> int:
+    """Length of the shorter name when each of its tokens is in the longer one (up to a typo), else 0"""
+    shorter, longer = (x, y) if len(x) <= len(y) else (y, x)
+    missing = set(shorter).difference(longer)
+    for t in missing:
+        if not any(tokens_match(t, u) for u in longer):
+            return 0
+    return len(shorter)
+
+
+class IdentityRecord:
+    """Everything seen under one patient key: name variants, phones and the patient number"""
+
+    __slots__ = ('key', 'num_paciente', 'names', 'phones', 'first_seen')
+
+    def __init__(self, key: str, num_paciente: str = "", first_seen: Optional[datetime] = None):
+        self.key = key
+        self.num_paciente = num_paciente
+        self.names: Set[Tuple[str, ...]] = set()
+        self.phones: Set[str] = set()
+        self.first_seen = first_seen or datetime.utcnow()
+
+    def blocking_keys(self) -> Iterable[str]:
+        if self.num_paciente:
+            yield f"n:{self.num_paciente}"
+        for phone in self.phones:
+            yield f"t:{phone}"
+        for tokens in self.names:
+            yield "f:" + " ".join(tokens)
+            for a, b in combinations(tokens, 2):
+                yield f"p:{a} {b}"
+
+
+def same_patient(a: IdentityRecord, b: IdentityRecord) -> bool:
+    """Conservative match: a shared phone needs compatible names, and without one the
+    names must agree on at least two tokens while the phones do not contradict them"""
+    if a.num_paciente and b.num_paciente and a.num_paciente != b.num_paciente:
+        return False
+    shared_phone = not a.phones.isdisjoint(b.phones)
+    if not shared_phone and a.phones and b.phones:
+        return False
+    # Fewest tokens accepted for a full name match: any with a shared phone, two without
+    needed = 1 if shared_phone else 2
+    return any(contained_tokens(x, y) >= needed for x in a.names for y in b.names)
+
+
+# =====================
+# Resolver
+# =====================
+class PatientIdentityIndex:
+    """Groups patient keys that belong to the same person into clusters.
+
+    make_patient_key gives a row either a "num:" or an "np:name|phone" key, so one
+    person shows up under several keys when a row lacks NumPac or spells the name or
+    phone differently. Each key is an IdentityRecord, filed under blocking keys
+    (patient number, phone suffix, full folded name, token pairs); a new or changed
+    record is scored only against the records sharing a block with it, never against
+    the whole register. Clusters that hold different patient numbers are never merged.
+
+    Cluster ids are persisted per key (repositories.identities) and updated
+    incrementally as syncs and manual edits bring in rows. A cluster is named after
+    its founding key, so a patient seen under a single key keeps the id it always had.
+    """
+
+    def __init__(self, repositories, max_block_size: int = MAX_BLOCK_SIZE):
+        self.repos = repositories
+        self.max_block_size = max_block_size
+        self.records: Dict[str, IdentityRecord] = {}
+        self.blocks: Dict[str, Set[str]] = {}
+        self.cluster_of: Dict[str, str] = {}
+        self.members: Dict[str, Set[str]] = {}
+        self.loaded = False
+        self.lock = asyncio.Lock()
+        self.comparisons = 0
+        self.last_build: Dict = {}
+        self.resolve_time = REGISTRY.histogram('patients.identity_resolve_ms')
+        # Bumped whenever clusters change; the derived patient id lookup is rebuilt on demand
+        self.version = 0
+        self._patient_ids: Dict[str, str] = {}
+        self._patient_ids_version = -1
+        # Rows observed while a rebuild resolves in its thread, replayed on the rebuilt clusters
+        self._backlog: Optional[List[Dict]] = None
+        self._building: Optional[asyncio.Future] = None
+
+    def cluster_id(self, key: str) -> str:
+        return self.cluster_of.get(key, key)
+
+    def keys_of(self, key: str) -> List[str]:
+        """Every patient key in the cluster of `key` (just `key` when it is unknown)"""
+        return sorted(self.members.get(self.cluster_id(key)) or {key})
+
+    def cluster_of_patient_id(self, patient_id: str) -> Optional[str]:
+        """The cluster listed under a derived patient id, None for any other id"""
+        if self._patient_ids_version != self.version:
+            self._patient_ids = {derived_patient_id(cluster): cluster for cluster in self.members}
+            self._patient_ids_version = self.version
+        return self._patient_ids.get(patient_id)
+
+    # ---- in-memory state ----
+    def _file(self, record: IdentityRecord):
+        for block in record.blocking_keys():
+            self.blocks.setdefault(block, set()).add(record.key)
+
+    def _absorb(self, row: Dict, now: datetime) -> Optional[str]:
+        """Record a row's identity; returns its key when something new was learned"""
+        num = (row.get('num_paciente') or "").strip()
+        full_name = row.get('patient_name') or row.get('full_name') or f"{row.get('first_name', '')} {row.get('last_name', '')}".strip()
+        phone = row.get('phone') or ""
+        key = make_patient_key(num, full_name, phone)
+        tokens = fold_name(full_name)
+        suffix = phone_suffix(phone)
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = IdentityRecord(key, num, now)
+            self.cluster_of[key] = key
+            self.members[key] = {key}
+        elif (not tokens or tokens in record.names) and (not suffix or suffix in record.phones):
+            return None
+        if tokens:
+            record.names.add(tokens)
+        if suffix:
+            record.phones.add(suffix)
+        self._file(record)
+        return key
+
+    def _rank(self, cluster: str):
+        # Keep the id of patient-numbered and then of older clusters when two merge
+        record = self.records.get(cluster)
+        return (not cluster.startswith("num:"), record.first_seen if record else datetime.max, cluster)
+
+    def _profile(self, cluster: str) -> Tuple[Set[str], Set[str], Tuple[str, ...]]:
+        """Patient numbers, phones and longest name across a cluster's keys"""
+        nums, phones, longest = set(), set(), ()
+        for key in self.members[cluster]:
+            record = self.records[key]
+            if record.num_paciente:
+                nums.add(record.num_paciente)
+            phones |= record.phones
+            for tokens in record.names:
+                if len(tokens) > len(longest):
+                    longest = tokens
+        return nums, phones, longest
+
+    def _conflict(self, a: str, b: str) -> bool:
+        """Clusters that cannot be one person: different patient numbers, phones but none
+        in common, or full names that disagree. The last two stop a record without a phone
+        ("María García") from bridging two different people it is compatible with."""
+        nums_a, phones_a, name_a = self._profile(a)
+        nums_b, phones_b, name_b = self._profile(b)
+        if nums_a and nums_b and nums_a.isdisjoint(nums_b):
+            return True
+        if phones_a and phones_b and phones_a.isdisjoint(phones_b):
+            return True
+        return bool(name_a and name_b) and not contained_tokens(name_a, name_b)
+
+    def _merge(self, a: str, b: str) -> Set[str]:
+        """Merge two clusters; returns the keys whose cluster id changed"""
+        if self._conflict(a, b):
+            return set()
+        keep, gone = (a, b) if self._rank(a) <= self._rank(b) else (b, a)
+        moved = self.members.pop(gone)
+        for key in moved:
+            self.cluster_of[key] = keep
+        self.members[keep] |= moved
+        return moved
+
+    def _resolve(self, key: str) -> Set[str]:
+        record = self.records[key]
+        changed: Set[str] = set()
+        seen: Set[str] = set()
+        for block in record.blocking_keys():
+            candidates = self.blocks.get(block, ())
+            if len(candidates) > self.max_block_size:
+                continue
+            for other in candidates:
+                if other in seen or self.cluster_of[other] == self.cluster_of[key]:
+                    continue
+                seen.add(other)
+                self.comparisons += 1
+                if same_patient(record, self.records[other]):
+                    changed |= self._merge(self.cluster_of[key], self.cluster_of[other])
+        return changed
+
+    def _observe(self, rows: Iterable[Dict]) -> Set[str]:
+        now = datetime.utcnow()
+        touched = [k for k in (self._absorb(row, now) for row in rows) if k is not None]
+        changed = set(touched)
+        for key in touched:
+            changed |= self._resolve(key)
+        if changed:
+            self.version += 1
+        return changed
+
+    def _doc(self, key: str) -> Dict:
+        record = self.records[key]
+        return {
+            "_id": key,
+            "cluster_id": self.cluster_of[key],
+            "num_paciente": record.num_paciente,
+            "names": sorted(" ".join(t) for t in record.names),
+            "phones": sorted(record.phones),
+            "first_seen": record.first_seen,
+            "updated_at": datetime.utcnow(),
+        }
+
+    def _restore(self, docs: List[Dict]):
+        self.version += 1
+        for doc in docs:
+            key = doc["_id"]
+            record = IdentityRecord(key, doc.get("num_paciente") or "", doc.get("first_seen"))
+            record.names = {tuple(n.split()) for n in doc.get("names", []) if n}
+            record.phones = set(doc.get("phones", []))
+            self.records[key] = record
+            self.cluster_of[key] = doc.get("cluster_id") or key
+            self.members.setdefault(self.cluster_of[key], set()).add(key)
+            self._file(record)
+
+    async def _source_rows(self) -> List[Dict]:
+        rows = await self.repos.patients.list()
+        fields = {"_id": 0, "patient_name": 1, "phone": 1, "num_paciente": 1}
+        rows.extend(await self.repos.appointments.scan(fields, include_quarantined=True))
+        if self.repos.archive is not None:
+            rows.extend(await self.repos.archive.scan(fields))
+        return rows
+
+    # ---- public API ----
+    async def ensure_loaded(self):
+        """Restore persisted clusters, or build them from every appointment and manual patient"""
+        if self.loaded:
+            return
+        async with self.lock:
+            if self.loaded:
+                return
+            docs = await self.repos.identities.load()
+            if docs:
+                self._restore(docs)
+                self.loaded = True
+                logger.info(f"Loaded {len(docs)} patient identities in {len(self.members)} clusters")
+                return
+        await self.rebuild()
+
+    async def rebuild(self) -> Dict:
+        """Re-resolve every identity from scratch and replace the persisted clusters.
+
+        Clusters are resolved on a fresh index in a worker thread, so the event loop
+        keeps serving meanwhile; rows observed during the build are replayed on it
+        before it is swapped in under the lock. Concurrent callers share one build.
+        """
+        if self._building is None or self._building.done():
+            self._building = asyncio.ensure_future(self._rebuild())
+        return await asyncio.shield(self._building)
+
+    async def _rebuild(self) -> Dict:
+        self._backlog = []
+        try:
+            rows = await self._source_rows()
+            fresh = PatientIdentityIndex(self.repos, self.max_block_size)
+            started = time.perf_counter()
+            await asyncio.to_thread(fresh._observe, rows)
+            elapsed = (time.perf_counter() - started) * 1000
+            async with self.lock:
+                fresh._observe(self._backlog)
+                self._swap(fresh)
+                docs = await asyncio.to_thread(lambda: [self._doc(k) for k in self.records])
+                await self.repos.identities.replace_all(docs)
+                self.loaded = True
+                self.resolve_time.observe(elapsed)
+                self.last_build = {"rows": len(rows), "resolve_ms": round(elapsed, 3), "at": datetime.utcnow().isoformat()}
+        finally:
+            self._backlog = None
+        logger.info(f"Resolved {len(self.records)} patient keys into {len(self.members)} clusters "
+                    f"({self.comparisons} comparisons) in {elapsed:.0f}ms")
+        return self.stats()
+
+    def _swap(self, fresh: "PatientIdentityIndex"):
+        self.records, self.blocks = fresh.records, fresh.blocks
+        self.cluster_of, self.members = fresh.cluster_of, fresh.members
+        self.comparisons = fresh.comparisons
+        self.version += 1
+
+    async def observe(self, rows: List[Dict]) -> int:
+        """Fold new rows into the clusters; returns how many keys were written"""
+        await self.ensure_loaded()
+        async with self.lock:
+            if self._backlog is not None:
+                self._backlog.extend(rows)
+            started = time.perf_counter()
+            changed = self._observe(rows)
+            self.resolve_time.observe((time.perf_counter() - started) * 1000)
+            if changed:
+                await self.repos.identities.save([self._doc(k) for k in changed])
+                REGISTRY.counter('patients.identity_updates').inc(len(changed))
+        return len(changed)
+
+    def stats(self) -> Dict:
+        sizes = [len(m) for m in self.members.values()]
+        oversized = sum(1 for b in self.blocks.values() if len(b) > self.max_block_size)
+        return {
+            "loaded": self.loaded,
+            "keys": len(self.records),
+            "clusters": len(self.members),
+            "merged_clusters": sum(1 for s in sizes if s > 1),
+            "largest_cluster": max(sizes, default=0),
+            "blocks": len(self.blocks),
+            "oversized_blocks": oversized,
+            "comparisons": self.comparisons,
+            "last_build": self.last_build,
+        }
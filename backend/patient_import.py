@@ -0,0 +1,209 @@
+import codecs
+import csv
+import json
+import logging
+import os
+import time
+import unicodedata
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Tuple
+
+from metrics import REGISTRY
+from patient_identity import PatientIdentityIndex, make_patient_key
+from repositories import Repositories
+
+logger = logging.getLogger(__name__)
+
+IMPORT_FIELDS = ('first_name', 'last_name', 'full_name', 'phone', 'email', 'address', 'num_paciente', 'notes')
+# Column headers of typical clinic exports, accent-folded and lower-cased
+HEADER_ALIASES = {
+    'nombre': 'first_name', 'apellidos': 'last_name', 'nombre completo': 'full_name',
+    'numpac': 'num_paciente', 'no paciente': 'num_paciente', 'numero paciente': 'num_paciente',
+    'telefono': 'phone', 'tel': 'phone', 'movil': 'phone', 'correo': 'email',
+    'direccion': 'address', 'notas': 'notes', 'observaciones': 'notes',
+}
+IMPORT_BATCH_SIZE = int(os.environ.get('PATIENT_IMPORT_BATCH_SIZE', '1000'))
+# Largest JSON record buffered while waiting for the rest of it; anything longer is malformed
+MAX_RECORD_BYTES = 64 * 1024
+# Per-row errors listed in an import report; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+
+def header_field(header: str) -> str:
+    decomposed = unicodedata.normalize('NFKD', header or "")
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+    folded = " ".join(folded.replace('_', ' ').replace('.', ' ').split())
+    return HEADER_ALIASES.get(folded, folded.replace(' ', '_'))
+
+
+def patient_doc(row: Dict, now: datetime) -> Dict:
+    """The stored fields of one imported row; raises ValueError when it cannot identify a patient"""
+    fields = {}
+    for field in IMPORT_FIELDS:
+        value = row.get(field)
+        if isinstance(value, (dict, list)):
+            raise ValueError(f"{field} must be a string")
+        fields[field] = str(value).strip() if value is not None else ""
+    fields['full_name'] = fields['full_name'] or f"{fields['first_name']} {fields['last_name']}".strip()
+    if not fields['num_paciente'] and not fields['full_name']:
+        raise ValueError("row has neither num_paciente nor a name")
+    return {
+        **fields,
+        "key": make_patient_key(fields['num_paciente'], fields['full_name'], fields['phone']),
+        "source": "manual",
+        "updated_at": now,
+    }
+
+
+# =====================
+# Streaming parsers
+# =====================
+class CsvRecords:
+    """Splits CSV text fed in arbitrary pieces into (row number, {field: value}) records;
+    the first record is the header"""
+
+    def __init__(self):
+        self.headers = None
+        self.pending = ""
+        self.record = ""
+        self.row_number = 0
+
+    def feed(self, text: str, final: bool = False) -> List[Tuple[int, Dict]]:
+        lines = (self.pending + text + ("\n" if final else "")).split("\n")
+        self.pending = lines.pop()
+        rows = []
+        for line in lines:
+            # A quoted field can span lines: a record is complete once its quotes balance
+            self.record += line + "\n"
+            if self.record.count('"') % 2:
+                continue
+            values = next(csv.reader([self.record.rstrip("\r\n")]), [])
+            self.record = ""
+            if not any(v.strip() for v in values):
+                continue
+            if self.headers is None:
+                self.headers = [header_field(h) for h in values]
+                continue
+            self.row_number += 1
+            row: Dict[str, str] = {}
+            for field, value in zip(self.headers, values):
+                # Two columns mapping to one field (e.g. "NumPac" and "Nº Paciente"): the first filled one wins
+                if not row.get(field):
+                    row[field] = value
+            rows.append((self.row_number, row))
+        if final and self.record.strip():
+            raise ValueError(f"unterminated quoted field after row {self.row_number}")
+        return rows
+
+
+class JsonRecords:
+    """Splits a JSON array or NDJSON fed in arbitrary pieces into (row number, value) records"""
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text = ""
+        self.row_number = 0
+
+    def feed(self, text: str, final: bool = False) -> List[Tuple[int, object]]:
+        self.text += text
+        rows, position = [], 0
+        while True:
+            # Values are separated by whitespace (NDJSON) or by commas inside the enclosing brackets
+            while position < len(self.text) and self.text[position] in " \t\r\n,[]":
+                position += 1
+            if position == len(self.text):
+                break
+            try:
+                value, position = self.decoder.raw_decode(self.text, position)
+            except json.JSONDecodeError as e:
+                # A value can still be arriving, unless the body ended, a complete NDJSON line
+                # failed, or it has grown far past any sane record
+                line_end = self.text.find("\n", position)
+                if final or (0 <= line_end and e.pos <= line_end) or len(self.text) - position > MAX_RECORD_BYTES:
+                    raise ValueError(f"invalid JSON after row {self.row_number}: {e.msg}")
+                break
+            self.row_number += 1
+            rows.append((self.row_number, value))
+        self.text = self.text[position:]
+        return rows
+
+
+async def iter_records(chunks: AsyncIterator[bytes], records) -> AsyncIterator[Tuple[int, object]]:
+    """Records of a streamed UTF-8 body as its chunks arrive"""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    async for chunk in chunks:
+        for row in records.feed(decoder.decode(chunk)):
+            yield row
+    for row in records.feed(decoder.decode(b"", final=True), final=True):
+        yield row
+
+
+# =====================
+# Import
+# =====================
+class PatientImporter:
+    """Bulk upsert of patients into one clinic.
+
+    Rows are validated and keyed with make_patient_key as they stream in, then written
+    in unordered bulk_write batches of `batch_size` upserts on the unique
+    (clinic_id, key) index, so an import costs one round trip per batch and a bad row
+    only fails itself. Within a batch the last row of a key wins.
+    """
+
+    def __init__(self, repos: Repositories, identities: PatientIdentityIndex, batch_size: int = None):
+        self.repos = repos
+        self.identities = identities
+        self.batch_size = batch_size or IMPORT_BATCH_SIZE
+        self.batch_time = REGISTRY.histogram('patients.import_batch_ms')
+
+    async def run(self, rows: AsyncIterator[Tuple[int, Dict]]) -> Dict:
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        report = {"received": 0, "inserted": 0, "updated": 0, "duplicates": 0, "failed": 0, "errors": []}
+        batch: Dict[str, Tuple[int, Dict]] = {}
+        try:
+            async for row_number, row in rows:
+                report["received"] += 1
+                try:
+                    if not isinstance(row, dict):
+                        raise ValueError("row must be a JSON object")
+                    doc = patient_doc(row, now)
+                except ValueError as e:
+                    self._fail(report, row_number, str(e))
+                    continue
+                if doc["key"] in batch:
+                    report["duplicates"] += 1
+                batch[doc["key"]] = (row_number, doc)
+                if len(batch) >= self.batch_size:
+                    await self._flush(batch, now, report)
+                    batch = {}
+        except ValueError as e:
+            # A malformed body stops the import; the rows before it are still written
+            report["aborted"] = str(e)
+        await self._flush(batch, now, report)
+        report["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        REGISTRY.counter('patients.imported').inc(report["inserted"] + report["updated"])
+        REGISTRY.counter('patients.import_failed').inc(report["failed"])
+        logger.info(f"Imported patients into clinic {self.repos.clinic_id}: {report['inserted']} new, "
+                    f"{report['updated']} updated, {report['failed']} failed in {report['duration_ms']}ms")
+        return report
+
+    async def _flush(self, batch: Dict[str, Tuple[int, Dict]], now: datetime, report: Dict):
+        if not batch:
+            return
+        started = time.perf_counter()
+        entries = list(batch.values())
+        docs = [doc for _, doc in entries]
+        await self.identities.observe(docs)
+        inserted, updated, errors = await self.repos.patients.upsert_many(docs, now)
+        report["inserted"] += inserted
+        report["updated"] += updated
+        for position, error in sorted(errors.items()):
+            self._fail(report, entries[position][0], error)
+        self.batch_time.observe((time.perf_counter() - started) * 1000)
+
+    @staticmethod
+    def _fail(report: Dict, row_number: int, error: str):
+        report["failed"] += 1
+        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+            report["errors"].append({"row": row_number, "error": error})
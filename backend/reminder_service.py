@@ -0,0 +1,415 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+import aiohttp
+from pymongo.errors import BulkWriteError
+
+from archive_service import as_utc
+from metrics import REGISTRY
+from repositories import Repositories
+
+logger = logging.getLogger(__name__)
+
+REMINDER_LOG_COLLECTION = 'reminder_log'
+# How long before an appointment each reminder goes out (default: 24h and 2h)
+REMINDER_OFFSETS_MINUTES = tuple(
+    int(m) for m in os.environ.get('REMINDER_OFFSETS_MINUTES', '1440,120').split(',') if m.strip()
+)
+# Appointment fields a reminder carries to the sender
+REMINDER_FIELDS = {"external_id": 1, "clinic_id": 1, "patient_name": 1, "phone": 1, "num_paciente": 1,
+                   "treatment": 1, "doctor": 1, "date": 1, "time": 1, "starts_at": 1, "status": 1, "quarantined": 1}
+# Statuses that never get a reminder; an override to one of them drops the pending ones
+SILENT_STATUSES = {'cancelled', 'completed'}
+REMINDER_LOG_RETENTION_DAYS = int(os.environ.get('REMINDER_LOG_RETENTION_DAYS', '7'))
+
+
+# =====================
+# Senders
+# =====================
+class ReminderSender:
+    """Destination for due reminders; `send` raises to have the batch retried"""
+
+    async def send(self, reminders: List[Dict]):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class HttpReminderSender(ReminderSender):
+    """POSTs {"reminders": [...]} as JSON, e.g. to an SMS or WhatsApp gateway"""
+
+    def __init__(self, url: str, timeout_seconds: float = 15):
+        self.url = url
+        self.timeout = aiohttp.ClientTimeout(total=timeout_seconds)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def send(self, reminders: List[Dict]):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        async with self._session.post(self.url, json={"reminders": reminders}) as response:
+            if response.status >= 300:
+                raise RuntimeError(f"Reminder sender returned HTTP {response.status}")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class LocalReminderSender(ReminderSender):
+    """Logs reminders and keeps the latest in memory; for development and tests"""
+
+    def __init__(self, keep: int = 1000):
+        self.sent = deque(maxlen=keep)
+
+    async def send(self, reminders: List[Dict]):
+        for reminder in reminders:
+            logger.info(f"Reminder {reminder['offset_minutes']}min before {reminder['starts_at']} "
+                        f"for {reminder.get('patient_name')} ({reminder['appointment_id']})")
+        self.sent.extend(reminders)
+
+
+def create_reminder_sender_from_env() -> Optional[ReminderSender]:
+    url = os.environ.get('REMINDER_SENDER_URL')
+    if url:
+        return HttpReminderSender(url)
+    return LocalReminderSender() if os.environ.get('REMINDERS') == 'local' else None
+
+
+# =====================
+# Delivery log
+# =====================
+class ReminderLog:
+    """Which reminders were handed to the sender, so a reminder goes out once per
+    appointment, offset and start time across resyncs, restarts and workers.
+    In memory for the memory backend; `reminder_log` in MongoDB otherwise."""
+
+    def __init__(self, mongo=None, clinic_id: str = ''):
+        self.mongo = mongo
+        self.clinic_id = clinic_id
+        self._claimed: Dict[str, float] = {}
+
+    @staticmethod
+    def key(reminder: Dict) -> str:
+        return f"{reminder['clinic_id']}:{reminder['appointment_id']}:{reminder['offset_minutes']}:{reminder['starts_at']}"
+
+    async def claim(self, reminders: List[Dict]) -> List[Dict]:
+        """The reminders not claimed before; they are claimed now"""
+        if self.mongo is None:
+            fresh = [r for r in reminders if self.key(r) not in self._claimed]
+            now = time.time()
+            self._claimed.update((self.key(r), now) for r in fresh)
+            return fresh
+        docs = [
+            {"_id": self.key(r), "clinic_id": self.clinic_id, "appointment_id": r["appointment_id"],
+             "offset_minutes": r["offset_minutes"], "starts_at": datetime.fromisoformat(r["starts_at"]),
+             "claimed_at": datetime.utcnow()}
+            for r in reminders
+        ]
+        taken: Set[int] = set()
+        try:
+            await self.mongo.db[REMINDER_LOG_COLLECTION].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            taken = {err['index'] for err in e.details.get('writeErrors', []) if err.get('code') == 11000}
+            if len(taken) < len(e.details.get('writeErrors', [])):
+                raise
+        return [r for i, r in enumerate(reminders) if i not in taken]
+
+    async def release(self, reminders: List[Dict]):
+        """Forget claims of reminders that could not be sent, so a retry can take them"""
+        keys = [self.key(r) for r in reminders]
+        if self.mongo is None:
+            for key in keys:
+                self._claimed.pop(key, None)
+            return
+        await self.mongo.db[REMINDER_LOG_COLLECTION].delete_many({"_id": {"$in": keys}})
+
+    def prune(self, before: float):
+        """Drop in-memory claims older than `before` (MongoDB expires them with a TTL index)"""
+        self._claimed = {k: at for k, at in self._claimed.items() if at >= before}
+
+
+# =====================
+# Scheduler
+# =====================
+class ReminderScheduler:
+    """Due reminders of one clinic's upcoming appointments, dispatched on time.
+
+    Every (appointment, offset) pair is an entry (due timestamp, token, appointment id,
+    offset, attempts) in a min-heap. It is built with one scan of the upcoming
+    appointments, then follows the sync diffs and status overrides; the loop sleeps
+    until the earliest due entry and only pops what is due, so a tick costs
+    O(due · log n) however many reminders are pending.
+
+    Rescheduling or dropping an appointment never searches the heap: the appointment's
+    token is replaced or removed, its old entries become stale and are skipped when
+    they surface, and the heap is compacted once stale entries outnumber live ones.
+    Due reminders are re-read from the repositories (so the latest row and override
+    apply), claimed in the ReminderLog and sent in batches of `batch_size`, at most
+    `concurrency` batches at a time. A failed batch is retried with backoff.
+    """
+
+    def __init__(self, mongo, repositories: Repositories, sender: ReminderSender,
+                 offsets_minutes: Tuple[int, ...] = REMINDER_OFFSETS_MINUTES,
+                 batch_size: Optional[int] = None, concurrency: Optional[int] = None,
+                 grace_minutes: Optional[float] = None, max_attempts: Optional[int] = None,
+                 base_backoff_seconds: float = 30.0, max_idle_seconds: float = 60.0):
+        self.repos = repositories
+        self.clinic_id = repositories.clinic_id
+        self.sender = sender
+        self.log = ReminderLog(mongo if repositories.uses_mongo else None, self.clinic_id)
+        self.offsets = tuple(sorted(set(offsets_minutes), reverse=True))
+        self.batch_size = batch_size or int(os.environ.get('REMINDER_BATCH_SIZE', '100'))
+        self.concurrency = concurrency or int(os.environ.get('REMINDER_SEND_CONCURRENCY', '4'))
+        # A reminder that fell due while nothing was running is still sent if it is at most this late
+        self.grace_seconds = (grace_minutes or float(os.environ.get('REMINDER_GRACE_MINUTES', '30'))) * 60
+        self.max_attempts = max_attempts or int(os.environ.get('REMINDER_MAX_ATTEMPTS', '5'))
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_idle_seconds = max_idle_seconds
+        self.heap: List[Tuple[float, int, str, int, int]] = []
+        # appointment id -> (token of its live entries, how many of them are in the heap)
+        self.scheduled: Dict[str, Tuple[int, int]] = {}
+        self.live = 0
+        self._tokens = itertools.count()
+        self.built = False
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.send_slots = asyncio.Semaphore(self.concurrency)
+        self.lag = REGISTRY.histogram('reminders.dispatch_lag_ms')
+        self.send_time = REGISTRY.histogram('reminders.send_ms')
+        self.last_error: Optional[str] = None
+        self.last_build: Dict = {}
+
+    # ---- schedule maintenance ----
+    def _drop(self, appointment_id: str):
+        entry = self.scheduled.pop(appointment_id, None)
+        if entry is not None:
+            self.live -= entry[1]
+
+    def _schedule(self, appointment_id: str, starts_at: Optional[datetime], status: Optional[str], now: float):
+        """(Re)schedule every reminder of one appointment that is not yet past"""
+        self._drop(appointment_id)
+        if starts_at is None or status in SILENT_STATUSES:
+            return
+        start = as_utc(starts_at).timestamp()
+        if start <= now:
+            return
+        token = next(self._tokens)
+        pushed = 0
+        for offset in self.offsets:
+            due = start - offset * 60
+            if due < now - self.grace_seconds:
+                continue
+            heapq.heappush(self.heap, (due, token, appointment_id, offset, 0))
+            pushed += 1
+        if pushed:
+            self.scheduled[appointment_id] = (token, pushed)
+            self.live += pushed
+            if self.heap[0][1] == token:
+                self.wakeup.set()
+
+    def _valid(self, entry: Tuple) -> bool:
+        scheduled = self.scheduled.get(entry[2])
+        return scheduled is not None and scheduled[0] == entry[1]
+
+    def _compact(self):
+        if len(self.heap) > 2 * self.live + 1024:
+            self.heap = [entry for entry in self.heap if self._valid(entry)]
+            heapq.heapify(self.heap)
+            self.log.prune(time.time() - REMINDER_LOG_RETENTION_DAYS * 86400)
+
+    async def _statuses(self, docs: List[Dict]) -> Dict[str, Optional[str]]:
+        """Effective status per appointment id: the override's, else the row's"""
+        ids = [str(d['_id']) for d in docs]
+        overrides = await self.repos.overrides.get_many(ids) if ids else {}
+        return {str(d['_id']): (overrides.get(str(d['_id'])) or d).get('status') for d in docs}
+
+    async def rebuild(self) -> int:
+        """Schedule every upcoming appointment from scratch; returns the pending reminder count"""
+        async with self.lock:
+            started = time.perf_counter()
+            now = datetime.now(timezone.utc)
+            docs = await self.repos.appointments.find({"$gte": now}, limit=10 ** 9)
+            overrides = await self.repos.overrides.all()
+            self.heap, self.scheduled, self.live = [], {}, 0
+            for doc in docs:
+                appointment_id = str(doc['_id'])
+                status = (overrides.get(appointment_id) or doc).get('status')
+                self._schedule(appointment_id, doc.get('starts_at'), status, now.timestamp())
+            self.built = True
+            elapsed = (time.perf_counter() - started) * 1000
+            self.last_build = {"appointments": len(docs), "reminders": self.live, "ms": round(elapsed, 1),
+                               "at": datetime.utcnow().isoformat()}
+        logger.info(f"Scheduled {self.live} reminders for {len(self.scheduled)} appointments of clinic "
+                    f"{self.clinic_id} in {elapsed:.0f}ms")
+        self.wakeup.set()
+        return self.live
+
+    async def apply_diff(self, added: List[Dict], updated: List[Dict], removed: List[Dict]):
+        """Follow a sync: changed rows are rescheduled, removed ones dropped"""
+        if not self.built:
+            return
+        changed = added + updated
+        statuses = await self._statuses(changed)
+        async with self.lock:
+            now = time.time()
+            for doc in removed:
+                self._drop(str(doc['_id']))
+            for doc in changed:
+                appointment_id = str(doc['_id'])
+                starts_at = None if doc.get('quarantined') else doc.get('starts_at')
+                self._schedule(appointment_id, starts_at, statuses.get(appointment_id), now)
+            self._compact()
+
+    async def apply_statuses(self, statuses: Dict[str, str]):
+        """Follow status overrides: a cancellation drops the appointment's reminders"""
+        if not self.built or not statuses:
+            return
+        docs = await self.repos.appointments.get_many(list(statuses), {"starts_at": 1})
+        async with self.lock:
+            now = time.time()
+            for appointment_id, status in statuses.items():
+                doc = docs.get(appointment_id)
+                self._schedule(appointment_id, doc.get('starts_at') if doc else None, status, now)
+            self._compact()
+
+    # ---- dispatch ----
+    def _pop_due(self, now: float, limit: int) -> List[Tuple]:
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < limit:
+            entry = heapq.heappop(self.heap)
+            if not self._valid(entry):
+                continue
+            token, remaining = self.scheduled[entry[2]]
+            if remaining > 1:
+                self.scheduled[entry[2]] = (token, remaining - 1)
+            else:
+                del self.scheduled[entry[2]]
+            self.live -= 1
+            due.append(entry)
+        return due
+
+    def _retry(self, entries: List[Tuple], now: float):
+        """Push failed entries back with backoff under the appointment's current token"""
+        for due, token, appointment_id, offset, attempts in entries:
+            if attempts + 1 >= self.max_attempts:
+                REGISTRY.counter('reminders.failed').inc()
+                continue
+            scheduled = self.scheduled.get(appointment_id)
+            if scheduled is not None and scheduled[0] != token:
+                continue  # rescheduled meanwhile; the new entries take over
+            delay = self.base_backoff_seconds * 2 ** attempts * random.uniform(0.5, 1.0)
+            heapq.heappush(self.heap, (now + delay, token, appointment_id, offset, attempts + 1))
+            self.scheduled[appointment_id] = (token, (scheduled[1] if scheduled else 0) + 1)
+            self.live += 1
+
+    async def dispatch_due(self) -> int:
+        """Send every reminder that is due; returns how many were sent"""
+        async with self.lock:
+            now = time.time()
+            entries = self._pop_due(now, self.batch_size * self.concurrency)
+        if not entries:
+            return 0
+        ids = list({entry[2] for entry in entries})
+        docs = await self.repos.appointments.get_many(ids, REMINDER_FIELDS)
+        statuses = await self._statuses(list(docs.values()))
+        reminders, sources = [], []
+        for entry in entries:
+            due, _, appointment_id, offset, _ = entry
+            doc = docs.get(appointment_id)
+            if doc is None or doc.get('quarantined') or doc.get('starts_at') is None \
+                    or statuses.get(appointment_id) in SILENT_STATUSES:
+                continue
+            starts_at = as_utc(doc['starts_at']).astimezone(timezone.utc)
+            if starts_at.timestamp() <= now or starts_at.timestamp() - offset * 60 > now:
+                continue  # moved by a sync still in flight; its new entries follow
+            reminders.append({
+                **{k: v for k, v in doc.items() if k not in ('_id', 'starts_at', 'quarantined')},
+                "appointment_id": appointment_id,
+                "clinic_id": self.clinic_id,
+                "status": statuses.get(appointment_id),
+                "starts_at": starts_at.isoformat(),
+                "offset_minutes": offset,
+            })
+            sources.append(entry)
+            self.lag.observe(max(now - due, 0) * 1000)
+        claimed = await self.log.claim(reminders)
+        claimed_keys = {self.log.key(r) for r in claimed}
+        pairs = [(r, e) for r, e in zip(reminders, sources) if self.log.key(r) in claimed_keys]
+        batches = [pairs[i:i + self.batch_size] for i in range(0, len(pairs), self.batch_size)]
+        sent = await asyncio.gather(*(self._send(batch) for batch in batches))
+        return sum(sent)
+
+    async def _send(self, batch: List[Tuple[Dict, Tuple]]) -> int:
+        reminders = [r for r, _ in batch]
+        async with self.send_slots:
+            started = time.perf_counter()
+            try:
+                await self.sender.send(reminders)
+            except Exception as e:
+                self.last_error = str(e)
+                logger.warning(f"Sending {len(reminders)} reminders of clinic {self.clinic_id} failed: {str(e)}")
+                await self.log.release(reminders)
+                async with self.lock:
+                    self._retry([entry for _, entry in batch], time.time())
+                    self.wakeup.set()
+                return 0
+        self.send_time.observe((time.perf_counter() - started) * 1000)
+        REGISTRY.counter('reminders.sent').inc(len(reminders))
+        self.last_error = None
+        return len(reminders)
+
+    def seconds_until_next(self) -> float:
+        if not self.heap:
+            return self.max_idle_seconds
+        return min(max(self.heap[0][0] - time.time(), 0.0), self.max_idle_seconds)
+
+    async def run(self):
+        logger.info(f"Starting reminder scheduler of clinic {self.clinic_id} "
+                    f"({', '.join(f'{m}min' for m in self.offsets)} before)")
+        try:
+            await self.rebuild()
+            while True:
+                try:
+                    await self.dispatch_due()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.last_error = str(e)
+                    logger.error(f"Error dispatching reminders of clinic {self.clinic_id}: {str(e)}")
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self.seconds_until_next())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.sender.close()
+
+    def upcoming(self, limit: int = 20) -> List[Dict]:
+        """The next `limit` pending reminders"""
+        entries = heapq.nsmallest(limit, (e for e in self.heap if self._valid(e)))
+        return [
+            {"appointment_id": appointment_id, "offset_minutes": offset, "attempts": attempts,
+             "due_at": datetime.fromtimestamp(due, timezone.utc).isoformat()}
+            for due, _, appointment_id, offset, attempts in entries
+        ]
+
+    def stats(self) -> Dict:
+        return {
+            "built": self.built,
+            "offsets_minutes": list(self.offsets),
+            "pending": self.live,
+            "appointments": len(self.scheduled),
+            "heap_entries": len(self.heap),
+            "next_due_at": datetime.fromtimestamp(self.heap[0][0], timezone.utc).isoformat() if self.heap else None,
+            "last_build": self.last_build,
+            "last_error": self.last_error,
+        }
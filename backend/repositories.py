@@ -0,0 +1,782 @@
+import bisect
+import heapq
+import logging
+import os
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from appointment_records import MISSING, AppointmentRecord, epoch_minutes, record_key
+from sheet_sources import DEFAULT_CLINIC_ID
+
+logger = logging.getLogger(__name__)
+
+# mongo: every read hits MongoDB; cached: in-memory hot tier in front of MongoDB;
+# memory: standalone in-process storage (tests, benchmarks, demos without a database).
+# Every repository serves one clinic: MongoDB queries are scoped by clinic_id, the
+# in-process tiers are simply separate per clinic.
+REPOSITORY_BACKENDS = ('mongo', 'cached', 'memory')
+BASE_QUERY = {"source": "google_sheets"}
+ARCHIVE_COLLECTION = 'appointments_archive'
+
+
+def as_object_id(appointment_id):
+    if isinstance(appointment_id, str) and ObjectId.is_valid(appointment_id):
+        return ObjectId(appointment_id)
+    return appointment_id
+
+
+# =====================
+# Appointments
+# =====================
+class AppointmentRepository(ABC):
+    """Storage for synced sheet appointments.
+
+    `find` and `count` take clinic-day bounds as produced by date_range_query
+    ({"$gte": utc datetime, "$lt": utc datetime}); documents are returned as
+    plain dicts in the stored shape, never as shared references.
+    """
+
+    @abstractmethod
+    async def sync_state(self, fields: Dict, source_id: Optional[str] = None, include_untagged: bool = False) -> List[Dict]:
+        """Every stored sheet row (quarantined included), for the sync diff.
+
+        With `source_id`, only that source's rows; `include_untagged` adds rows
+        synced before sources were tagged, so one source can adopt them.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def has_rows(self, source_id: Optional[str] = None, include_untagged: bool = False) -> bool:
+        """Whether any sheet row (of the source, as in sync_state) is stored"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def apply_sync(self, removed: List[Dict], updated: List[Dict], added: List[Dict]):
+        """Delete removed rows by _id, replace updated ones and insert added ones (assigning _id)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find(self, starts_at: Optional[Dict] = None, status: Optional[str] = None, limit: int = 10000) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count(self, starts_at: Optional[Dict] = None, status: Optional[str] = None) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get(self, appointment_id, fields: Optional[Dict] = None) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_many(self, appointment_ids: List[str], fields: Optional[Dict] = None) -> Dict[str, Dict]:
+        """Documents by str(_id); unknown ids are left out"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def quarantined(self, fields: Dict, limit: int) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def scan(self, fields: Dict, include_quarantined: bool = False) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def history(self, patient_keys: List[str], before: Optional[Tuple[datetime, str]] = None,
+                      limit: int = 50) -> List[Dict]:
+        """Listed rows of the given patient keys, newest first (starts_at, then _id), strictly
+        older than the (starts_at, str(_id)) position `before`"""
+        raise NotImplementedError
+
+
+class MongoAppointmentRepository(AppointmentRepository):
+    def __init__(self, mongo, collection_name: str = 'appointments', clinic_id: str = DEFAULT_CLINIC_ID):
+        self.mongo = mongo
+        self.collection_name = collection_name
+        self.clinic_id = clinic_id
+        # Every query filters on the clinic first; the indexes lead with clinic_id
+        self.base = {"clinic_id": clinic_id, **BASE_QUERY}
+
+    @property
+    def collection(self):
+        return self.mongo.db[self.collection_name]
+
+    def query(self, starts_at: Optional[Dict] = None, status: Optional[str] = None) -> Dict:
+        query = {**self.base, "quarantined": False}
+        if status:
+            query["status"] = status
+        if starts_at:
+            query["starts_at"] = starts_at
+        return query
+
+    def source_query(self, source_id: Optional[str], include_untagged: bool) -> Dict:
+        query = dict(self.base)
+        if source_id is not None:
+            query["source_id"] = {"$in": [source_id, None]} if include_untagged else source_id
+        return query
+
+    async def sync_state(self, fields: Dict, source_id: Optional[str] = None, include_untagged: bool = False) -> List[Dict]:
+        return await self.collection.find(self.source_query(source_id, include_untagged), fields).to_list(length=None)
+
+    async def has_rows(self, source_id: Optional[str] = None, include_untagged: bool = False) -> bool:
+        return await self.collection.find_one(self.source_query(source_id, include_untagged), {"_id": 1}) is not None
+
+    async def apply_sync(self, removed: List[Dict], updated: List[Dict], added: List[Dict]):
+        if removed:
+            await self.collection.delete_many({"_id": {"$in": [d['_id'] for d in removed]}})
+        if updated:
+            ops = [UpdateOne({"_id": d['_id']}, {"$set": {k: v for k, v in d.items() if k != '_id'}}) for d in updated]
+            await self.collection.bulk_write(ops, ordered=False)
+        if added:
+            await self.collection.insert_many(added)
+
+    async def find(self, starts_at: Optional[Dict] = None, status: Optional[str] = None, limit: int = 10000) -> List[Dict]:
+        cursor = self.collection.find(self.query(starts_at, status)).sort([("starts_at", 1)]).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def count(self, starts_at: Optional[Dict] = None, status: Optional[str] = None) -> int:
+        return await self.collection.count_documents(self.query(starts_at, status))
+
+    async def get(self, appointment_id, fields: Optional[Dict] = None) -> Optional[Dict]:
+        return await self.collection.find_one({"_id": as_object_id(appointment_id), "clinic_id": self.clinic_id}, fields)
+
+    async def get_many(self, appointment_ids: List[str], fields: Optional[Dict] = None) -> Dict[str, Dict]:
+        if not appointment_ids:
+            return {}
+        cursor = self.collection.find({"_id": {"$in": [as_object_id(i) for i in appointment_ids]}, "clinic_id": self.clinic_id}, fields)
+        return {str(doc['_id']): doc async for doc in cursor}
+
+    async def quarantined(self, fields: Dict, limit: int) -> List[Dict]:
+        return await self.collection.find({**self.base, "quarantined": True}, fields).to_list(length=limit)
+
+    async def scan(self, fields: Dict, include_quarantined: bool = False) -> List[Dict]:
+        query = dict(self.base) if include_quarantined else {**self.base, "quarantined": False}
+        return await self.collection.find(query, fields).to_list(length=None)
+
+    async def history(self, patient_keys: List[str], before: Optional[Tuple[datetime, str]] = None,
+                      limit: int = 50) -> List[Dict]:
+        # One range read of the (clinic_id, source, quarantined, patient_key, starts_at, _id) index per key
+        query = {**self.query(), "patient_key": {"$in": patient_keys}}
+        if before is not None:
+            starts_at, appointment_id = before
+            query["$or"] = [
+                {"starts_at": {"$lt": starts_at}},
+                {"starts_at": starts_at, "_id": {"$lt": as_object_id(appointment_id)}},
+            ]
+        cursor = self.collection.find(query).sort([("starts_at", -1), ("_id", -1)]).limit(limit)
+        return await cursor.to_list(length=limit)
+
+
+class MemoryAppointmentRepository(AppointmentRepository):
+    """Appointments held in process as packed AppointmentRecords.
+
+    Records live in a dict keyed by the raw ObjectId bytes. Two parallel lists,
+    start minutes and records, kept sorted with bisect serve date-range listings
+    and counts; a status -> keys hash index serves status counts without scanning,
+    and a patient key -> keys one serves patient histories.
+    """
+
+    # Above this many written rows, apply_sync rebuilds the indexes with one sort
+    BULK_REINDEX_ROWS = 1024
+
+    def __init__(self):
+        self.loaded = False
+        self._docs: Dict[bytes, AppointmentRecord] = {}
+        self._starts: List[int] = []
+        self._order: List[AppointmentRecord] = []
+        self._by_status: Dict[str, Set[bytes]] = {}
+        self._by_patient: Dict[str, Set[bytes]] = {}
+        self._quarantined: Set[bytes] = set()
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def _index(self, key, record: AppointmentRecord):
+        minute = record.start_minute
+        if minute is None:
+            self._quarantined.add(key)
+            return
+        i = bisect.bisect_right(self._starts, minute)
+        self._starts.insert(i, minute)
+        self._order.insert(i, record)
+        self._by_status.setdefault(record.status_key, set()).add(key)
+        if type(record.patient_key) is str:
+            self._by_patient.setdefault(record.patient_key, set()).add(key)
+
+    def _unindex(self, key, record: AppointmentRecord):
+        if key in self._quarantined:
+            self._quarantined.discard(key)
+            return
+        minute = record.start_minute
+        for i in range(bisect.bisect_left(self._starts, minute), bisect.bisect_right(self._starts, minute)):
+            if self._order[i] is record:
+                del self._starts[i]
+                del self._order[i]
+                break
+        self._by_status.get(record.status_key, set()).discard(key)
+        patients = self._by_patient.get(record.patient_key)
+        if patients is not None:
+            patients.discard(key)
+            if not patients:
+                del self._by_patient[record.patient_key]
+
+    def put(self, doc: Dict):
+        doc.setdefault('_id', ObjectId())
+        record = AppointmentRecord.from_doc(doc)
+        key = record.key
+        old = self._docs.get(key)
+        if old is not None:
+            self._unindex(key, old)
+        self._docs[key] = record
+        self._index(key, record)
+
+    def delete(self, appointment_id):
+        key = record_key(appointment_id)
+        old = self._docs.pop(key, None)
+        if old is not None:
+            self._unindex(key, old)
+
+    def load(self, docs: Iterable[Dict]):
+        """Replace the contents wholesale (cache warmup)"""
+        self._docs, stamps = {}, {}
+        for doc in docs:
+            record = AppointmentRecord.from_doc(doc, stamps)
+            self._docs[record.key] = record
+        self._reindex()
+        self.loaded = True
+
+    def _reindex(self):
+        """Rebuild every index from _docs with one sort"""
+        self._by_status, self._by_patient, self._quarantined = {}, {}, set()
+        listed = []
+        for key, record in self._docs.items():
+            minute = record.start_minute
+            if minute is None:
+                self._quarantined.add(key)
+            else:
+                listed.append((minute, record))
+                self._by_status.setdefault(record.status_key, set()).add(key)
+                if type(record.patient_key) is str:
+                    self._by_patient.setdefault(record.patient_key, set()).add(key)
+        listed.sort(key=lambda pair: pair[0])
+        self._starts = [minute for minute, _ in listed]
+        self._order = [record for _, record in listed]
+
+    def _range(self, starts_at: Optional[Dict]) -> Tuple[int, int]:
+        lo, hi = 0, len(self._starts)
+        if starts_at and starts_at.get('$gte') is not None:
+            lo = bisect.bisect_left(self._starts, epoch_minutes(starts_at['$gte']))
+        if starts_at and starts_at.get('$lt') is not None:
+            hi = bisect.bisect_left(self._starts, epoch_minutes(starts_at['$lt']))
+        return lo, hi
+
+    def _records(self, starts_at: Optional[Dict], status: Optional[str]):
+        lo, hi = self._range(starts_at)
+        if status is None:
+            return (self._order[i] for i in range(lo, hi))
+        return (self._order[i] for i in range(lo, hi) if self._order[i].status_key == status)
+
+    def _of_source(self, source_id: Optional[str], include_untagged: bool) -> Iterable[AppointmentRecord]:
+        if source_id is None:
+            return self._docs.values()
+        wanted = {source_id, MISSING, None} if include_untagged else {source_id}
+        return (record for record in self._docs.values() if record.source_id in wanted)
+
+    async def sync_state(self, fields: Dict, source_id: Optional[str] = None, include_untagged: bool = False) -> List[Dict]:
+        return [record.to_doc(fields) for record in self._of_source(source_id, include_untagged)]
+
+    async def has_rows(self, source_id: Optional[str] = None, include_untagged: bool = False) -> bool:
+        return any(True for _ in self._of_source(source_id, include_untagged))
+
+    async def apply_sync(self, removed: List[Dict], updated: List[Dict], added: List[Dict]):
+        if len(updated) + len(added) <= self.BULK_REINDEX_ROWS:
+            for doc in removed:
+                self.delete(doc['_id'])
+            for doc in updated + added:
+                self.put(doc)
+        else:
+            # Bisect-inserting is O(n) per row: a large batch (e.g. an initial sync) is re-sorted once
+            for doc in removed:
+                self._docs.pop(record_key(doc['_id']), None)
+            stamps = {}
+            for doc in updated + added:
+                doc.setdefault('_id', ObjectId())
+                record = AppointmentRecord.from_doc(doc, stamps)
+                self._docs[record.key] = record
+            self._reindex()
+        self.loaded = True
+
+    async def find(self, starts_at: Optional[Dict] = None, status: Optional[str] = None, limit: int = 10000) -> List[Dict]:
+        out = []
+        for record in self._records(starts_at, status):
+            out.append(record.to_doc())
+            if len(out) >= limit:
+                break
+        return out
+
+    async def count(self, starts_at: Optional[Dict] = None, status: Optional[str] = None) -> int:
+        if not starts_at:
+            return len(self._by_status.get(status, ())) if status else len(self._starts)
+        if status is None:
+            lo, hi = self._range(starts_at)
+            return max(hi - lo, 0)
+        return sum(1 for _ in self._records(starts_at, status))
+
+    async def get(self, appointment_id, fields: Optional[Dict] = None) -> Optional[Dict]:
+        record = self._docs.get(record_key(appointment_id))
+        return record.to_doc(fields) if record is not None else None
+
+    async def get_many(self, appointment_ids: List[str], fields: Optional[Dict] = None) -> Dict[str, Dict]:
+        found = {}
+        for appointment_id in appointment_ids:
+            record = self._docs.get(record_key(appointment_id))
+            if record is not None:
+                found[str(appointment_id)] = record.to_doc(fields)
+        return found
+
+    async def quarantined(self, fields: Dict, limit: int) -> List[Dict]:
+        return [self._docs[key].to_doc(fields) for key in list(self._quarantined)[:limit]]
+
+    async def scan(self, fields: Dict, include_quarantined: bool = False) -> List[Dict]:
+        return [
+            record.to_doc(fields) for key, record in self._docs.items()
+            if include_quarantined or key not in self._quarantined
+        ]
+
+    async def history(self, patient_keys: List[str], before: Optional[Tuple[datetime, str]] = None,
+                      limit: int = 50) -> List[Dict]:
+        def position(record: AppointmentRecord):
+            key = record.key
+            return record.start_minute, key.hex() if type(key) is bytes else str(key)
+
+        records = [self._docs[key] for patient_key in patient_keys for key in self._by_patient.get(patient_key, ())]
+        if before is not None:
+            bound = (epoch_minutes(before[0]), before[1])
+            records = [record for record in records if position(record) < bound]
+        return [record.to_doc() for record in heapq.nlargest(limit, records, key=position)]
+
+
+class CachedAppointmentRepository(AppointmentRepository):
+    """Hot read tier: writes go to MongoDB and then to memory; reads are served from
+    memory once it has been warmed, and fall through to MongoDB until then."""
+
+    def __init__(self, primary: AppointmentRepository, cache: MemoryAppointmentRepository):
+        self.primary = primary
+        self.cache = cache
+
+    async def warm(self):
+        docs = await self.primary.sync_state(None)
+        self.cache.load(docs)
+        logger.info(f"Appointment cache warmed with {len(self.cache)} rows")
+
+    def _reader(self) -> AppointmentRepository:
+        return self.cache if self.cache.loaded else self.primary
+
+    async def sync_state(self, fields: Dict, source_id: Optional[str] = None, include_untagged: bool = False) -> List[Dict]:
+        if not self.cache.loaded:
+            await self.warm()
+        return await self.cache.sync_state(fields, source_id, include_untagged)
+
+    async def has_rows(self, source_id: Optional[str] = None, include_untagged: bool = False) -> bool:
+        return await self._reader().has_rows(source_id, include_untagged)
+
+    async def apply_sync(self, removed: List[Dict], updated: List[Dict], added: List[Dict]):
+        await self.primary.apply_sync(removed, updated, added)
+        if self.cache.loaded:
+            await self.cache.apply_sync(removed, updated, added)
+
+    async def find(self, starts_at: Optional[Dict] = None, status: Optional[str] = None, limit: int = 10000) -> List[Dict]:
+        return await self._reader().find(starts_at, status, limit)
+
+    async def count(self, starts_at: Optional[Dict] = None, status: Optional[str] = None) -> int:
+        return await self._reader().count(starts_at, status)
+
+    async def get(self, appointment_id, fields: Optional[Dict] = None) -> Optional[Dict]:
+        return await self._reader().get(appointment_id, fields)
+
+    async def get_many(self, appointment_ids: List[str], fields: Optional[Dict] = None) -> Dict[str, Dict]:
+        return await self._reader().get_many(appointment_ids, fields)
+
+    async def quarantined(self, fields: Dict, limit: int) -> List[Dict]:
+        return await self._reader().quarantined(fields, limit)
+
+    async def scan(self, fields: Dict, include_quarantined: bool = False) -> List[Dict]:
+        return await self._reader().scan(fields, include_quarantined)
+
+    async def history(self, patient_keys: List[str], before: Optional[Tuple[datetime, str]] = None,
+                      limit: int = 50) -> List[Dict]:
+        return await self._reader().history(patient_keys, before, limit)
+
+
+# =====================
+# Status overrides
+# =====================
+class OverrideRepository(ABC):
+    """Manual status overrides keyed by appointment id (string)"""
+
+    @abstractmethod
+    async def get_many(self, appointment_ids: List[str]) -> Dict[str, Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def all(self) -> Dict[str, Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def upsert(self, appointment_id: str, fields: Dict) -> Optional[Dict]:
+        """Set fields on the override; returns the previous override, if any"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def upsert_many(self, changes: Dict[str, Dict]) -> Tuple[Dict[str, Dict], Dict[str, str]]:
+        """Apply {appointment_id: fields} in one batch.
+
+        Returns (previous overrides of the ids that were written, {appointment_id: error}
+        for the ones that failed).
+        """
+        raise NotImplementedError
+
+
+class MongoOverrideRepository(OverrideRepository):
+    def __init__(self, mongo, clinic_id: str = DEFAULT_CLINIC_ID):
+        self.mongo = mongo
+        self.clinic_id = clinic_id
+
+    @property
+    def collection(self):
+        return self.mongo.db.get_collection('appointment_overrides')
+
+    async def get_many(self, appointment_ids: List[str]) -> Dict[str, Dict]:
+        if not appointment_ids:
+            return {}
+        cursor = self.collection.find({"clinic_id": self.clinic_id, "appointment_id": {"$in": appointment_ids}})
+        return {doc["appointment_id"]: doc async for doc in cursor}
+
+    async def all(self) -> Dict[str, Dict]:
+        return {doc["appointment_id"]: doc async for doc in self.collection.find({"clinic_id": self.clinic_id})}
+
+    async def upsert(self, appointment_id: str, fields: Dict) -> Optional[Dict]:
+        return await self.collection.find_one_and_update(
+            {"clinic_id": self.clinic_id, "appointment_id": appointment_id},
+            {"$set": {"clinic_id": self.clinic_id, "appointment_id": appointment_id, **fields}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+
+    async def upsert_many(self, changes: Dict[str, Dict]) -> Tuple[Dict[str, Dict], Dict[str, str]]:
+        if not changes:
+            return {}, {}
+        ids = list(changes)
+        previous = await self.get_many(ids)
+        ops = [
+            UpdateOne({"clinic_id": self.clinic_id, "appointment_id": i},
+                      {"$set": {"clinic_id": self.clinic_id, "appointment_id": i, **changes[i]}}, upsert=True)
+            for i in ids
+        ]
+        errors: Dict[str, str] = {}
+        try:
+            await self.collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get('writeErrors', []):
+                errors[ids[err['index']]] = err.get('errmsg', 'write failed')
+        return {i: doc for i, doc in previous.items() if i not in errors}, errors
+
+
+class MemoryOverrideRepository(OverrideRepository):
+    def __init__(self):
+        self._docs: Dict[str, Dict] = {}
+
+    async def get_many(self, appointment_ids: List[str]) -> Dict[str, Dict]:
+        return {i: dict(self._docs[i]) for i in appointment_ids if i in self._docs}
+
+    async def all(self) -> Dict[str, Dict]:
+        return {k: dict(v) for k, v in self._docs.items()}
+
+    async def upsert(self, appointment_id: str, fields: Dict) -> Optional[Dict]:
+        previous = self._docs.get(appointment_id)
+        self._docs[appointment_id] = {**(previous or {}), "appointment_id": appointment_id, **fields}
+        return dict(previous) if previous is not None else None
+
+    async def upsert_many(self, changes: Dict[str, Dict]) -> Tuple[Dict[str, Dict], Dict[str, str]]:
+        previous = {}
+        for appointment_id, fields in changes.items():
+            before = await self.upsert(appointment_id, fields)
+            if before is not None:
+                previous[appointment_id] = before
+        return previous, {}
+
+
+# =====================
+# Patients
+# =====================
+class PatientRepository(ABC):
+    """Manually maintained patient records (derived patients are computed from appointments)"""
+
+    @abstractmethod
+    async def list(self, limit: int = 5000) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get(self, patient_id) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_by_key(self, key: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update(self, patient_id, fields: Dict) -> Optional[Dict]:
+        """Set `fields` on an existing patient; returns the updated patient, None if there is none"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def upsert_by_key(self, key: str, fields: Dict, created_at: datetime) -> Dict:
+        """Set `fields` on the patient with `key`, creating it if there is none; returns the patient"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def upsert_many(self, docs: List[Dict], created_at: datetime) -> Tuple[int, int, Dict[int, str]]:
+        """Upsert a batch of patients by their `key` in one round trip.
+
+        Returns (inserted, updated, {position in `docs`: error}) for the rows that failed.
+        """
+        raise NotImplementedError
+
+
+class MongoPatientRepository(PatientRepository):
+    def __init__(self, mongo, clinic_id: str = DEFAULT_CLINIC_ID):
+        self.mongo = mongo
+        self.clinic_id = clinic_id
+
+    @property
+    def collection(self):
+        return self.mongo.db.patients
+
+    async def list(self, limit: int = 5000) -> List[Dict]:
+        return await self.collection.find({"clinic_id": self.clinic_id}).to_list(limit)
+
+    async def get(self, patient_id) -> Optional[Dict]:
+        return await self.collection.find_one({"_id": as_object_id(patient_id), "clinic_id": self.clinic_id})
+
+    async def find_by_key(self, key: str) -> Optional[Dict]:
+        return await self.collection.find_one({"clinic_id": self.clinic_id, "key": key})
+
+    async def update(self, patient_id, fields: Dict) -> Optional[Dict]:
+        return await self.collection.find_one_and_update(
+            {"_id": as_object_id(patient_id), "clinic_id": self.clinic_id}, {"$set": fields},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def upsert_by_key(self, key: str, fields: Dict, created_at: datetime) -> Dict:
+        # Atomic on the unique (clinic_id, key) index: concurrent creates of one patient cannot duplicate it
+        return await self.collection.find_one_and_update(
+            {"clinic_id": self.clinic_id, "key": key},
+            {"$set": {**fields, "key": key}, "$setOnInsert": {"created_at": created_at}},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+
+    async def upsert_many(self, docs: List[Dict], created_at: datetime) -> Tuple[int, int, Dict[int, str]]:
+        if not docs:
+            return 0, 0, {}
+        ops = [
+            UpdateOne({"clinic_id": self.clinic_id, "key": d["key"]},
+                      {"$set": d, "$setOnInsert": {"created_at": created_at}}, upsert=True)
+            for d in docs
+        ]
+        errors: Dict[int, str] = {}
+        try:
+            result = await self.collection.bulk_write(ops, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            for err in details.get('writeErrors', []):
+                errors[err['index']] = err.get('errmsg', 'write failed')
+        return details.get('nUpserted', 0), details.get('nMatched', 0), errors
+
+
+class MemoryPatientRepository(PatientRepository):
+    """Patients in process with hash indexes on key, phone and num_paciente"""
+
+    INDEXED = ('key', 'phone', 'num_paciente')
+
+    def __init__(self):
+        self._docs: Dict[str, Dict] = {}
+        self._indexes: Dict[str, Dict[str, Set[str]]] = {field: {} for field in self.INDEXED}
+
+    def _index(self, pid: str, doc: Dict, add: bool):
+        for field in self.INDEXED:
+            value = doc.get(field)
+            if not value:
+                continue
+            bucket = self._indexes[field].setdefault(value, set())
+            if add:
+                bucket.add(pid)
+            else:
+                bucket.discard(pid)
+
+    def find_by(self, field: str, value: str) -> List[Dict]:
+        return [dict(self._docs[pid]) for pid in self._indexes[field].get(value, ())]
+
+    async def list(self, limit: int = 5000) -> List[Dict]:
+        return [dict(doc) for doc in list(self._docs.values())[:limit]]
+
+    async def get(self, patient_id) -> Optional[Dict]:
+        doc = self._docs.get(str(patient_id))
+        return dict(doc) if doc is not None else None
+
+    async def find_by_key(self, key: str) -> Optional[Dict]:
+        found = self.find_by('key', key)
+        return found[0] if found else None
+
+    async def update(self, patient_id, fields: Dict) -> Optional[Dict]:
+        pid = str(patient_id)
+        doc = self._docs.get(pid)
+        if doc is None:
+            return None
+        self._index(pid, doc, add=False)
+        doc.update(fields)
+        self._index(pid, doc, add=True)
+        return dict(doc)
+
+    def _upsert(self, key: str, fields: Dict, created_at: datetime) -> Tuple[Dict, bool]:
+        pids = self._indexes['key'].get(key)
+        if pids:
+            pid = next(iter(pids))
+            doc = self._docs[pid]
+            self._index(pid, doc, add=False)
+            doc.update(fields, key=key)
+            self._index(pid, doc, add=True)
+            return dict(doc), False
+        pid = str(ObjectId())
+        doc = self._docs[pid] = {**fields, "_id": pid, "key": key, "created_at": created_at}
+        self._index(pid, doc, add=True)
+        return dict(doc), True
+
+    async def upsert_by_key(self, key: str, fields: Dict, created_at: datetime) -> Dict:
+        return self._upsert(key, fields, created_at)[0]
+
+    async def upsert_many(self, docs: List[Dict], created_at: datetime) -> Tuple[int, int, Dict[int, str]]:
+        inserted = sum(self._upsert(d["key"], d, created_at)[1] for d in docs)
+        return inserted, len(docs) - inserted, {}
+
+
+class PatientIdentityRepository(ABC):
+    """Persisted patient identity clusters, one document per patient key (see patient_identity)"""
+
+    @abstractmethod
+    async def load(self) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save(self, docs: List[Dict]):
+        """Upsert identity documents by _id (the patient key)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def replace_all(self, docs: List[Dict]):
+        raise NotImplementedError
+
+
+class MongoPatientIdentityRepository(PatientIdentityRepository):
+    """Stored under "<clinic_id>:<patient key>", since one key can turn up in several clinics"""
+
+    def __init__(self, mongo, clinic_id: str = DEFAULT_CLINIC_ID):
+        self.mongo = mongo
+        self.clinic_id = clinic_id
+
+    @property
+    def collection(self):
+        return self.mongo.db.patient_identities
+
+    async def load(self) -> List[Dict]:
+        docs = await self.collection.find({"clinic_id": self.clinic_id}).to_list(length=None)
+        return [{**doc, "_id": doc["key"]} for doc in docs]
+
+    async def save(self, docs: List[Dict]):
+        if docs:
+            ops = [
+                ReplaceOne({"_id": f"{self.clinic_id}:{d['_id']}"},
+                           {**d, "_id": f"{self.clinic_id}:{d['_id']}", "key": d["_id"], "clinic_id": self.clinic_id}, upsert=True)
+                for d in docs
+            ]
+            await self.collection.bulk_write(ops, ordered=False)
+
+    async def replace_all(self, docs: List[Dict]):
+        await self.collection.delete_many({"clinic_id": self.clinic_id})
+        await self.save(docs)
+
+
+class MemoryPatientIdentityRepository(PatientIdentityRepository):
+    def __init__(self):
+        self._docs: Dict[str, Dict] = {}
+
+    async def load(self) -> List[Dict]:
+        return [dict(doc) for doc in self._docs.values()]
+
+    async def save(self, docs: List[Dict]):
+        for doc in docs:
+            self._docs[doc["_id"]] = dict(doc)
+
+    async def replace_all(self, docs: List[Dict]):
+        self._docs.clear()
+        await self.save(docs)
+
+
+# =====================
+# Wiring
+# =====================
+class Repositories:
+    """The repositories one clinic is served from, built for a given backend"""
+
+    def __init__(self, backend: str, appointments: AppointmentRepository, overrides: OverrideRepository,
+                 patients: PatientRepository, identities: PatientIdentityRepository,
+                 archive: Optional[MongoAppointmentRepository] = None, clinic_id: str = DEFAULT_CLINIC_ID):
+        self.backend = backend
+        self.clinic_id = clinic_id
+        self.appointments = appointments
+        self.overrides = overrides
+        self.patients = patients
+        self.identities = identities
+        # Appointments past the archive horizon (MongoDB backends only; see archive_service)
+        self.archive = archive
+
+    @property
+    def uses_mongo(self) -> bool:
+        return self.backend != 'memory'
+
+    async def warm(self):
+        """Fill the hot tier from MongoDB until the first load (later syncs keep it current).
+        No-op for other backends."""
+        if isinstance(self.appointments, CachedAppointmentRepository) and not self.appointments.cache.loaded:
+            await self.appointments.warm()
+
+    def warm_state(self) -> Dict[str, bool]:
+        """Whether each in-process tier holds its data; empty when every read goes to MongoDB"""
+        state = {}
+        if isinstance(self.appointments, CachedAppointmentRepository):
+            state["appointments"] = self.appointments.cache.loaded
+        elif isinstance(self.appointments, MemoryAppointmentRepository):
+            state["appointments"] = self.appointments.loaded
+        return state
+
+
+def create_repositories(mongo, backend: Optional[str] = None, clinic_id: str = DEFAULT_CLINIC_ID) -> Repositories:
+    backend = backend or os.environ.get('REPOSITORY_BACKEND', 'cached')
+    if backend not in REPOSITORY_BACKENDS:
+        raise ValueError(f"Unknown repository backend: {backend}")
+    if backend == 'memory':
+        return Repositories(backend, MemoryAppointmentRepository(), MemoryOverrideRepository(),
+                            MemoryPatientRepository(), MemoryPatientIdentityRepository(), clinic_id=clinic_id)
+    appointments = MongoAppointmentRepository(mongo, clinic_id=clinic_id)
+    if backend == 'cached':
+        appointments = CachedAppointmentRepository(appointments, MemoryAppointmentRepository())
+    # Overrides are always read from MongoDB, even when appointments are cached: any worker may
+    # write one, and they are few and indexed by appointment_id
+    overrides = MongoOverrideRepository(mongo, clinic_id)
+    archive = MongoAppointmentRepository(mongo, ARCHIVE_COLLECTION, clinic_id)
+    return Repositories(backend, appointments, overrides, MongoPatientRepository(mongo, clinic_id),
+                        MongoPatientIdentityRepository(mongo, clinic_id), archive, clinic_id)
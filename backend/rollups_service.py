@@ -0,0 +1,110 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_FIELDS = {"date": 1, "doctor": 1, "treatment": 1, "status": 1, "duration": 1, "duration_minutes": 1, "quarantined": 1}
+ROLLUP_GROUP_BY = ('day', 'month', 'doctor', 'treatment', 'status')
+
+RollupKey = Tuple[str, str, str, str]
+
+
+class DailyRollupService:
+    """Maintains `daily_rollups`: counts and booked minutes per (clinic, date, doctor, treatment, status).
+
+    Rollups are adjusted with $inc deltas from the rows each sync actually changed
+    and from status overrides, so reports never need to scan raw appointments.
+    Each instance reads and writes one clinic's buckets only.
+    """
+
+    def __init__(self, mongo, minutes_fn: Callable[[Dict], int], clinic_id: str):
+        self.mongo = mongo
+        self.minutes_fn = minutes_fn
+        self.clinic_id = clinic_id
+
+    @property
+    def collection(self):
+        return self.mongo.db.get_collection('daily_rollups')
+
+    def key(self, doc: Dict, status: Optional[str] = None) -> Optional[RollupKey]:
+        if not doc.get('date') or doc.get('quarantined'):
+            return None
+        return (doc['date'], doc.get('doctor') or '', doc.get('treatment') or '', status or doc.get('status') or 'pending')
+
+    def deltas(self, removed: Iterable[Tuple[Dict, str]], added: Iterable[Tuple[Dict, str]]) -> Dict[RollupKey, List[int]]:
+        """Net [count, minutes] change per key for (doc, effective status) pairs"""
+        out: Dict[RollupKey, List[int]] = defaultdict(lambda: [0, 0])
+        for sign, pairs in ((-1, removed), (1, added)):
+            for doc, status in pairs:
+                k = self.key(doc, status)
+                if k is None:
+                    continue
+                out[k][0] += sign
+                out[k][1] += sign * self.minutes_fn(doc)
+        return {k: v for k, v in out.items() if v[0] or v[1]}
+
+    async def apply(self, removed: Iterable[Tuple[Dict, str]], added: Iterable[Tuple[Dict, str]]) -> int:
+        changes = self.deltas(removed, added)
+        if not changes:
+            return 0
+        now = datetime.utcnow()
+        ops = [
+            UpdateOne(
+                {"clinic_id": self.clinic_id, "date": k[0], "doctor": k[1], "treatment": k[2], "status": k[3]},
+                {"$inc": {"count": c, "booked_minutes": m}, "$set": {"updated_at": now}},
+                upsert=True
+            )
+            for k, (c, m) in changes.items()
+        ]
+        await self.collection.bulk_write(ops, ordered=False)
+        # Only buckets this apply decremented can have emptied; each is one point read on the bucket index
+        emptied = [
+            {"date": k[0], "doctor": k[1], "treatment": k[2], "status": k[3]}
+            for k, (c, _) in changes.items() if c < 0
+        ]
+        if emptied:
+            await self.collection.delete_many({"clinic_id": self.clinic_id, "$or": emptied, "count": {"$lte": 0}})
+        return len(ops)
+
+    async def is_empty(self) -> bool:
+        return await self.collection.find_one({"clinic_id": self.clinic_id}, {"_id": 1}) is None
+
+    async def rebuild(self, pairs: List[Tuple[Dict, str]]) -> int:
+        """Recompute every rollup from (appointment, effective status) pairs (initial load or repair)"""
+        await self.collection.delete_many({"clinic_id": self.clinic_id})
+        applied = await self.apply([], pairs)
+        logger.info(f"Rebuilt daily rollups of clinic {self.clinic_id} from {len(pairs)} appointments ({applied} buckets)")
+        return applied
+
+    async def report(self, start_date: Optional[str], end_date: Optional[str], by: str = 'day') -> List[Dict]:
+        match: Dict = {"clinic_id": self.clinic_id}
+        if start_date or end_date:
+            match["date"] = {}
+            if start_date:
+                match["date"]["$gte"] = start_date
+            if end_date:
+                match["date"]["$lte"] = end_date
+        group_key = {
+            'day': "$date",
+            'month': {"$substrCP": ["$date", 0, 7]},
+            'doctor': "$doctor",
+            'treatment': "$treatment",
+            'status': "$status",
+        }[by]
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": group_key,
+                "total": {"$sum": "$count"},
+                "cancelled": {"$sum": {"$cond": [{"$eq": ["$status", "cancelled"]}, "$count", 0]}},
+                "completed": {"$sum": {"$cond": [{"$eq": ["$status", "completed"]}, "$count", 0]}},
+                "booked_minutes": {"$sum": {"$cond": [{"$eq": ["$status", "cancelled"]}, 0, "$booked_minutes"]}},
+            }},
+            {"$sort": {"_id": 1}},
+        ]
+        rows = await self.collection.aggregate(pipeline).to_list(length=None)
+        return [{"key": r["_id"], **{k: v for k, v in r.items() if k != "_id"}} for r in rows]
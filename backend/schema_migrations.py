@@ -0,0 +1,165 @@
+"""Backfills: the canonical appointment schema (starts_at, duration_minutes, quarantine
+flag), the clinic_id partition key and the patient_key of appointments.
+
+Run once after deploying, or let the API run them at startup; they only touch
+documents whose schema_version is older than the current one, or that have no
+clinic_id or patient_key yet.
+
+    python schema_migrations.py
+"""
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict
+
+from pymongo import UpdateOne
+
+from appointments_service import SCHEMA_VERSION, row_hash
+from archive_service import as_utc
+from db_indexes import drop_obsolete_indexes
+from patient_identity import make_patient_key
+from repositories import ARCHIVE_COLLECTION, as_object_id
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+async def migrate_canonical_schema(db, sheets_service) -> Dict:
+    """Recompute typed fields from the stored date/time/duration strings"""
+    query = {"schema_version": {"$not": {"$gte": SCHEMA_VERSION}}}
+    migrated = quarantined = 0
+    ops = []
+    async for doc in db.appointments.find(query):
+        # Unparseable values were previously stored verbatim in date/time
+        date_str = doc.get('date_raw') or doc.get('date') or ''
+        time_str = doc.get('time_raw') or doc.get('time') or ''
+        fields = sheets_service.canonical_fields(date_str, time_str, doc.get('duration') or '')
+        doc.update(fields)
+        fields['row_hash'] = row_hash(doc)
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+        migrated += 1
+        quarantined += int(fields['quarantined'])
+        if len(ops) >= BATCH_SIZE:
+            await db.appointments.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db.appointments.bulk_write(ops, ordered=False)
+    if migrated:
+        sheets_service.generation += 1
+        sheets_service.data_generation += 1
+        logger.info(f"Migrated {migrated} appointments to schema v{SCHEMA_VERSION} ({quarantined} quarantined)")
+    return {"migrated": migrated, "quarantined": quarantined, "schema_version": SCHEMA_VERSION}
+
+
+async def _tag_appointments(collection, clinic_of_source: Dict[str, str], default_clinic: str) -> int:
+    """Tag rows by their source's clinic; the row hash covers clinic_id, so it is recomputed"""
+    tagged = 0
+    ops = []
+    async for doc in collection.find({"clinic_id": {"$exists": False}}):
+        doc['clinic_id'] = clinic_of_source.get(doc.get('source_id'), default_clinic)
+        if doc.get('starts_at') is not None:
+            # Hashed as parsed rows carry it (tz-aware), or every row would look changed to the next sync
+            doc['starts_at'] = as_utc(doc['starts_at'])
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"clinic_id": doc['clinic_id'], "row_hash": row_hash(doc)}}))
+        tagged += 1
+        if len(ops) >= BATCH_SIZE:
+            await collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await collection.bulk_write(ops, ordered=False)
+    return tagged
+
+
+async def _tag_overrides(db, default_clinic: str) -> int:
+    """Overrides follow the clinic of their appointment, hot or archived"""
+    tagged = 0
+    cursor = db.appointment_overrides.find({"clinic_id": {"$exists": False}}, {"appointment_id": 1})
+    while True:
+        batch = await cursor.to_list(length=BATCH_SIZE)
+        if not batch:
+            break
+        ids = [as_object_id(doc["appointment_id"]) for doc in batch]
+        clinic_of = {}
+        for collection in (db.appointments, db[ARCHIVE_COLLECTION]):
+            async for doc in collection.find({"_id": {"$in": ids}}, {"clinic_id": 1}):
+                clinic_of[str(doc["_id"])] = doc.get("clinic_id")
+        await db.appointment_overrides.bulk_write([
+            UpdateOne({"_id": doc["_id"]}, {"$set": {"clinic_id": clinic_of.get(doc["appointment_id"]) or default_clinic}})
+            for doc in batch
+        ], ordered=False)
+        tagged += len(batch)
+    return tagged
+
+
+async def migrate_clinic_partitions(db, clinics) -> Dict:
+    """Tag everything stored before clinic partitioning with its clinic_id.
+
+    Appointments (hot and archived) take the clinic of their sheet source, overrides
+    that of their appointment, manual patients the default clinic. Identity clusters
+    and rollups are derived data: untagged ones are dropped and each clinic rebuilds
+    its own. The pre-partitioning unique indexes are dropped first, since they would
+    reject the same patient key or rollup bucket in a second clinic.
+    """
+    untagged = {"clinic_id": {"$exists": False}}
+    if await db.appointments.find_one(untagged, {"_id": 1}) is None and \
+            await db.appointment_overrides.find_one(untagged, {"_id": 1}) is None and \
+            await db.patients.find_one(untagged, {"_id": 1}) is None:
+        return {"tagged": 0}
+    await drop_obsolete_indexes(db)
+    clinic_of_source = clinics.source_clinics()
+    result = {
+        "appointments": await _tag_appointments(db.appointments, clinic_of_source, clinics.default_id),
+        "archived": await _tag_appointments(db[ARCHIVE_COLLECTION], clinic_of_source, clinics.default_id),
+        # After the appointments, so each override can take its appointment's clinic
+        "overrides": await _tag_overrides(db, clinics.default_id),
+        "patients": (await db.patients.update_many(untagged, {"$set": {"clinic_id": clinics.default_id}})).modified_count,
+        "identities_dropped": (await db.patient_identities.delete_many(untagged)).deleted_count,
+        "rollups_dropped": (await db.daily_rollups.delete_many(untagged)).deleted_count,
+    }
+    result["tagged"] = result["appointments"] + result["archived"] + result["overrides"] + result["patients"]
+    logger.info(f"Tagged stored data with clinic ids: {result}")
+    return result
+
+
+async def migrate_patient_keys(db) -> Dict:
+    """Store the patient key on appointments synced before it was, for the patient history index"""
+    result = {}
+    for name in ('appointments', ARCHIVE_COLLECTION):
+        collection = db[name]
+        keyed = 0
+        ops = []
+        fields = {"num_paciente": 1, "patient_name": 1, "phone": 1}
+        async for doc in collection.find({"patient_key": {"$exists": False}}, fields):
+            key = make_patient_key(doc.get('num_paciente') or '', doc.get('patient_name') or '', doc.get('phone') or '')
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"patient_key": key}}))
+            keyed += 1
+            if len(ops) >= BATCH_SIZE:
+                await collection.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            await collection.bulk_write(ops, ordered=False)
+        result[name] = keyed
+    if any(result.values()):
+        logger.info(f"Stored patient keys on appointments: {result}")
+    return result
+
+
+async def main():
+    from dotenv import load_dotenv
+    from mongo_client import MongoClientProvider
+
+    load_dotenv(Path(__file__).parent / '.env')
+    from clinics import ClinicRegistry
+
+    mongo = MongoClientProvider()
+    clinics = ClinicRegistry(mongo)
+    print(await migrate_canonical_schema(mongo.db, clinics.default))
+    print(await migrate_clinic_partitions(mongo.db, clinics))
+    print(await migrate_patient_keys(mongo.db))
+    mongo.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
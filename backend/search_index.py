@@ -0,0 +1,263 @@
+import bisect
+import heapq
+from array import array
+import logging
+import os
+import re
+import time
+import unicodedata
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Searchable appointment fields and how much a match in each counts
+FIELD_BOOSTS = {"patient_name": 3.0, "treatment": 2.0, "notes": 1.0, "doctor": 1.0}
+SEARCH_PROJECTION = {"_id": 1, "starts_at": 1, **{field: 1 for field in FIELD_BOOSTS}}
+# A term matching only as a prefix ("revis" -> "revision") scores this share of an exact match
+PREFIX_WEIGHT = 0.5
+MIN_PREFIX_LENGTH = 2
+MAX_PREFIX_EXPANSIONS = int(os.environ.get('SEARCH_MAX_PREFIX_EXPANSIONS', '200'))
+
+
+def fold_tokens(text: str) -> List[str]:
+    """Accent-folded, lower-cased word tokens ("Revisión" -> "revision")"""
+    if not text:
+        return []
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+    return [t for t in re.split(r"[^a-z0-9]+", folded) if t]
+
+
+def sort_key(starts_at: Optional[datetime]) -> float:
+    """Posting order: most recent first, undated rows last (naive datetimes are UTC, as stored)"""
+    if not starts_at:
+        return float('inf')
+    if starts_at.tzinfo is None:
+        starts_at = starts_at.replace(tzinfo=timezone.utc)
+    return -starts_at.timestamp()
+
+
+class PostingList:
+    """Appointment ids in date order, with their sort keys in a parallel packed array"""
+
+    __slots__ = ('keys', 'ids')
+
+    def __init__(self, entries: Optional[List[Tuple[float, str]]] = None):
+        entries = sorted(entries or ())
+        self.keys = array('d', (key for key, _ in entries))
+        self.ids = [appointment_id for _, appointment_id in entries]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, key: float, appointment_id: str):
+        i = bisect.bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.ids.insert(i, appointment_id)
+
+    def remove(self, key: float, appointment_id: str):
+        i = bisect.bisect_left(self.keys, key)
+        while i < len(self.ids) and self.keys[i] == key:
+            if self.ids[i] == appointment_id:
+                del self.keys[i]
+                del self.ids[i]
+                return
+            i += 1
+
+    def entries(self):
+        return zip(self.keys, self.ids)
+
+
+class AppointmentSearchIndex:
+    """In-process inverted index over appointment text.
+
+    Each accent-folded token maps to posting lists of appointment ids sorted most
+    recent first, one list per weight (the summed boosts of the fields the token
+    appears in), so a single-term page is read straight off the lists in score and
+    date order. The index is built from one scan and then follows the sync diffs;
+    removing an appointment is a bisect into each of its tokens' lists.
+
+    Every query term is a prefix match against a sorted vocabulary. Matching ids are
+    combined with set operations; scoring in Python only happens for the page of a
+    single-term query, or for the (already narrowed) matches of a multi-term one.
+    """
+
+    def __init__(self):
+        self.docs: Dict[str, Tuple[float, Dict[str, float]]] = {}
+        self.postings: Dict[str, Dict[float, PostingList]] = {}
+        self.vocabulary: List[str] = []
+        self.built = False
+        self.generation: Optional[int] = None
+        self.query_time = REGISTRY.histogram('search.query_ms')
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    @staticmethod
+    def weights(doc: Dict) -> Dict[str, float]:
+        weights: Dict[str, float] = {}
+        for field, boost in FIELD_BOOSTS.items():
+            for token in set(fold_tokens(doc.get(field))):
+                weights[token] = weights.get(token, 0.0) + boost
+        return weights
+
+    # ---- maintenance ----
+    def build(self, docs: Iterable[Dict], generation: Optional[int] = None):
+        started = time.perf_counter()
+        self.docs = {}
+        grouped: Dict[str, Dict[float, List[Tuple[float, str]]]] = {}
+        for doc in docs:
+            if doc.get('quarantined'):
+                continue
+            appointment_id = str(doc['_id'])
+            key = sort_key(doc.get('starts_at'))
+            weights = self.weights(doc)
+            self.docs[appointment_id] = (key, weights)
+            for token, weight in weights.items():
+                grouped.setdefault(token, {}).setdefault(weight, []).append((key, appointment_id))
+        self.postings = {
+            token: {weight: PostingList(entries) for weight, entries in by_weight.items()}
+            for token, by_weight in grouped.items()
+        }
+        self.vocabulary = sorted(self.postings)
+        self.built = True
+        self.generation = generation
+        logger.info(f"Search index built over {len(self.docs)} appointments, {len(self.vocabulary)} terms "
+                    f"in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    def _drop(self, appointment_id: str):
+        entry = self.docs.pop(appointment_id, None)
+        if entry is None:
+            return
+        key, weights = entry
+        for token, weight in weights.items():
+            by_weight = self.postings.get(token, {})
+            postings = by_weight.get(weight)
+            if postings is None:
+                continue
+            postings.remove(key, appointment_id)
+            if not postings:
+                del by_weight[weight]
+                if not by_weight:
+                    del self.postings[token]
+                    i = bisect.bisect_left(self.vocabulary, token)
+                    if i < len(self.vocabulary) and self.vocabulary[i] == token:
+                        del self.vocabulary[i]
+
+    def _add(self, doc: Dict):
+        appointment_id = str(doc['_id'])
+        self._drop(appointment_id)
+        if doc.get('quarantined'):
+            return
+        key = sort_key(doc.get('starts_at'))
+        weights = self.weights(doc)
+        self.docs[appointment_id] = (key, weights)
+        for token, weight in weights.items():
+            by_weight = self.postings.get(token)
+            if by_weight is None:
+                by_weight = self.postings[token] = {}
+                bisect.insort(self.vocabulary, token)
+            postings = by_weight.get(weight)
+            if postings is None:
+                by_weight[weight] = PostingList([(key, appointment_id)])
+            else:
+                postings.add(key, appointment_id)
+
+    def apply_diff(self, added: List[Dict], updated: List[Dict], removed: List[Dict], generation: Optional[int] = None):
+        for doc in removed:
+            self._drop(str(doc['_id']))
+        for doc in updated + added:
+            self._add(doc)
+        self.generation = generation
+
+    # ---- queries ----
+    def expand(self, term: str) -> List[str]:
+        """Vocabulary tokens starting with `term` (just `term` when it is too short to expand)"""
+        if len(term) < MIN_PREFIX_LENGTH:
+            return [term] if term in self.postings else []
+        start = bisect.bisect_left(self.vocabulary, term)
+        matches = []
+        for token in self.vocabulary[start:start + MAX_PREFIX_EXPANSIONS]:
+            if not token.startswith(term):
+                break
+            matches.append(token)
+        return matches
+
+    def term_score(self, term: str, expansions: List[str], weights: Dict[str, float]) -> float:
+        """Best weight of `term` in one appointment: exact match, else a prefix match at PREFIX_WEIGHT"""
+        exact = weights.get(term)
+        if exact is not None:
+            return exact
+        if len(expansions) <= len(weights):
+            found = [weights[token] for token in expansions if token in weights]
+        else:
+            found = [w for token, w in weights.items() if token.startswith(term)]
+        return max(found, default=0.0) * PREFIX_WEIGHT
+
+    def _lists(self, term: str, expansions: List[str]) -> List[Tuple[float, PostingList]]:
+        """(score, posting list) for every weight group of every expansion of `term`"""
+        return [
+            (weight * (1.0 if token == term else PREFIX_WEIGHT), postings)
+            for token in expansions for weight, postings in self.postings[token].items()
+        ]
+
+    def _single_term_page(self, lists: List[Tuple[float, PostingList]], wanted: int, order: str) -> List[Tuple[str, float]]:
+        """Top `wanted` ids for one term without scoring every match: lists are merged in
+        date order, by descending score level for relevance, and the first hit of an id
+        (its best score) is kept"""
+        if order == 'date':
+            levels = [lists]
+        else:
+            by_score: Dict[float, List] = {}
+            for score, postings in lists:
+                by_score.setdefault(score, []).append((score, postings))
+            levels = [by_score[score] for score in sorted(by_score, reverse=True)]
+        page, seen = [], set()
+        for level in levels:
+            merged = heapq.merge(*(((key, i, score) for key, i in postings.entries()) for score, postings in level))
+            for _, appointment_id, score in merged:
+                if appointment_id in seen:
+                    continue
+                seen.add(appointment_id)
+                page.append((appointment_id, score))
+                if len(page) >= wanted:
+                    return page
+        return page
+
+    def search(self, query: str, offset: int = 0, limit: int = 20, order: str = 'relevance') -> Tuple[int, List[Tuple[str, float]]]:
+        """(total matches, [(appointment_id, score)] for the requested page); every term must match"""
+        started = time.perf_counter()
+        terms = list(dict.fromkeys(fold_tokens(query)))
+        if not terms:
+            return 0, []
+        expansions = {term: self.expand(term) for term in terms}
+        lists = {term: self._lists(term, expansions[term]) for term in terms}
+        matches = sorted((set().union(*(p.ids for _, p in lists[term])) for term in terms), key=len)
+        matched = matches[0].intersection(*matches[1:]) if len(matches) > 1 else matches[0]
+        wanted = offset + limit
+        if len(terms) == 1:
+            # For date order, a prefix-only hit must still report its best score
+            page = self._single_term_page(lists[terms[0]], wanted, order)
+            if order == 'date':
+                page = [(i, self.term_score(terms[0], expansions[terms[0]], self.docs[i][1])) for i, _ in page]
+        else:
+            scored = []
+            for appointment_id in matched:
+                key, weights = self.docs[appointment_id]
+                score = sum(self.term_score(term, expansions[term], weights) for term in terms)
+                scored.append((key if order == 'date' else (-score, key), appointment_id, score))
+            page = [(appointment_id, score) for _, appointment_id, score in heapq.nsmallest(wanted, scored)]
+        self.query_time.observe((time.perf_counter() - started) * 1000)
+        return len(matched), [(appointment_id, round(score, 3)) for appointment_id, score in page[offset:]]
+
+    def stats(self) -> Dict:
+        return {
+            "built": self.built,
+            "generation": self.generation,
+            "appointments": len(self.docs),
+            "terms": len(self.vocabulary),
+            "postings": sum(len(p) for by_weight in self.postings.values() for p in by_weight.values()),
+        }
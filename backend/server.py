@@ -1,7 +1,8 @@
 from fastapi import FastAPI, APIRouter
+import asyncio
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from contextlib import asynccontextmanager
 import os
 import logging
 from pathlib import Path
@@ -9,19 +10,90 @@ from pydantic import BaseModel, Field
 from typing import List
 import uuid
 from datetime import datetime
-import asyncio
-from appointments_service import create_appointments_router, create_patients_router
+from appointments_service import GoogleSheetsService, create_appointments_router, create_patients_router
+from analytics_service import create_analytics_router
+from health import create_health_router
+from lifecycle import BackgroundTasks
+from schema_migrations import migrate_canonical_schema, migrate_clinic_partitions, migrate_patient_keys
+from db_indexes import ensure_indexes
+from mongo_client import MongoClientProvider
+from clinics import ClinicRegistry
+from metrics import REGISTRY, TimingMiddleware
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Single MongoDB client shared by every router; the connection pool opens on first use
+mongo = MongoClientProvider()
+# One partition per clinic in SHEET_SOURCES, each with its own storage (REPOSITORY_BACKEND=mongo|cached|memory)
+clinics = ClinicRegistry(mongo)
+# Startup work and long-running loops, tracked for readiness and cancelled on shutdown
+background = BackgroundTasks()
+
+async def warm_up_clinic(service: GoogleSheetsService) -> dict:
+    """One clinic's cache warmup and first sync, then its sync loop"""
+    step = lambda name: background.progress('warmup', **{f"clinic.{service.clinic_id}": name})
+    try:
+        if service.repos.uses_mongo:
+            step('cache_warmup')
+            await service.repos.warm()
+        step('snapshot_restore')
+        await service.restore_snapshots()
+        step('initial_sync')
+        result = await service.sync_appointments()
+    finally:
+        # The sync loop starts even when the first sync failed; it retries on its own
+        await appointments_router.start_background_sync(background, service, initial_sync=False)
+        logger.info(f"Background sync of clinic {service.clinic_id} started")
+    # Search builds its index lazily anyway; prebuilding it must not hold back readiness
+    background.start(f'search_index:{service.clinic_id}', service.ensure_search_index())
+    step('done')
+    return {k: result.get(k) for k in ("success", "synced", "added", "updated", "removed")}
+
+async def warm_up() -> dict:
+    """Schema migrations, then every clinic's warmup and first sync side by side"""
+    step = lambda name: background.progress('warmup', step=name)
+    if clinics.uses_mongo:
+        step('schema_migration')
+        try:
+            background.progress('warmup', migration=await migrate_canonical_schema(mongo.db, clinics.default))
+            background.progress('warmup', clinic_partitions=await migrate_clinic_partitions(mongo.db, clinics))
+            background.progress('warmup', patient_keys=await migrate_patient_keys(mongo.db))
+        except Exception as e:
+            logger.error(f"Schema migration failed: {e}")
+    step('clinics')
+    # A clinic whose warmup fails does not hold the others back
+    results = await asyncio.gather(*(warm_up_clinic(service) for service in clinics), return_exceptions=True)
+    initial_sync = {
+        service.clinic_id: {"error": str(r)} if isinstance(r, Exception) else r
+        for service, r in zip(clinics, results)
+    }
+    background.progress('warmup', initial_sync=initial_sync)
+    crashed = [service.clinic_id for service, r in zip(clinics, results) if isinstance(r, Exception)]
+    if crashed:
+        # Fails the required warmup task: the instance stays not ready instead of serving cold caches
+        raise RuntimeError(f"Warmup failed for clinic(s): {', '.join(crashed)}")
+    return {"step": "done", "initial_sync": initial_sync}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start background work and return at once; cancel and await it on shutdown"""
+    logger.info("Starting Rubio García Dental Portal API")
+    health_router.lag_monitor.start()
+    logger.info(f"Initializing Google Sheets sync ({clinics.default.repos.backend} repositories)...")
+    if clinics.uses_mongo:
+        # Index builds run in the background from the declarative registry in db_indexes
+        background.start('indexes', ensure_indexes(mongo.db, lambda **p: background.progress('indexes', **p)))
+    background.start('warmup', warm_up(), required=True)
+    yield
+    await background.shutdown()
+    await clinics.close()
+    await health_router.lag_monitor.stop()
+    mongo.close()
+    logger.info("Background tasks stopped and database connection closed")
 
 # Create the main app without a prefix
-app = FastAPI(title="Rubio García Dental Portal API")
+app = FastAPI(title="Rubio García Dental Portal API", lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -45,31 +117,42 @@ async def root():
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.dict()
     status_obj = StatusCheck(**status_dict)
-    _ = await db.status_checks.insert_one(status_obj.dict())
+    _ = await mongo.db.status_checks.insert_one(status_obj.dict())
     return status_obj
 
 @api_router.get("/status", response_model=List[StatusCheck])
 async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
+    status_checks = await mongo.db.status_checks.find().to_list(1000)
     return [StatusCheck(**status_check) for status_check in status_checks]
 
-@api_router.get("/health")
-async def health_check():
+@api_router.get("/metrics")
+async def get_metrics():
     return {
-        "status": "healthy",
-        "database": "connected",
-        "google_sheets_sync": "active",
+        "mongo_pool": mongo.pool_stats(),
+        "http": REGISTRY.snapshot('http.'),
+        "mongo": REGISTRY.snapshot('mongo.command.'),
+        "admission": {"routes": clinics.admission.describe(), **REGISTRY.snapshot('admission.')},
+        "slow_queries": mongo.slow_queries.recent(20),
+        "slow_query_threshold_ms": mongo.slow_queries.threshold_ms,
         "timestamp": datetime.utcnow().isoformat()
     }
 
+@api_router.get("/metrics/slow-queries")
+async def get_slow_queries(limit: int = 50):
+    return {"threshold_ms": mongo.slow_queries.threshold_ms, "entries": mongo.slow_queries.recent(limit)}
+
 # Include the router in the main app
 app.include_router(api_router)
 
 # Include appointments and patients routers
-appointments_router = create_appointments_router(client)
-patients_router = create_patients_router(client)
+appointments_router = create_appointments_router(mongo, clinics)
+patients_router = create_patients_router(mongo, clinics)
+analytics_router = create_analytics_router(clinics)
+health_router = create_health_router(mongo, clinics, background)
 app.include_router(appointments_router)
 app.include_router(patients_router)
+app.include_router(analytics_router)
+app.include_router(health_router)
 
 app.add_middleware(
     CORSMiddleware,
@@ -78,6 +161,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(TimingMiddleware)
 
 # Configure logging
 logging.basicConfig(
@@ -85,29 +169,3 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
-
-@app.on_event("startup")
-async def startup_event():
-    """Initialize background tasks on startup"""
-    logger.info("Starting Rubio García Dental Portal API")
-    logger.info("Initializing Google Sheets sync...")
-    
-    # Create indexes for performance on large collections
-    try:
-        await db.appointments.create_index([("date", 1), ("time", 1)])
-        await db.appointments.create_index([("status", 1)])
-        await db.patients.create_index([("key", 1)], unique=True)
-        await db.patients.create_index([("num_paciente", 1)])
-        await db.patients.create_index([("phone", 1)])
-        logger.info("MongoDB indexes ensured for appointments and patients")
-    except Exception as e:
-        logger.error(f"Failed to ensure MongoDB indexes: {e}")
-
-    # Start background sync task
-    await appointments_router.start_background_sync()
-    logger.info("Background sync task started")
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
-    logger.info("Database connection closed")
\ No newline at end of file
@@ -0,0 +1,496 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional
+
+import aiohttp
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHEET_URL = "https://docs.google.com/spreadsheets/d/1MBDBHQ08XGuf5LxVHCFhHDagIazFkpBnxwqyEQIBJrQ/export?format=csv&gid=0"
+DEFAULT_FALLBACK_SHEET_URL = "https://docs.google.com/spreadsheets/d/1MBDBHQ08XGuf5LxVHCFhHDagIazFkpBnxwqyEQIBJrQ/export?format=csv"
+SHEET_EXPORT_URL = "https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid}"
+DEFAULT_SOURCE_ID = 'default'
+# Partition key of sources configured without a clinic (single-clinic deployments)
+DEFAULT_CLINIC_ID = os.environ.get('DEFAULT_CLINIC_ID', 'default')
+CONNECT_TIMEOUT_SECONDS = 5
+# Runtime state, kept out of the code tree: $XDG_STATE_HOME (default ~/.local/state)/rubio_garcia/sheet_snapshots
+DEFAULT_SNAPSHOT_DIR = Path(os.environ.get('XDG_STATE_HOME') or Path.home() / '.local' / 'state') / 'rubio_garcia' / 'sheet_snapshots'
+
+
+class CircuitBreaker:
+    """Stops calling an endpoint after `failure_threshold` consecutive failures.
+
+    Once `reset_seconds` have passed a single trial call is let through
+    (half-open); its outcome closes the breaker again or re-opens it.
+    """
+
+    def __init__(self, name: str, failure_threshold: Optional[int] = None, reset_seconds: Optional[float] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or int(os.environ.get('SHEET_BREAKER_FAILURES', '3'))
+        self.reset_seconds = reset_seconds or float(os.environ.get('SHEET_BREAKER_RESET_SECONDS', '60'))
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if time.monotonic() - self.opened_at >= self.reset_seconds else 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_in_flight or (self.opened_at is None and self.failures >= self.failure_threshold):
+            if self.opened_at is None:
+                logger.warning(f"Circuit for {self.name} opened after {self.failures} consecutive failures")
+                REGISTRY.counter('sheet_source.circuit_opened').inc()
+            self.opened_at = time.monotonic()
+        self.trial_in_flight = False
+
+    def describe(self) -> Dict:
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+
+class SheetSnapshot:
+    def __init__(self, text: str, meta: Dict):
+        self.text = text
+        self.meta = meta
+
+    @property
+    def age_seconds(self) -> float:
+        return (datetime.utcnow() - datetime.fromisoformat(self.meta["saved_at"])).total_seconds()
+
+
+class SheetSnapshotStore:
+    """Last successfully fetched CSV per source, gzip-compressed on local disk.
+
+    Each snapshot is `<source>.csv.gz` plus `<source>.json` holding its SHA-256
+    digest, the URL it was fetched for, CSV headers, row count and save time. Both
+    are written to a temp file and renamed into place. A snapshot whose digest does
+    not match, or that was saved for another URL, is ignored.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self._digests: Dict[str, str] = {}
+
+    @classmethod
+    def from_env(cls) -> Optional["SheetSnapshotStore"]:
+        """SHEET_SNAPSHOT_DIR (default DEFAULT_SNAPSHOT_DIR); SHEET_SNAPSHOTS=0 disables"""
+        if os.environ.get('SHEET_SNAPSHOTS', '1').lower() in ('0', 'false', 'no'):
+            return None
+        return cls(Path(os.environ.get('SHEET_SNAPSHOT_DIR', str(DEFAULT_SNAPSHOT_DIR))))
+
+    def _paths(self, source_id: str):
+        stem = re.sub(r'[^A-Za-z0-9_.-]', '_', source_id)
+        return self.directory / f"{stem}.csv.gz", self.directory / f"{stem}.json"
+
+    def exists(self, source_id: str) -> bool:
+        return all(p.exists() for p in self._paths(source_id))
+
+    def _write(self, path: Path, data: bytes):
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def _save(self, source_id: str, url: str, text: str, headers: List[str], rows: int) -> bool:
+        raw = text.encode('utf-8')
+        digest = hashlib.sha256(raw).hexdigest()
+        if self._digests.get(source_id) == digest:
+            return False
+        data_path, meta_path = self._paths(source_id)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        compressed = gzip.compress(raw, compresslevel=5)
+        self._write(data_path, compressed)
+        meta = {
+            "source_id": source_id,
+            "url": url,
+            "digest": digest,
+            "saved_at": datetime.utcnow().isoformat(),
+            "bytes": len(raw),
+            "compressed_bytes": len(compressed),
+            "headers": headers,
+            "rows": rows,
+        }
+        self._write(meta_path, json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+        self._digests[source_id] = digest
+        return True
+
+    def _load(self, source_id: str, url: str) -> Optional[SheetSnapshot]:
+        data_path, meta_path = self._paths(source_id)
+        try:
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+            raw = gzip.decompress(data_path.read_bytes())
+        except (OSError, ValueError, EOFError) as e:
+            logger.warning(f"Unreadable sheet snapshot for {source_id}: {str(e)}")
+            return None
+        if meta.get("url") != url:
+            logger.warning(f"Sheet snapshot for {source_id} was saved for another URL ({meta.get('url')}); ignoring it")
+            return None
+        if hashlib.sha256(raw).hexdigest() != meta.get("digest"):
+            logger.warning(f"Sheet snapshot for {source_id} does not match its digest; ignoring it")
+            return None
+        self._digests[source_id] = meta["digest"]
+        return SheetSnapshot(raw.decode('utf-8'), meta)
+
+    async def save(self, source_id: str, url: str, text: str, headers: List[str], rows: int) -> bool:
+        """Persist `text` fetched for `url` unless it is what was saved last; returns whether it was written"""
+        try:
+            return await asyncio.to_thread(self._save, source_id, url, text, headers, rows)
+        except OSError as e:
+            logger.error(f"Could not write sheet snapshot for {source_id}: {str(e)}")
+            return False
+
+    async def load(self, source_id: str, url: str) -> Optional[SheetSnapshot]:
+        """The snapshot of `source_id`, if there is a valid one saved for `url`"""
+        return await asyncio.to_thread(self._load, source_id, url)
+
+
+class SheetSource:
+    """Where the appointments CSV comes from.
+
+    `fetch` returns the current CSV text, or None when the source is unavailable.
+    Sources that can tell when their content changes also implement `watch`,
+    which yields once per change; the others are polled on the sync interval.
+    Every source has an id its rows are tagged and reconciled by, the clinic its
+    rows belong to, a fetch timeout and optionally its own sync interval.
+    """
+
+    kind = 'source'
+    watchable = False
+    # Whether the last good CSV is worth keeping on disk (a local file already is)
+    snapshot = True
+    # Where the CSV is read from; a disk snapshot is only restored for the same location
+    location = ''
+
+    def __init__(self, source_id: str = DEFAULT_SOURCE_ID, clinic_id: Optional[str] = None,
+                 timeout_seconds: Optional[float] = None, sync_interval_minutes: Optional[float] = None):
+        self.source_id = source_id
+        self.clinic_id = clinic_id or DEFAULT_CLINIC_ID
+        self.timeout_seconds = timeout_seconds or float(os.environ.get('SHEET_FETCH_TIMEOUT_SECONDS', '30'))
+        self.sync_interval_minutes = sync_interval_minutes
+
+    async def fetch(self) -> Optional[str]:
+        raise NotImplementedError
+
+    async def watch(self) -> AsyncIterator[None]:
+        raise NotImplementedError
+        yield
+
+    def invalidate(self):
+        """Make the next fetch read the source in full; for sources that read incrementally"""
+
+    def describe(self) -> Dict:
+        return {"id": self.source_id, "clinic_id": self.clinic_id, "type": self.kind,
+                "sync_interval_minutes": self.sync_interval_minutes}
+
+    async def close(self):
+        pass
+
+
+class SheetHttpClient:
+    """One pooled keep-alive aiohttp session shared by every HTTP source"""
+
+    def __init__(self, limit: Optional[int] = None, limit_per_host: Optional[int] = None):
+        self.limit = limit or int(os.environ.get('SHEET_HTTP_POOL_SIZE', '20'))
+        self.limit_per_host = limit_per_host or int(os.environ.get('SHEET_HTTP_POOL_PER_HOST', '8'))
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class HttpSheetSource(SheetSource):
+    """Google Sheets CSV export, retried on the fallback URL (no gid: first tab) when the primary fails.
+
+    Each URL sits behind its own circuit breaker, and the two requests share the
+    source's timeout so a fetch never takes longer than `timeout_seconds`.
+    """
+
+    kind = 'http'
+
+    def __init__(self, url: str, fallback_url: Optional[str] = None, http: Optional[SheetHttpClient] = None, **tags):
+        super().__init__(**tags)
+        self.url = url
+        self.location = url
+        self.fallback_url = fallback_url
+        self.http = http or SheetHttpClient()
+        self.breakers = {url: CircuitBreaker(f"{self.source_id} primary")}
+        if fallback_url:
+            self.breakers[fallback_url] = CircuitBreaker(f"{self.source_id} fallback")
+
+    async def fetch(self) -> Optional[str]:
+        session = self.http.session()
+        per_request = self.timeout_seconds / len(self.breakers)
+        timeout = aiohttp.ClientTimeout(total=per_request, sock_connect=min(per_request, CONNECT_TIMEOUT_SECONDS))
+        for url, breaker in self.breakers.items():
+            if not breaker.allow():
+                continue
+            text = await self._get(session, url, breaker, timeout)
+            if text is not None:
+                return text
+        return None
+
+    async def _get(self, session: aiohttp.ClientSession, url: str, breaker: CircuitBreaker,
+                   timeout: aiohttp.ClientTimeout) -> Optional[str]:
+        ok = False
+        try:
+            async with session.get(url, timeout=timeout) as response:
+                if response.status != 200:
+                    logger.error(f"Failed to fetch sheet data for source {self.source_id}: HTTP {response.status}")
+                    return None
+                text = await response.text()
+                ok = True
+                return text
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error fetching sheet data for source {self.source_id}: {e.__class__.__name__} {str(e)}")
+            return None
+        finally:
+            # Also reached on cancellation, so a timed-out trial call re-opens the breaker
+            if ok:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+    def describe(self) -> Dict:
+        return {
+            **super().describe(),
+            "url": self.url,
+            "fallback_url": self.fallback_url,
+            "circuits": {name: b.describe() for name, b in zip(("primary", "fallback"), self.breakers.values())},
+        }
+
+    async def close(self):
+        # Idempotent, so sources sharing one client can each close it
+        await self.http.close()
+
+
+class FileCursor:
+    """Incremental reader for a CSV that the exporting program appends to.
+
+    Complete lines already read are kept in memory together with the file's
+    identity, size, mtime and a hash of those lines. A file that is untouched
+    since the last read is not read again, and one that has strictly grown while
+    its first bytes still hash to the lines held (a pure append) is read only past
+    them. Anything else is read again from the start: a replaced or truncated
+    file, one modified without growing (a row rewritten in place with the same
+    length, e.g. Confirmada -> Finalizada), and one that grew but changed earlier
+    on. `invalidate` forces the next read to be a full one. A trailing line
+    without its newline is returned but re-read next time, since the writer may
+    still be in the middle of it.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.identity = None
+        self.size = 0
+        self.mtime_ns = 0
+        self.data = bytearray()
+        self.digest = hashlib.blake2b()
+        self.full_reads = 0
+        self.last_bytes_read = 0
+
+    def invalidate(self):
+        self.identity = None
+
+    def read(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            identity = (st.st_dev, st.st_ino)
+            if identity == self.identity:
+                offset = len(self.data)
+                unchanged = st.st_size == self.size and st.st_mtime_ns == self.mtime_ns
+                if unchanged or (st.st_size > self.size and self._prefix_matches(f, offset)):
+                    f.seek(offset)
+                    chunk = f.read()
+                    self.size, self.mtime_ns = st.st_size, st.st_mtime_ns
+                    return self._advance(chunk)
+            self.identity = identity
+            self.size, self.mtime_ns = st.st_size, st.st_mtime_ns
+            self.data = bytearray()
+            self.digest = hashlib.blake2b()
+            self.full_reads += 1
+            f.seek(0)
+            return self._advance(f.read())
+
+    def _prefix_matches(self, f, length: int) -> bool:
+        """Whether the file's first `length` bytes are still the lines held"""
+        digest = hashlib.blake2b()
+        f.seek(0)
+        remaining = length
+        while remaining:
+            block = f.read(min(remaining, 1 << 20))
+            if not block:
+                return False
+            digest.update(block)
+            remaining -= len(block)
+        REGISTRY.counter('sheet_source.bytes_hashed').inc(length)
+        return digest.digest() == self.digest.digest()
+
+    def _advance(self, new: bytes) -> bytes:
+        self.last_bytes_read = len(new)
+        REGISTRY.counter('sheet_source.bytes_read').inc(len(new))
+        cut = new.rfind(b'\n') + 1
+        self.data += new[:cut]
+        self.digest.update(new[:cut])
+        return bytes(self.data) + new[cut:]
+
+
+class LocalFileSource(SheetSource):
+    """CSV exported to local disk by the practice-management software.
+
+    `path` is either the CSV itself or a directory, in which case the most
+    recently modified *.csv in it is used. Changes are picked up with watchfiles
+    and trigger a sync as soon as the writer settles (`debounce_ms`).
+    """
+
+    kind = 'file'
+    watchable = True
+    snapshot = False
+
+    def __init__(self, path: str, debounce_ms: Optional[int] = None, force_polling: Optional[bool] = None, **tags):
+        super().__init__(**tags)
+        self.path = Path(path)
+        self.debounce_ms = debounce_ms or int(os.environ.get('SHEET_WATCH_DEBOUNCE_MS', '200'))
+        if force_polling is None:
+            force_polling = os.environ.get('SHEET_WATCH_FORCE_POLLING', '').lower() in ('1', 'true', 'yes')
+        self.force_polling = force_polling
+        self.cursor: Optional[FileCursor] = None
+
+    def current_file(self) -> Optional[Path]:
+        if not self.path.is_dir():
+            return self.path if self.path.exists() else None
+        candidates = [p for p in self.path.glob('*.csv') if p.is_file()]
+        return max(candidates, key=lambda p: p.stat().st_mtime_ns) if candidates else None
+
+    def _read(self) -> Optional[bytes]:
+        target = self.current_file()
+        if target is None:
+            logger.error(f"Local sheet source not found: {self.path}")
+            return None
+        if self.cursor is None or self.cursor.path != target:
+            self.cursor = FileCursor(target)
+        return self.cursor.read()
+
+    def invalidate(self):
+        if self.cursor is not None:
+            self.cursor.invalidate()
+
+    async def fetch(self) -> Optional[str]:
+        try:
+            content = await asyncio.to_thread(self._read)
+        except OSError as e:
+            logger.error(f"Error reading local sheet {self.path}: {str(e)}")
+            return None
+        return content.decode('utf-8-sig', errors='replace') if content is not None else None
+
+    def _relevant(self, change, changed_path: str) -> bool:
+        changed = Path(changed_path)
+        if self.path.is_dir():
+            return changed.suffix.lower() == '.csv'
+        return changed.name == self.path.name
+
+    async def watch(self) -> AsyncIterator[None]:
+        from watchfiles import awatch
+
+        # Watching the parent catches exporters that write a temp file and rename it over the CSV
+        root = self.path if self.path.is_dir() else self.path.parent
+        logger.info(f"Watching {self.path} for changes (debounce {self.debounce_ms}ms)")
+        async for _ in awatch(root, watch_filter=self._relevant, debounce=self.debounce_ms, step=50,
+                              force_polling=self.force_polling, recursive=False):
+            yield
+
+    def describe(self) -> Dict:
+        cursor = self.cursor
+        return {
+            **super().describe(),
+            "path": str(self.path),
+            "file": str(cursor.path) if cursor else None,
+            "bytes_held": len(cursor.data) if cursor else 0,
+            "last_bytes_read": cursor.last_bytes_read if cursor else 0,
+            "full_reads": cursor.full_reads if cursor else 0,
+        }
+
+
+def source_from_config(config: Dict, http: Optional[SheetHttpClient] = None) -> SheetSource:
+    """One SHEET_SOURCES entry, e.g.
+    {"id": "centro-gab1", "clinic_id": "centro", "sheet_id": "1MBD...", "gid": "0", "timeout_seconds": 20}
+    {"id": "norte", "clinic_id": "norte", "type": "file", "path": "/exports/norte", "sync_interval_minutes": 2}
+    """
+    tags = {
+        "source_id": config["id"],
+        "clinic_id": config.get("clinic_id"),
+        "timeout_seconds": config.get("timeout_seconds"),
+        "sync_interval_minutes": config.get("sync_interval_minutes"),
+    }
+    kind = config.get("type", "http")
+    if kind == 'file':
+        return LocalFileSource(config["path"], **tags)
+    if kind != 'http':
+        raise ValueError(f"Unknown sheet source type {kind!r} for source {config['id']}")
+    url = config.get("url")
+    if not url:
+        url = SHEET_EXPORT_URL.format(sheet_id=config["sheet_id"], gid=config.get("gid", "0"))
+    return HttpSheetSource(url, config.get("fallback_url"), http=http, **tags)
+
+
+def create_sources_from_env() -> List[SheetSource]:
+    """SHEET_SOURCES (a JSON list, see source_from_config) configures several sheets or tabs
+    sharing one HTTP pool; without it the single source from create_source_from_env is used"""
+    raw = os.environ.get('SHEET_SOURCES')
+    if not raw:
+        return [create_source_from_env()]
+    http = SheetHttpClient()
+    sources = [source_from_config(config, http) for config in json.loads(raw)]
+    ids = [s.source_id for s in sources]
+    if not sources or len(set(ids)) != len(ids):
+        raise ValueError(f"SHEET_SOURCES needs at least one source and unique ids, got {ids}")
+    return sources
+
+
+def create_source_from_env() -> SheetSource:
+    """SHEET_SOURCE=http (default) reads GOOGLE_SHEET_URL; SHEET_SOURCE=file reads SHEET_SOURCE_PATH"""
+    kind = os.environ.get('SHEET_SOURCE', 'http')
+    if kind == 'file':
+        return LocalFileSource(os.environ['SHEET_SOURCE_PATH'])
+    if kind != 'http':
+        raise ValueError(f"Unknown SHEET_SOURCE {kind!r}; expected http or file")
+    return HttpSheetSource(
+        os.environ.get('GOOGLE_SHEET_URL', DEFAULT_SHEET_URL),
+        os.environ.get('GOOGLE_SHEET_FALLBACK_URL', DEFAULT_FALLBACK_SHEET_URL)
+    )
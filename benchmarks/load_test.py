@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Asyncio load generator for the clinic API.
+
+Replays a reception-desk traffic mix (dashboard polls, agenda listings, patient
+list, status updates, manual syncs) with N concurrent virtual clients and
+reports throughput, error rate and p50/p95/p99 latency per operation.
+
+Against a running deployment:
+    python benchmarks/load_test.py --base-url http://127.0.0.1:8001 --concurrency 32 --duration 30
+
+Against a locally launched app fed by a synthetic sheet (needs a local MongoDB; the app
+uses the benchmark database, not DB_NAME):
+    python benchmarks/load_test.py --launch --rows 50000 --concurrency 32 --during-sync
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from run_benchmarks import DEFAULT_DB_NAME, git_commit, launch_api, percentiles_ms  # noqa: E402
+from sheet_server import SheetServer  # noqa: E402
+from synthetic_sheet import csv_text  # noqa: E402
+
+STATUSES = ['pending', 'confirmed', 'completed', 'cancelled']
+
+
+def agenda_range(rng: random.Random) -> str:
+    start = date.today() + timedelta(days=rng.randint(-7, 14))
+    end = start + timedelta(days=rng.choice([0, 0, 0, 6]))
+    return f"/api/appointments/?start_date={start:%Y-%m-%d}&end_date={end:%Y-%m-%d}"
+
+
+# (operation, weight, method, path builder)
+MIX = [
+    ('dashboard.stats', 20, 'GET', lambda ctx, rng: '/api/appointments/stats'),
+    ('dashboard.today', 20, 'GET', lambda ctx, rng: '/api/appointments/today'),
+    ('dashboard.sync_status', 10, 'GET', lambda ctx, rng: '/api/appointments/sync/status'),
+    ('agenda.listing', 25, 'GET', lambda ctx, rng: agenda_range(rng)),
+    ('agenda.upcoming', 8, 'GET', lambda ctx, rng: '/api/appointments/upcoming?days=7'),
+    ('patients.list', 5, 'GET', lambda ctx, rng: '/api/patients/'),
+    ('appointments.status_update', 10, 'POST', lambda ctx, rng: (
+        f"/api/appointments/{rng.choice(ctx['ids'])}/status?new_status={rng.choice(STATUSES)}" if ctx['ids'] else None)),
+    ('appointments.sync', 2, 'POST', lambda ctx, rng: '/api/appointments/sync'),
+]
+
+
+class LoadStats:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.status_codes: Dict[str, Dict[int, int]] = {}
+
+    def record(self, op: str, seconds: float, status: Optional[int]):
+        self.samples.setdefault(op, []).append(seconds)
+        codes = self.status_codes.setdefault(op, {})
+        codes[status or 0] = codes.get(status or 0, 0) + 1
+        if status is None or status >= 400:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+    def report(self, elapsed: float) -> Dict:
+        total = sum(len(s) for s in self.samples.values())
+        errors = sum(self.errors.values())
+        per_op = {}
+        for op, samples in sorted(self.samples.items()):
+            per_op[op] = {
+                **percentiles_ms(samples),
+                "throughput_rps": round(len(samples) / elapsed, 2),
+                "error_rate": round(self.errors.get(op, 0) / len(samples), 4),
+                "status_codes": self.status_codes[op],
+            }
+        return {
+            "duration_s": round(elapsed, 2),
+            "requests": total,
+            "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+            "error_rate": round(errors / total, 4) if total else 0.0,
+            "operations": per_op,
+        }
+
+
+async def sample_ids(session: aiohttp.ClientSession, base: str, limit: int = 500) -> List[str]:
+    try:
+        async with session.get(f"{base}/api/appointments/?limit={limit}") as r:
+            return [a['_id'] for a in await r.json()] if r.status == 200 else []
+    except aiohttp.ClientError:
+        return []
+
+
+async def virtual_client(n: int, session, base: str, ctx: Dict, stats: LoadStats, stop_at: float, think_ms: float):
+    rng = random.Random(n)
+    ops = [m for m in MIX if m[1] > 0]
+    weights = [m[1] for m in ops]
+    while time.monotonic() < stop_at:
+        op, _, method, build = rng.choices(ops, weights)[0]
+        path = build(ctx, rng)
+        if path is None:
+            continue
+        started = time.perf_counter()
+        status = None
+        try:
+            async with session.request(method, f"{base}{path}") as r:
+                await r.read()
+                status = r.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        stats.record(op, time.perf_counter() - started, status)
+        if think_ms:
+            await asyncio.sleep(rng.expovariate(1000 / think_ms))
+
+
+async def sync_pressure(session, base: str, stop_at: float, stats: LoadStats):
+    """Keep a sync running back-to-back for the whole run"""
+    while time.monotonic() < stop_at:
+        started = time.perf_counter()
+        status = None
+        try:
+            async with session.post(f"{base}/api/appointments/sync") as r:
+                await r.read()
+                status = r.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        stats.record('background.sync', time.perf_counter() - started, status)
+
+
+async def run_load(base: str, args) -> Dict:
+    connector = aiohttp.TCPConnector(limit=args.concurrency + 2)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        ctx = {"ids": await sample_ids(session, base)}
+        stats = LoadStats()
+        started = time.monotonic()
+        stop_at = started + args.duration
+        tasks = [
+            asyncio.create_task(virtual_client(i, session, base, ctx, stats, stop_at, args.think_ms))
+            for i in range(args.concurrency)
+        ]
+        if args.during_sync:
+            tasks.append(asyncio.create_task(sync_pressure(session, base, stop_at, stats)))
+        await asyncio.gather(*tasks)
+        return stats.report(time.monotonic() - started)
+
+
+async def main_async(args) -> Dict:
+    report = {
+        "commit": git_commit(),
+        "concurrency": args.concurrency,
+        "during_sync": args.during_sync,
+    }
+    if args.launch:
+        os.environ['DB_NAME'] = DEFAULT_DB_NAME
+        server = await SheetServer(csv_text(args.rows, seed=args.seed)).start()
+        try:
+            async with launch_api(server.url()) as base:
+                report["rows"] = args.rows
+                report.update(await run_load(base, args))
+        finally:
+            await server.stop()
+    else:
+        report.update(await run_load(args.base_url.rstrip('/'), args))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load test for the clinic API")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--base-url', help="API root, e.g. http://127.0.0.1:8001")
+    target.add_argument('--launch', action='store_true', help="launch the app locally against a synthetic sheet")
+    parser.add_argument('--rows', type=int, default=20000, help="synthetic sheet size with --launch")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20, help="seconds")
+    parser.add_argument('--think-ms', type=float, default=0, help="mean pause between a client's requests")
+    parser.add_argument('--timeout', type=float, default=30, help="per-request timeout in seconds")
+    parser.add_argument('--during-sync', action='store_true', help="run syncs back-to-back while loading")
+    parser.add_argument('--output', help="write JSON results to this file as well as stdout")
+    args = parser.parse_args()
+    report = asyncio.run(main_async(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text, encoding='utf-8')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Reproducible backend benchmarks.
+
+Measures CSV parsing, row mapping, in-memory store footprint, full sync_appointments (cold, unchanged and
+with a fraction of changed rows) and the main read endpoints against a
+synthetic sheet served locally. Everything runs offline: with a reachable
+MongoDB (MONGO_URL, default mongodb://localhost:27017) the sync and endpoint
+stages use it, otherwise they run against the in-memory repositories.
+
+Runs always use their own database (--db-name, default rubio_garcia_benchmark),
+whatever DB_NAME says, because they drop it; names without the "_benchmark"
+marker are refused.
+
+    python benchmarks/run_benchmarks.py --rows 2000 --rows 100000 --output bench.json
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+BACKEND_DIR = ROOT_DIR / 'backend'
+sys.path.insert(0, str(BACKEND_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('MONGO_SERVER_SELECTION_TIMEOUT_MS', '1500')
+# Keep sheet snapshots written during runs out of the working tree
+os.environ.setdefault('SHEET_SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'rubio_garcia_benchmark_snapshots'))
+
+import aiohttp  # noqa: E402
+
+from synthetic_sheet import csv_text  # noqa: E402
+from sheet_server import SheetServer  # noqa: E402
+
+DEFAULT_DB_NAME = 'rubio_garcia_benchmark'
+# Only databases carrying this marker are ever dropped
+BENCHMARK_DB_MARKER = '_benchmark'
+ENDPOINTS = [
+    '/api/appointments/?limit=5000',
+    '/api/appointments/today',
+    '/api/appointments/upcoming',
+    '/api/appointments/stats',
+    '/api/patients/',
+    '/api/analytics/summary',
+]
+
+
+def timed(fn, repeat: int):
+    """Run fn `repeat` times; returns (last result, list of seconds)"""
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - started)
+    return result, samples
+
+
+def summarize(samples, rows: int = 0):
+    out = {
+        "runs": len(samples),
+        "min_s": round(min(samples), 6),
+        "median_s": round(statistics.median(samples), 6),
+    }
+    if rows:
+        out["rows_per_s"] = round(rows / statistics.median(samples), 1)
+    return out
+
+
+def percentiles_ms(samples):
+    ordered = sorted(s * 1000 for s in samples)
+    pick = lambda q: round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 3)
+    return {"requests": len(ordered), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(ordered[-1], 3)}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def bench_parsing(service, text: str, rows: int, repeat: int):
+    parsed, samples = timed(lambda: service.parse_csv_data(text), repeat)
+    results = {"parse_csv_data": {**summarize(samples, rows), "appointments": len(parsed)}}
+    raw_rows = list(csv.DictReader(text.splitlines()))
+    _, samples = timed(lambda: [service.map_appointment_data(r) for r in raw_rows], repeat)
+    results["map_appointment_data"] = summarize(samples, rows)
+    return results
+
+
+def bench_memory(service, text: str, rows: int):
+    """Retained bytes per appointment: parsed dicts vs the packed in-memory repository"""
+    from bson import ObjectId
+    from repositories import MemoryAppointmentRepository
+
+    def parsed():
+        docs = service.parse_csv_data(text)
+        for d in docs:
+            d['_id'] = ObjectId()
+        return docs
+
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        docs = parsed()
+        as_dicts = tracemalloc.get_traced_memory()[0] - base
+        del docs
+        base = tracemalloc.get_traced_memory()[0]
+        repo = MemoryAppointmentRepository()
+        repo.load(parsed())
+        packed = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+    return {
+        "dict_bytes_per_row": round(as_dicts / rows),
+        "packed_bytes_per_row": round(packed / rows),
+        "ratio": round(as_dicts / packed, 2) if packed else None,
+    }
+
+
+async def drop_benchmark_database(mongo):
+    name = mongo.settings.db_name
+    if BENCHMARK_DB_MARKER not in name:
+        raise RuntimeError(f"Refusing to drop database {name!r}: benchmark databases must contain {BENCHMARK_DB_MARKER!r}")
+    await mongo.client.drop_database(name)
+
+
+async def mongo_available(mongo) -> bool:
+    try:
+        await mongo.client.admin.command('ping')
+        return True
+    except Exception as e:
+        print(f"MongoDB not reachable ({e.__class__.__name__}); benchmarking the in-memory repositories", file=sys.stderr)
+        return False
+
+
+async def bench_sync(service, server: SheetServer, rows: int, seed: int):
+    from db_indexes import ensure_indexes
+    from repositories import create_repositories
+
+    # Fresh storage per size so the cold sync really starts empty
+    service.repos = create_repositories(service.mongo, service.repos.backend)
+    if service.repos.uses_mongo:
+        await drop_benchmark_database(service.mongo)
+        await ensure_indexes(service.db)
+    results = {"repository_backend": service.repos.backend}
+    for label, mutate in (("sync_cold", 0.0), ("sync_unchanged", 0.0), ("sync_1pct_changed", 0.01)):
+        server.set_csv(csv_text(rows, seed=seed, mutate_fraction=mutate))
+        started = time.perf_counter()
+        outcome = await service.sync_appointments()
+        elapsed = time.perf_counter() - started
+        results[label] = {
+            "seconds": round(elapsed, 4),
+            "rows_per_s": round(rows / elapsed, 1),
+            **{k: outcome.get(k) for k in ("success", "synced", "added", "updated", "removed")},
+        }
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@asynccontextmanager
+async def launch_api(sheet_url: str, repository_backend: Optional[str] = None, ready_timeout: float = 60):
+    """Run the app under uvicorn against the configured database, or on `repository_backend` when given;
+    yields its base URL once the first sync finished"""
+    port = free_port()
+    env = {**os.environ, "GOOGLE_SHEET_URL": sheet_url, "GOOGLE_SHEET_FALLBACK_URL": sheet_url}
+    if repository_backend:
+        env["REPOSITORY_BACKEND"] = repository_backend
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'server:app', '--port', str(port), '--log-level', 'warning'],
+        cwd=BACKEND_DIR, env=env
+    )
+    base = f"http://127.0.0.1:{port}"
+    try:
+        async with aiohttp.ClientSession() as session:
+            deadline = time.monotonic() + ready_timeout
+            while True:
+                try:
+                    async with session.get(f"{base}/api/appointments/sync/status") as r:
+                        if r.status == 200 and (await r.json()).get('last_update'):
+                            break
+                except aiohttp.ClientError:
+                    pass
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"API did not become ready within {ready_timeout}s")
+                await asyncio.sleep(0.25)
+        yield base
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+async def bench_endpoints(sheet_url: str, repository_backend: str, requests_per_endpoint: int):
+    """Time each read endpoint sequentially against a locally launched app"""
+    results = {"repository_backend": repository_backend}
+    async with launch_api(sheet_url, repository_backend) as base, aiohttp.ClientSession() as session:
+        for path in ENDPOINTS:
+            samples, size = [], 0
+            for _ in range(requests_per_endpoint):
+                started = time.perf_counter()
+                async with session.get(f"{base}{path}") as r:
+                    body = await r.read()
+                    r.raise_for_status()
+                samples.append(time.perf_counter() - started)
+                size = len(body)
+            results[path] = {**percentiles_ms(samples), "response_bytes": size}
+    return results
+
+
+async def run(args) -> dict:
+    from appointments_service import GoogleSheetsService
+    from mongo_client import MongoClientProvider
+    from repositories import create_repositories
+    from sheet_sources import HttpSheetSource
+
+    mongo = MongoClientProvider()
+    server = await SheetServer().start()
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "sizes": {},
+    }
+    have_mongo = not args.no_mongo and await mongo_available(mongo)
+    # Without MongoDB the sync and endpoint stages run against the in-memory repositories
+    backend = os.environ.get('REPOSITORY_BACKEND', 'mongo') if have_mongo else 'memory'
+    service = GoogleSheetsService(mongo, create_repositories(mongo, backend))
+    service.sources = [HttpSheetSource(server.url())]
+    try:
+        for rows in args.rows:
+            print(f"Benchmarking {rows} rows...", file=sys.stderr)
+            text = csv_text(rows, seed=args.seed)
+            size = {"csv_bytes": len(text.encode('utf-8'))}
+            size.update(bench_parsing(service, text, rows, args.repeat))
+            size["memory_store"] = bench_memory(service, text, rows)
+            size.update(await bench_sync(service, server, rows, args.seed))
+            server.set_csv(csv_text(rows, seed=args.seed))
+            size["endpoints"] = await bench_endpoints(server.url(), backend, args.requests)
+            report["sizes"][str(rows)] = size
+    finally:
+        await service.close()
+        await server.stop()
+        if have_mongo:
+            await drop_benchmark_database(mongo)
+        mongo.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run backend benchmarks and emit JSON")
+    parser.add_argument('--rows', type=int, action='append', help="sheet size; repeatable (default 2000 and 50000)")
+    parser.add_argument('--repeat', type=int, default=3, help="repetitions for CPU-bound stages")
+    parser.add_argument('--requests', type=int, default=50, help="requests per endpoint")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-mongo', action='store_true', help="skip MongoDB; sync and endpoints run against in-memory repositories")
+    parser.add_argument('--db-name', default=DEFAULT_DB_NAME,
+                        help=f"database to benchmark in; dropped before and after, so it must contain {BENCHMARK_DB_MARKER!r}")
+    parser.add_argument('--output', help="write JSON results to this file as well as stdout")
+    args = parser.parse_args()
+    args.rows = args.rows or [2000, 50000]
+    if BENCHMARK_DB_MARKER not in args.db_name:
+        parser.error(f"--db-name must contain {BENCHMARK_DB_MARKER!r}: the benchmark drops its database")
+    # Overrides any exported DB_NAME, here and in the launched app, so a real database is never touched
+    os.environ['DB_NAME'] = args.db_name
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text, encoding='utf-8')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Local HTTP stand-in for the Google Sheets CSV export.
+
+Serves a CSV file (or in-memory text) at the same path shape as the real
+export, so GoogleSheetsService can be pointed at it through GOOGLE_SHEET_URL:
+
+    python benchmarks/sheet_server.py --csv /tmp/agenda.csv --port 8765
+    GOOGLE_SHEET_URL=http://127.0.0.1:8765/spreadsheets/d/local/export?format=csv&gid=0
+"""
+
+import argparse
+import asyncio
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+EXPORT_PATH = "/spreadsheets/d/{sheet_id}/export"
+WRITEBACK_PATH = "/writeback"
+
+
+class SheetServer:
+    """Serves the current CSV; `set_csv` swaps the content between runs.
+
+    Tabs are addressed by gid like the real export: `set_csv(text, gid=...)` gives
+    a gid its own content and `delays[gid]` adds response latency in seconds.
+
+    Also stands in for the write-back endpoint (SHEET_WRITEBACK_URL=writeback_url()):
+    received change batches are kept in `writebacks`, and `fail_writebacks` makes
+    the next N batches answer 503 to exercise retries.
+    """
+
+    def __init__(self, csv_text: str = "", csv_path: Optional[Path] = None, host: str = "127.0.0.1", port: int = 0):
+        self.csv_text = csv_text
+        self.csv_path = csv_path
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.tabs: Dict[str, str] = {}
+        self.delays: Dict[str, float] = {}
+        self.writebacks: List[List[Dict]] = []
+        self.fail_writebacks = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    def set_csv(self, csv_text: str, gid: Optional[str] = None):
+        if gid is not None:
+            self.tabs[gid] = csv_text
+            return
+        self.csv_text = csv_text
+        self.csv_path = None
+
+    def url(self, gid: str = "0") -> str:
+        return f"http://{self.host}:{self.port}/spreadsheets/d/local/export?format=csv&gid={gid}"
+
+    def writeback_url(self) -> str:
+        return f"http://{self.host}:{self.port}{WRITEBACK_PATH}"
+
+    async def handle_export(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        gid = request.query.get("gid", "0")
+        if self.delays.get(gid):
+            await asyncio.sleep(self.delays[gid])
+        if gid in self.tabs:
+            return web.Response(text=self.tabs[gid], content_type="text/csv", charset="utf-8")
+        if self.csv_path is not None:
+            return web.FileResponse(self.csv_path, headers={"Content-Type": "text/csv; charset=utf-8"})
+        return web.Response(text=self.csv_text, content_type="text/csv", charset="utf-8")
+
+    async def handle_writeback(self, request: web.Request) -> web.Response:
+        if self.fail_writebacks > 0:
+            self.fail_writebacks -= 1
+            return web.json_response({"error": "unavailable"}, status=503)
+        changes = (await request.json()).get("changes", [])
+        self.writebacks.append(changes)
+        return web.json_response({"applied": len(changes)})
+
+    async def start(self) -> "SheetServer":
+        app = web.Application()
+        app.router.add_get(EXPORT_PATH, self.handle_export)
+        app.router.add_post(WRITEBACK_PATH, self.handle_writeback)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def serve_forever(csv_path: Path, host: str, port: int):
+    server = await SheetServer(csv_path=csv_path, host=host, port=port).start()
+    print(f"Serving {csv_path} at {server.url()}")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a CSV as a local Google Sheets export")
+    parser.add_argument('--csv', required=True, type=Path)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve_forever(args.csv, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
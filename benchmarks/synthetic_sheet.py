@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Synthetic Spanish-clinic agenda CSV generator.
+
+Produces sheets shaped like the clinic export (Registro, NumPac, Apellidos,
+Nombre, TelMovil, Fecha, Hora, EstadoCita, Tratamiento, Odontologo, Notas,
+Duracion) or one of the alternative header aliases accepted by
+map_appointment_data, with mixed date/time formats and free-text statuses.
+
+    python benchmarks/synthetic_sheet.py --rows 100000 --output /tmp/agenda.csv
+"""
+
+import argparse
+import csv
+import io
+import random
+import sys
+from datetime import date, time, timedelta
+
+HEADER_VARIANTS = [
+    # Clinic export as currently configured
+    {'registro': 'Registro', 'citmod': 'CitMod', 'fecha_alta': 'FechaAlta', 'num_pac': 'NumPac',
+     'apellidos': 'Apellidos', 'nombre': 'Nombre', 'telefono': 'TelMovil', 'fecha': 'Fecha', 'hora': 'Hora',
+     'estado_cita': 'EstadoCita', 'tratamiento': 'Tratamiento', 'doctor': 'Odontologo', 'notas': 'Notas',
+     'duracion': 'Duracion'},
+    # Older manual sheet
+    {'num_pac': 'Nº Paciente', 'apellidos': 'Apellidos', 'nombre': 'Nombre Paciente', 'telefono': 'Teléfono',
+     'fecha': 'Fecha Cita', 'hora': 'Hora Cita', 'estado_cita': 'Estado cita', 'tratamiento': 'Motivo',
+     'doctor': 'Doctor asignado', 'notas': 'Observaciones', 'duracion': 'Duracion'},
+    # English export
+    {'nombre': 'Name', 'telefono': 'Phone', 'fecha': 'Date', 'hora': 'Time', 'estado_cita': 'Status',
+     'tratamiento': 'Treatment', 'doctor': 'Doctor', 'notas': 'Notes', 'duracion': 'Duracion'},
+]
+
+FIRST_NAMES = ['María', 'Carmen', 'Josefa', 'Isabel', 'Ana', 'Laura', 'Lucía', 'Marta', 'Elena', 'Paula',
+               'Antonio', 'José', 'Manuel', 'Francisco', 'David', 'Juan', 'Javier', 'Daniel', 'Carlos', 'Miguel',
+               'Álvaro', 'Sofía', 'Nerea', 'Íñigo', 'Begoña']
+SURNAMES = ['García', 'Rodríguez', 'González', 'Fernández', 'López', 'Martínez', 'Sánchez', 'Pérez', 'Gómez',
+            'Martín', 'Jiménez', 'Ruiz', 'Hernández', 'Díaz', 'Moreno', 'Muñoz', 'Álvarez', 'Romero', 'Alonso',
+            'Gutiérrez', 'Navarro', 'Torres', 'Domínguez', 'Vázquez', 'Ramos', 'Rubio', 'Manzanedo']
+TREATMENTS = ['Revisión', 'Limpieza', 'Empaste', 'Endodoncia', 'Implante', 'Extracción', 'Ortodoncia',
+              'Blanqueamiento', 'Corona', 'Carilla', 'Periodoncia', 'Urgencia', 'Radiografía', 'Férula']
+DOCTORS = ['Dr. Rubio', 'Dra. García', 'Dr. Manzanedo', 'Dra. Ortega', 'Dr. Prieto', 'Higienista']
+STATUSES = ['Planificada', 'Planificada', 'Confirmada', 'Confirmada', 'Finalizada', 'Finalizada', 'Finalizada',
+            'Cancelada', 'Anulada', 'Reprogramada', 'No acude', 'Pendiente confirmar', '']
+NOTES = ['', '', '', 'Traer radiografía', 'Alergia a penicilina', 'Primera visita', 'Revisar presupuesto',
+         'Llamar para confirmar', 'Paciente con ansiedad', 'Control implante']
+DATE_FORMATS = ['%d/%m/%Y', '%d/%m/%Y', '%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y']
+TIME_FORMATS = ['%H:%M', '%H:%M', '%H:%M', '%H.%M', '%I:%M %p', '%H%M']
+DURATIONS = ['15', '30', '30', '45', '60', '90', '1h', '01:30', '']
+
+
+def generate_rows(rows: int, seed: int = 1, start: date = None, days: int = 730,
+                  garbage_fraction: float = 0.002, variant: int = 0):
+    """Yield row dicts keyed by the variant's headers; deterministic for a given seed"""
+    rng = random.Random(seed)
+    headers = HEADER_VARIANTS[variant]
+    start = start or date.today() - timedelta(days=days - 60)
+    patients = max(rows // 4, 1)
+    for i in range(rows):
+        p = rng.randrange(patients)
+        prng = random.Random(p)  # patient attributes stay stable across rows
+        day = start + timedelta(days=rng.randrange(days))
+        hour, minute = rng.randint(9, 20), rng.choice([0, 15, 30, 45])
+        fecha = day.strftime(rng.choice(DATE_FORMATS))
+        if rng.random() < garbage_fraction:
+            fecha = rng.choice(['31/02/2024', 'mañana', '2024-13-01', 'pendiente'])
+        hora = time(hour, minute).strftime(rng.choice(TIME_FORMATS))
+        values = {
+            'registro': str(100000 + i),
+            'citmod': rng.choice(['', 'S', 'N']),
+            'fecha_alta': (day - timedelta(days=rng.randint(1, 60))).strftime('%d/%m/%Y'),
+            'num_pac': str(5000 + p) if prng.random() > 0.1 else '',
+            'apellidos': f"{prng.choice(SURNAMES)} {prng.choice(SURNAMES)}",
+            'nombre': prng.choice(FIRST_NAMES),
+            'telefono': prng.choice(['6', '7']) + ''.join(str(prng.randint(0, 9)) for _ in range(8)),
+            'fecha': fecha,
+            'hora': hora,
+            'estado_cita': rng.choice(STATUSES),
+            'tratamiento': rng.choice(TREATMENTS),
+            'doctor': rng.choice(DOCTORS),
+            'notas': rng.choice(NOTES),
+            'duracion': rng.choice(DURATIONS),
+        }
+        if 'apellidos' not in headers:
+            values['nombre'] = f"{values['nombre']} {values['apellidos']}"
+        yield {header: values[field] for field, header in headers.items()}
+
+
+def write_csv(out, rows: int, seed: int = 1, mutate_fraction: float = 0.0, variant: int = 0, **kwargs) -> int:
+    """Write a sheet to a text stream; mutate_fraction re-rolls the status of that share of rows"""
+    headers = list(HEADER_VARIANTS[variant].values())
+    writer = csv.DictWriter(out, fieldnames=headers)
+    writer.writeheader()
+    rng = random.Random(seed + 7919)
+    status_header = HEADER_VARIANTS[variant]['estado_cita']
+    count = 0
+    for row in generate_rows(rows, seed=seed, variant=variant, **kwargs):
+        if mutate_fraction and rng.random() < mutate_fraction:
+            row[status_header] = rng.choice(STATUSES)
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def csv_text(rows: int, **kwargs) -> str:
+    buf = io.StringIO()
+    write_csv(buf, rows, **kwargs)
+    return buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic clinic agenda CSV")
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--variant', type=int, default=0, choices=range(len(HEADER_VARIANTS)))
+    parser.add_argument('--mutate', type=float, default=0.0, help="fraction of rows whose status changes")
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args()
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    try:
+        count = write_csv(out, args.rows, seed=args.seed, mutate_fraction=args.mutate, variant=args.variant)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"Wrote {count} rows", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
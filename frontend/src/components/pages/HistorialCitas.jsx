@@ -14,13 +14,17 @@ import {
   Users,
   Clock
 } from "lucide-react";
-import { appointmentsAPI } from "../../services/apiService";
+import { appointmentsAPI, patientsAPI } from "../../services/apiService";
 import { toast } from "../../hooks/use-toast";
-import { useNavigate } from "react-router-dom";
+import { useNavigate, useSearchParams } from "react-router-dom";
 
 const HistorialCitas = () => {
   const navigate = useNavigate();
+  // ?paciente=<id>: one patient's history, served newest first by the API a page at a time
+  const [searchParams] = useSearchParams();
+  const patientId = searchParams.get('paciente');
   const [appointments, setAppointments] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(false);
   const [searchTerm, setSearchTerm] = useState('');
   const [statusFilter, setStatusFilter] = useState('all');
@@ -29,6 +33,25 @@ const HistorialCitas = () => {
     endDate: ''
   });
 
+  const fetchPatientAppointments = async (cursor = null) => {
+    setLoading(true);
+    try {
+      const response = await patientsAPI.getAppointments(patientId, cursor ? { cursor } : {});
+      const page = response.data?.appointments || [];
+      setAppointments(prev => (cursor ? [...prev, ...page] : page));
+      setNextCursor(response.data?.next_cursor || null);
+    } catch (error) {
+      toast({
+        title: "Error al cargar historial",
+        description: "No se pudo cargar el historial del paciente",
+        variant: "destructive"
+      });
+      if (!cursor) setAppointments([]);
+    } finally {
+      setLoading(false);
+    }
+  };
+
   const fetchHistorialAppointments = async () => {
     setLoading(true);
     try {
@@ -58,9 +81,14 @@ const HistorialCitas = () => {
     }
   };
 
+  // A patient's history is fetched once; its status and date filters apply to the loaded pages
   useEffect(() => {
-    fetchHistorialAppointments();
-  }, [statusFilter, dateRange]);
+    if (patientId) fetchPatientAppointments();
+  }, [patientId]);
+
+  useEffect(() => {
+    if (!patientId) fetchHistorialAppointments();
+  }, [patientId, statusFilter, dateRange]);
 
   const getStatusColor = (status) => {
     const colors = {
@@ -86,6 +114,11 @@ const HistorialCitas = () => {
 
   // Filter appointments by search term
   const filteredAppointments = appointments.filter(apt => {
+    if (patientId) {
+      if (statusFilter !== 'all' && apt.status !== statusFilter) return false;
+      if (dateRange.startDate && apt.date < dateRange.startDate) return false;
+      if (dateRange.endDate && apt.date > dateRange.endDate) return false;
+    }
     if (!searchTerm) return true;
     const searchLower = searchTerm.toLowerCase();
     return (
@@ -298,6 +331,13 @@ const HistorialCitas = () => {
                   </div>
                 </div>
               ))}
+              {patientId && nextCursor && (
+                <div className="text-center">
+                  <Button variant="outline" onClick={() => fetchPatientAppointments(nextCursor)}>
+                    Cargar más
+                  </Button>
+                </div>
+              )}
             </div>
           )}
         </CardContent>
@@ -19,10 +19,12 @@ import {
 } from "lucide-react";
 import { patientsAPI } from "../../services/apiService";
 import { toast } from "../../hooks/use-toast";
+import { useNavigate } from "react-router-dom";
 
 const emptyForm = { first_name:"", last_name:"", full_name:"", phone:"", email:"", address:"", num_paciente:"", notes:"" };
 
 const Patients = () => {
+  const navigate = useNavigate();
   const [searchTerm, setSearchTerm] = useState("");
   const [patients, setPatients] = useState([]);
   const [loading, setLoading] = useState(false);
@@ -195,6 +197,9 @@ const Patients = () => {
                       </div>
                     </div>
                     <div className="flex items-center space-x-2 ml-4">
+                      <Button size="sm" variant="outline" onClick={() => navigate(`/panel-de-control/agenda/historial?paciente=${p._id}`)}>
+                        <Eye className="h-4 w-4 mr-1" />Historial
+                      </Button>
                       <Button size="sm" variant="outline" onClick={() => startEdit(p)}>
                         <Edit className="h-4 w-4 mr-1" />Editar
                       </Button>
@@ -32,6 +32,13 @@ apiClient.interceptors.response.use(
   },
   (error) => {
     console.error('API Response Error:', error);
+    const config = error.config;
+    if (error.response?.status === 503 && config && config.method === 'get' && !config._retried) {
+      // Shed by admission control: retry a read once, after the server's Retry-After
+      config._retried = true;
+      const seconds = Math.min(parseInt(error.response.headers?.['retry-after'], 10) || 1, 10);
+      return new Promise((resolve) => setTimeout(resolve, seconds * 1000)).then(() => apiClient(config));
+    }
     if (error.response?.status === 307) {
       console.warn('Redirect detected - this might cause infinite loops');
     } else if (error.response?.status === 500) {
@@ -69,7 +76,9 @@ export const appointmentsAPI = {
     if (payload?.status) params.set('new_status', payload.status);
     if (payload?.estado_cita) params.set('estado_cita_text', payload.estado_cita);
     return apiClient.post(`/appointments/${appointmentId}/status?${params.toString()}`);
-  }
+  },
+  // updates: [{ appointment_id, status, estado_cita }]; one request for a whole agenda
+  updateStatuses: (updates) => apiClient.post('/appointments/status/bulk', { updates })
 };
 
 // Patients API
@@ -77,6 +86,14 @@ export const patientsAPI = {
   getAll: () => apiClient.get('/patients/'),
   create: (data) => apiClient.post('/patients/', data),
   update: (id, data) => apiClient.put(`/patients/${id}`, data),
+  getAppointments: (id, params = {}) => apiClient.get(`/patients/${id}/appointments`, { params }),
+};
+
+// Analytics API
+export const analyticsAPI = {
+  getSummary: (params = {}) => apiClient.get('/analytics/summary', { params }),
+  getGrouped: (by = 'month', params = {}) => apiClient.get('/analytics/grouped', { params: { by, ...params } }),
+  getUtilization: (params = {}) => apiClient.get('/analytics/utilization', { params }),
 };
 
 // General API
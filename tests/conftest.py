@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# Backend modules import each other as top-level modules (the server runs from backend/)
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT / 'backend'), str(ROOT / 'benchmarks')]
@@ -0,0 +1,150 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+
+import admission
+import appointments_service
+from admission import AdmissionController, AdmissionLimiter
+from appointments_service import create_appointments_router
+from clinics import ClinicRegistry
+from sheet_sources import LocalFileSource
+from synthetic_sheet import csv_text
+
+
+async def hold(limiter, release: asyncio.Event):
+    async with limiter.admit():
+        await release.wait()
+
+
+async def assert_all_slots_free(limiter):
+    # Every permit can be taken again without waiting
+    for _ in range(limiter.max_concurrent):
+        assert not limiter.slots.locked()
+        await limiter.slots.acquire()
+    assert limiter.slots.locked()
+    for _ in range(limiter.max_concurrent):
+        limiter.slots.release()
+
+
+def test_waiters_are_shed_with_retry_after_on_timeout_and_when_the_queue_is_full():
+    async def main():
+        limiter = AdmissionLimiter('appointments.list', 'expensive', 1, 1, 0.05)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(limiter, release))
+        await asyncio.sleep(0)
+
+        waiter = asyncio.create_task(hold(limiter, release))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as full:
+            await hold(limiter, release)
+        assert full.value.status_code == 503 and full.value.headers["Retry-After"] == "1"
+
+        with pytest.raises(HTTPException) as timed_out:
+            await waiter
+        assert timed_out.value.status_code == 503 and "Retry-After" in timed_out.value.headers
+        release.set()
+        await holder
+        assert limiter.queued == 0 and limiter.in_flight == 0
+        await assert_all_slots_free(limiter)
+    asyncio.run(main())
+
+
+def test_no_permit_is_lost_to_timeouts_or_cancelled_waiters():
+    async def main():
+        limiter = AdmissionLimiter('appointments.list', 'expensive', 2, 100, 0.01)
+
+        async def request(seconds):
+            try:
+                async with limiter.admit():
+                    await asyncio.sleep(seconds)
+            except HTTPException:
+                pass
+
+        # Slot hand-overs landing around the waiters' deadlines
+        tasks = [asyncio.create_task(request(0.005 + (i % 4) * 0.001)) for i in range(200)]
+        await asyncio.sleep(0.02)
+        for task in tasks[150:]:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert limiter.queued == 0 and limiter.in_flight == 0
+        await assert_all_slots_free(limiter)
+    asyncio.run(main())
+
+
+def test_permit_won_as_the_wait_times_out_is_kept(monkeypatch):
+    async def late_wait_for(awaitable, timeout):
+        # What wait_for can do before Python 3.12: the acquire completes, the timeout still wins
+        await awaitable
+        raise asyncio.TimeoutError
+
+    async def main():
+        limiter = AdmissionLimiter('appointments.list', 'expensive', 1, 1, 0.01)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(limiter, release))
+        await asyncio.sleep(0)
+        monkeypatch.setattr(admission.asyncio, 'wait_for', late_wait_for)
+        waiter = asyncio.create_task(hold(limiter, asyncio.Event()))
+        await asyncio.sleep(0)
+        release.set()
+        await holder
+        await asyncio.sleep(0.01)
+        assert not waiter.done() and limiter.in_flight == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        monkeypatch.undo()
+        await assert_all_slots_free(limiter)
+    asyncio.run(main())
+
+
+@pytest.fixture
+def app_and_clinics(tmp_path):
+    path = tmp_path / "citas.csv"
+    path.write_text(csv_text(300, seed=2), encoding='utf-8')
+    clinics = ClinicRegistry(None, 'memory', [LocalFileSource(str(path), clinic_id='centro')])
+    asyncio.run(clinics.default.sync_appointments())
+    app = FastAPI()
+    app.include_router(create_appointments_router(None, clinics))
+    return app, clinics
+
+
+async def get(app, url):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+        return await client.get(url)
+
+
+def test_listing_holds_its_slot_until_the_body_is_serialized(app_and_clinics, monkeypatch):
+    app, clinics = app_and_clinics
+    seen = []
+    serialize = appointments_service.appointments_response
+
+    def spy(appointments):
+        seen.append(clinics.admission.limiter('appointments.list').in_flight)
+        return serialize(appointments)
+
+    monkeypatch.setattr(appointments_service, 'appointments_response', spy)
+    response = asyncio.run(get(app, '/api/appointments/?limit=50'))
+    assert response.status_code == 200 and len(response.json()) == 50
+    assert "_id" in response.json()[0]
+    assert seen == [1]
+    assert clinics.admission.limiter('appointments.list').in_flight == 0
+
+
+def test_stats_are_admission_controlled(app_and_clinics):
+    app, clinics = app_and_clinics
+    clinics.admission = AdmissionController({'appointments.stats': (1, 0, 0.01)})
+    limiter = clinics.admission.limiter('appointments.stats')
+
+    async def main():
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(limiter, release))
+        await asyncio.sleep(0)
+        busy = await get(app, '/api/appointments/stats')
+        release.set()
+        await holder
+        return busy, await get(app, '/api/appointments/stats'), await clinics.default.repos.appointments.count()
+
+    busy, ok, total = asyncio.run(main())
+    assert busy.status_code == 503 and busy.headers["Retry-After"] == "1"
+    assert ok.status_code == 200 and ok.json()["total_appointments"] == total
@@ -0,0 +1,59 @@
+import asyncio
+
+from analytics_service import AnalyticsEngine
+from appointments_service import GoogleSheetsService
+from repositories import create_repositories
+from sheet_sources import LocalFileSource
+from synthetic_sheet import csv_text
+
+
+async def synced_service(path, rows=400, **kwargs):
+    path.write_text(csv_text(rows, seed=3, **kwargs), encoding='utf-8')
+    service = GoogleSheetsService(None, create_repositories(None, 'memory'), [LocalFileSource(str(path))])
+    await service.sync_appointments()
+    return service
+
+
+def by_status(snapshot):
+    return snapshot.grouped('status', snapshot.mask())
+
+
+def test_overrides_are_applied_to_the_snapshot_without_a_rebuild(tmp_path):
+    async def main():
+        service = await synced_service(tmp_path / "citas.csv")
+        engine = AnalyticsEngine(service)
+        snapshot = await engine.get_snapshot()
+
+        ids = [d["_id"] for d in await service.get_appointments(limit=5)]
+        await service.set_status_override(ids[0], 'cancelled')
+        await service.set_status_override(ids[1], 'completed', 'No acude')
+        await service.set_status_overrides([{"appointment_id": i, "status": 'rescheduled'} for i in ids[2:]])
+
+        caught_up = await engine.get_snapshot()
+        assert caught_up is snapshot
+        assert caught_up.generation == service.generation
+        # Same figures as a snapshot built from scratch with the overrides in place
+        assert by_status(caught_up) == by_status(await AnalyticsEngine(service).get_snapshot())
+    asyncio.run(main())
+
+
+def test_snapshot_is_rebuilt_when_rows_change_or_the_log_is_short(tmp_path):
+    async def main():
+        path = tmp_path / "citas.csv"
+        service = await synced_service(path)
+        engine = AnalyticsEngine(service)
+        first = await engine.get_snapshot()
+
+        path.write_text(csv_text(400, seed=3, mutate_fraction=0.1), encoding='utf-8')
+        await service.sync_appointments()
+        second = await engine.get_snapshot()
+        assert second is not first and second.data_generation == service.data_generation
+
+        # Overrides no longer in the log cannot be replayed
+        appointment_id = (await service.get_appointments(limit=1))[0]["_id"]
+        await service.set_status_override(appointment_id, 'cancelled')
+        service.override_log.clear()
+        third = await engine.get_snapshot()
+        assert third is not second
+        assert by_status(third) == by_status(await AnalyticsEngine(service).get_snapshot())
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson import ObjectId
+
+mongomock_motor = pytest.importorskip('mongomock_motor')
+
+from archive_service import AppointmentArchiver, merge_tiers
+from repositories import create_repositories
+
+NOW = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+
+
+class FakeMongo:
+    def __init__(self, client=None):
+        self.client = client or mongomock_motor.AsyncMongoMockClient()
+        self.db = self.client['test']
+
+
+def row(days_ago: float, external_id: str, status: str = 'pending', **fields):
+    return {"external_id": external_id, "source": "google_sheets", "source_id": "s1", "clinic_id": "centro",
+            "quarantined": False, "starts_at": NOW - timedelta(days=days_ago), "status": status,
+            "row_hash": f"{external_id}:{status}", "created_at": datetime.utcnow(), **fields}
+
+
+def archiver_for(mongo):
+    return AppointmentArchiver(mongo, create_repositories(mongo, 'mongo', 'centro'), after_days=30)
+
+
+def test_merge_tiers_orders_by_start_and_drops_rows_caught_mid_move():
+    old, moving, new = (
+        {"_id": ObjectId(), "starts_at": NOW - timedelta(days=d)} for d in (60, 40, 1)
+    )
+    hot = [moving, new]
+    cold = [old, {**moving, "starts_at": moving["starts_at"].replace(tzinfo=None)}]
+    assert [d["_id"] for d in merge_tiers(hot, cold, 10)] == [old["_id"], moving["_id"], new["_id"]]
+    assert [d["_id"] for d in merge_tiers(hot, cold, 2)] == [old["_id"], moving["_id"]]
+    newest_first = merge_tiers(hot[::-1], cold[::-1], 10, newest_first=True)
+    assert [d["_id"] for d in newest_first] == [new["_id"], moving["_id"], old["_id"]]
+
+
+def test_store_inserts_new_cold_rows_and_updates_changed_ones():
+    async def main():
+        archiver = archiver_for(FakeMongo())
+        added, updated = await archiver.store([row(60, "a"), row(90, "b")], "s1")
+        assert [r["external_id"] for r in added] == ["a", "b"] and updated == []
+
+        added, updated = await archiver.store([row(60, "a"), row(90, "b", 'cancelled')], "s1")
+        assert added == []
+        assert [(old["external_id"], new["status"]) for old, new in updated] == [("b", 'cancelled')]
+        stored = await archiver.archive.collection.find({}, {"_id": 0, "external_id": 1, "status": 1}).to_list(None)
+        assert sorted((d["external_id"], d["status"]) for d in stored) == [("a", 'pending'), ("b", 'cancelled')]
+    asyncio.run(main())
+
+
+def test_only_ranges_reaching_past_the_horizon_need_the_archive():
+    archiver = archiver_for(FakeMongo())
+    assert not archiver.reaches(None)
+    assert not archiver.reaches({"$gte": NOW - timedelta(days=7)})
+    assert archiver.reaches({"$gte": NOW - timedelta(days=60)})
+    assert archiver.reaches({"$lt": NOW - timedelta(days=60)})
+
+
+def test_counts_follow_archive_writes_made_by_another_worker():
+    async def main():
+        client = mongomock_motor.AsyncMongoMockClient()
+        mine, other = archiver_for(FakeMongo(client)), archiver_for(FakeMongo(client))
+        await mine.store([row(60, "a")], "s1")
+        assert await mine.counts() == {"pending": 1, "total": 1}
+
+        await asyncio.sleep(0.002)
+        await other.store([row(70, "b", 'completed')], "s1")
+        assert await mine.counts() == {"pending": 1, "completed": 1, "total": 2}
+    asyncio.run(main())
@@ -0,0 +1,139 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+mongomock_motor = pytest.importorskip('mongomock_motor')
+
+from outbox_service import HttpSink, OutboxFlusher, SheetOutbox, coalesce
+from sheet_server import SheetServer
+
+ROW = {"external_id": "e1", "clinic_id": "centro", "source_id": "s1", "patient_name": "Ana"}
+
+
+class FakeMongo:
+    def __init__(self):
+        self.client = mongomock_motor.AsyncMongoMockClient()
+        self.db = self.client['test']
+
+
+async def entries(outbox, **query):
+    return await outbox.collection.find(query).to_list(length=None)
+
+
+async def make_due(outbox):
+    await outbox.collection.update_many({}, {"$set": {"next_attempt_at": datetime.utcnow() - timedelta(seconds=1)}})
+
+
+def run_with_server(scenario):
+    async def main():
+        server = await SheetServer().start()
+        try:
+            outbox = SheetOutbox(FakeMongo())
+            sink = HttpSink(server.writeback_url())
+            try:
+                await scenario(server, outbox, sink)
+            finally:
+                await sink.close()
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+
+def test_coalesce_merges_fields_later_entries_win():
+    t0 = datetime(2025, 1, 1)
+    merged = coalesce([
+        {"appointment_id": "a", "enqueued_at": t0 + timedelta(seconds=1), "changes": {"status": "cancelled"}, "row": {}},
+        {"appointment_id": "a", "enqueued_at": t0, "changes": {"status": "confirmed", "estado_cita": "Confirmada"}, "row": ROW},
+    ])
+    assert len(merged) == 1
+    assert merged[0]["changes"] == {"status": "cancelled", "estado_cita": "Confirmada"}
+    assert merged[0]["row"] == ROW
+
+
+def test_repeated_edits_are_sent_once_with_latest_values():
+    async def scenario(server, outbox, sink):
+        await outbox.enqueue({"a1": {"status": "confirmed"}}, {"a1": ROW})
+        await outbox.enqueue({"a1": {"status": "cancelled", "estado_cita": "Anulada"}}, {"a1": ROW})
+        assert len(await entries(outbox, state="pending")) == 1
+
+        assert await OutboxFlusher(outbox, sink).flush_once() == 1
+        assert len(server.writebacks) == 1
+        [change] = server.writebacks[0]
+        assert change["appointment_id"] == "a1"
+        assert change["changes"] == {"status": "cancelled", "estado_cita": "Anulada"}
+        assert change["row"]["external_id"] == "e1"
+        assert await outbox.counts() == {"sent": 1}
+    run_with_server(scenario)
+
+
+def test_failed_batch_backs_off_then_delivers():
+    async def scenario(server, outbox, sink):
+        flusher = OutboxFlusher(outbox, sink, base_backoff_seconds=60)
+        await outbox.enqueue({"a1": {"status": "completed"}}, {"a1": ROW})
+        server.fail_writebacks = 1
+
+        assert await flusher.flush_once() == 0
+        [entry] = await entries(outbox)
+        assert entry["state"] == "pending"
+        assert entry["attempts"] == 1
+        assert "503" in entry["last_error"]
+        assert entry["next_attempt_at"] > datetime.utcnow()
+        # Backing off: nothing is due yet
+        assert await flusher.flush_once() == 0
+
+        await make_due(outbox)
+        assert await flusher.flush_once() == 1
+        assert [c["changes"] for c in server.writebacks[0]] == [{"status": "completed"}]
+    run_with_server(scenario)
+
+
+def test_retry_never_overwrites_an_edit_made_while_in_flight():
+    async def scenario(server, outbox, sink):
+        flusher = OutboxFlusher(outbox, sink)
+        await outbox.enqueue({"a1": {"status": "confirmed", "estado_cita": "Confirmada"}}, {"a1": ROW})
+        claimed = await flusher.claim(datetime.utcnow())
+        # The row is edited again while its batch is out, then the batch fails
+        await outbox.enqueue({"a1": {"status": "cancelled"}}, {"a1": ROW})
+        await flusher.reschedule(claimed, "boom")
+
+        [entry] = await entries(outbox)
+        assert entry["state"] == "pending"
+        assert entry["changes"] == {"status": "cancelled", "estado_cita": "Confirmada"}
+        assert entry["attempts"] == 1
+
+        await make_due(outbox)
+        assert await flusher.flush_once() == 1
+        assert server.writebacks[0][0]["changes"] == {"status": "cancelled", "estado_cita": "Confirmada"}
+    run_with_server(scenario)
+
+
+def test_entries_out_of_attempts_are_parked():
+    async def scenario(server, outbox, sink):
+        flusher = OutboxFlusher(outbox, sink, max_attempts=2, base_backoff_seconds=0.001)
+        await outbox.enqueue({"a1": {"status": "cancelled"}}, {"a1": ROW})
+        server.fail_writebacks = 2
+        assert await flusher.flush_once() == 0
+        await make_due(outbox)
+        assert await flusher.flush_once() == 0
+
+        [entry] = await entries(outbox)
+        assert entry["state"] == "failed"
+        assert entry["attempts"] == 2
+        await make_due(outbox)
+        assert await flusher.flush_once() == 0
+        assert server.writebacks == []
+    run_with_server(scenario)
+
+
+def test_expired_claims_are_taken_over():
+    async def scenario(server, outbox, sink):
+        await outbox.enqueue({"a1": {"status": "confirmed"}}, {"a1": ROW})
+        assert len(await OutboxFlusher(outbox, sink).claim(datetime.utcnow())) == 1
+        # The worker holding the claim dies; its lease started a minute ago
+        await outbox.collection.update_many({}, {"$set": {"claimed_at": datetime.utcnow() - timedelta(seconds=60)}})
+        # A live claim is left alone; an expired one returns to pending and is delivered
+        assert await OutboxFlusher(outbox, sink, lease_seconds=120).flush_once() == 0
+        assert await OutboxFlusher(outbox, sink, lease_seconds=30).flush_once() == 1
+        assert len(server.writebacks) == 1
+    run_with_server(scenario)
@@ -0,0 +1,95 @@
+import asyncio
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+from patient_identity import IdentityRecord, PatientIdentityIndex, fold_name, make_patient_key, same_patient
+from repositories import create_repositories
+
+
+def person(name: str, phone: str = "", num: str = "") -> dict:
+    return {"patient_name": name, "phone": phone, "num_paciente": num}
+
+
+def stored(row: dict) -> dict:
+    return {"_id": ObjectId(), "starts_at": datetime(2025, 3, 1, 9, tzinfo=timezone.utc), "quarantined": False,
+            "status": "pending", **row}
+
+
+def key(row: dict) -> str:
+    return make_patient_key(row["num_paciente"], row["patient_name"], row["phone"])
+
+
+async def index_over(rows):
+    repos = create_repositories(None, 'memory')
+    await repos.appointments.apply_sync([], [], [stored(r) for r in rows])
+    index = PatientIdentityIndex(repos)
+    await index.ensure_loaded()
+    return index
+
+
+def test_name_variants_sharing_a_phone_are_one_patient():
+    async def main():
+        full = person("María García López", "+34 600 111 222")
+        short = person("maria garcia", "600111222")
+        typo = person("Maria Garcai Lopez", "600 111 222")
+        other = person("María García López", "611 999 888")
+        index = await index_over([full, short, typo, other])
+        assert index.cluster_id(key(full)) == index.cluster_id(key(short)) == index.cluster_id(key(typo))
+        # Same name, a different phone: another person
+        assert index.cluster_id(key(other)) != index.cluster_id(key(full))
+        assert index.keys_of(key(short)) == sorted({key(full), key(short), key(typo)})
+    asyncio.run(main())
+
+
+def test_same_patient_needs_two_name_tokens_without_a_shared_phone():
+    def record(name, phone=""):
+        r = IdentityRecord(name)
+        r.names.add(fold_name(name))
+        if phone:
+            r.phones.add(phone)
+        return r
+    assert same_patient(record("Ana Ruiz Soto"), record("Ana Ruiz"))
+    assert not same_patient(record("Ana Ruiz"), record("Ana Pérez"))
+    assert same_patient(record("Ana", "600111222"), record("Ana Ruiz", "600111222"))
+
+
+def test_different_patient_numbers_and_bridging_records_never_merge_clusters():
+    async def main():
+        numbered_a = person("Luis Martín", "600 222 333", "101")
+        numbered_b = person("Luis Martín", "600 222 333", "102")
+        phone_a = person("Pedro Sanz", "600 444 555")
+        phone_b = person("Pedro Sanz", "600 666 777")
+        # Compatible with both Pedros, but they have different phones
+        bridge = person("Pedro Sanz")
+        index = await index_over([numbered_a, numbered_b, phone_a, phone_b, bridge])
+        assert index.cluster_id(key(numbered_a)) != index.cluster_id(key(numbered_b))
+        assert index.cluster_id(key(phone_a)) != index.cluster_id(key(phone_b))
+    asyncio.run(main())
+
+
+def test_rows_observed_during_a_rebuild_are_replayed_on_the_rebuilt_clusters():
+    async def main():
+        first = person("Carmen Vidal Roca", "600 123 456")
+        index = await index_over([first])
+        source_rows, gate = index._source_rows, asyncio.Event()
+
+        async def slow_source_rows():
+            rows = await source_rows()
+            await gate.wait()
+            return rows
+
+        index._source_rows = slow_source_rows
+        rebuild = asyncio.create_task(index.rebuild())
+        while index._backlog is None:
+            await asyncio.sleep(0)
+        # Lands while the rebuild is reading its rows; not in the repositories it reads
+        late = person("carmen vidal", "+34600123456")
+        assert await index.observe([late]) >= 1
+        gate.set()
+        await rebuild
+
+        assert index.cluster_id(key(late)) == index.cluster_id(key(first))
+        persisted = {doc["_id"]: doc["cluster_id"] for doc in await index.repos.identities.load()}
+        assert persisted[key(late)] == persisted[key(first)]
+    asyncio.run(main())
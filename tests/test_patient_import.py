@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+import pytest
+
+from patient_identity import PatientIdentityIndex
+from patient_import import MAX_RECORD_BYTES, CsvRecords, JsonRecords, PatientImporter, iter_records
+from repositories import create_repositories
+
+CSV_BODY = (
+    'Nombre,Apellidos,Teléfono,Nº Paciente,Observaciones\r\n'
+    'María,García,600 111 222,101,"Alergia a la penicilina,\r\nrevisar ""antes"" de anestesia"\r\n'
+    '\r\n'
+    'Luis,Martín,611 222 333,,\r\n'
+    'José,Núñez,,103,"línea 1\n\nlínea 3"\n'
+)
+
+
+async def pieces(body: bytes, size: int):
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+def parse(body: str, records, size: int):
+    async def main():
+        return [row async for row in iter_records(pieces(body.encode('utf-8'), size), records)]
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 4096])
+def test_csv_quoted_fields_spanning_lines_and_chunks(size):
+    rows = parse(CSV_BODY, CsvRecords(), size)
+    assert [number for number, _ in rows] == [1, 2, 3]
+    maria, luis, jose = (row for _, row in rows)
+    assert maria == {"first_name": "María", "last_name": "García", "phone": "600 111 222", "num_paciente": "101",
+                     "notes": 'Alergia a la penicilina,\r\nrevisar "antes" de anestesia'}
+    assert luis["num_paciente"] == "" and luis["phone"] == "611 222 333"
+    assert jose["notes"] == "línea 1\n\nlínea 3"
+
+
+def test_csv_with_an_unterminated_quote_fails_at_the_end():
+    records = CsvRecords()
+    assert records.feed('Nombre,Notas\nAna,"sin cerrar\n') == []
+    with pytest.raises(ValueError, match="unterminated"):
+        records.feed('más texto', final=True)
+
+
+@pytest.mark.parametrize('size', [1, 5, 4096])
+def test_json_arrays_and_ndjson_give_the_same_records(size):
+    patients = [{"full_name": "Ana Ruiz", "phone": "600 000 001"}, {"full_name": "Luis [Martín], {jr}"}, 7]
+    array = parse(json.dumps(patients, ensure_ascii=False, indent=2), JsonRecords(), size)
+    ndjson = parse("\n".join(json.dumps(p, ensure_ascii=False) for p in patients) + "\n", JsonRecords(), size)
+    assert array == ndjson == list(enumerate(patients, start=1))
+
+
+def test_json_bad_lines_and_runaway_records_stop_the_parse():
+    records = JsonRecords()
+    assert records.feed('{"full_name": "Ana"}\n{"full_name": ') == [(1, {"full_name": "Ana"})]
+    # A value still arriving is kept until it ends
+    assert records.feed('"Luis"') == []
+    assert records.feed('}\n') == [(2, {"full_name": "Luis"})]
+    with pytest.raises(ValueError, match="after row 2"):
+        records.feed('{"full_name": nope}\n')
+
+    runaway = JsonRecords()
+    runaway.feed('[{"notes": "')
+    with pytest.raises(ValueError, match="invalid JSON"):
+        runaway.feed("x" * MAX_RECORD_BYTES)
+
+
+def import_rows(repos, rows, batch_size=2):
+    async def main():
+        async def stream():
+            for row in rows:
+                if isinstance(row, Exception):
+                    raise row
+                yield row
+        return await PatientImporter(repos, PatientIdentityIndex(repos), batch_size).run(stream())
+    return asyncio.run(main())
+
+
+def test_import_reports_inserts_updates_duplicates_and_failures():
+    repos = create_repositories(None, 'memory')
+    ana = {"full_name": "Ana Ruiz", "phone": "600 000 001"}
+    report = import_rows(repos, [
+        (1, ana),
+        (2, {"phone": "600 000 002"}),
+        (3, {**ana, "notes": "última"}),
+        (4, {"first_name": "Luis", "last_name": "Martín"}),
+        (5, ["not", "an", "object"]),
+        (6, {"num_paciente": "103", "notes": {"nested": True}}),
+        (7, {"num_paciente": "104"}),
+    ])
+    assert {k: report[k] for k in ("received", "inserted", "updated", "duplicates", "failed")} == {
+        "received": 7, "inserted": 3, "updated": 0, "duplicates": 1, "failed": 3}
+    assert [e["row"] for e in report["errors"]] == [2, 5, 6]
+    assert "aborted" not in report
+    patients = asyncio.run(repos.patients.list())
+    assert len(patients) == 3
+    assert [p["notes"] for p in patients if p["full_name"] == "Ana Ruiz"] == ["última"]
+
+    again = import_rows(repos, [(1, ana), (2, {"num_paciente": "105"})])
+    assert (again["inserted"], again["updated"]) == (1, 1)
+
+
+def test_a_malformed_body_aborts_but_keeps_the_rows_before_it():
+    repos = create_repositories(None, 'memory')
+    report = import_rows(repos, [(1, {"num_paciente": "1"}), (2, {"num_paciente": "2"}), (3, {"num_paciente": "3"}),
+                                 ValueError("invalid JSON after row 3: Expecting value")], batch_size=2)
+    assert report["aborted"].startswith("invalid JSON after row 3")
+    assert report["inserted"] == 3
+    assert len(asyncio.run(repos.patients.list())) == 3
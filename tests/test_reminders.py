@@ -0,0 +1,136 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+from reminder_service import LocalReminderSender, ReminderScheduler, ReminderSender
+from repositories import create_repositories
+
+# Offsets of 60 and 10 minutes: for an appointment 30 minutes away, the first is due, the second is not
+OFFSETS = (60, 10)
+
+
+def appointment(minutes_from_now: float, status: str = 'pending', **fields):
+    starts_at = datetime.now(timezone.utc) + timedelta(minutes=minutes_from_now)
+    return {"_id": ObjectId(), "starts_at": starts_at, "status": status, "quarantined": False,
+            "clinic_id": "centro", "patient_name": fields.pop("patient_name", "Ana Ruiz"), **fields}
+
+
+async def setup(docs, sender=None, **options):
+    repos = create_repositories(None, 'memory', 'centro')
+    await repos.appointments.apply_sync([], [], docs)
+    scheduler = ReminderScheduler(None, repos, sender or LocalReminderSender(),
+                                  offsets_minutes=OFFSETS, grace_minutes=120, **options)
+    await scheduler.rebuild()
+    return scheduler
+
+
+def sent_pairs(sender):
+    return sorted((r["appointment_id"], r["offset_minutes"]) for r in sender.sent)
+
+
+class FlakySender(ReminderSender):
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.sent = []
+
+    async def send(self, reminders):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("gateway down")
+        self.sent.extend(reminders)
+
+
+def test_rebuild_schedules_upcoming_reminders_only():
+    async def main():
+        docs = [appointment(30), appointment(300), appointment(30, 'cancelled'), appointment(-30), appointment(30, 'completed')]
+        scheduler = await setup(docs)
+        assert scheduler.live == 4
+        assert sorted(scheduler.scheduled) == sorted(str(d["_id"]) for d in docs[:2])
+    asyncio.run(main())
+
+
+def test_pop_due_takes_due_entries_in_order_and_skips_stale_ones():
+    async def main():
+        soon, later = appointment(30), appointment(40)
+        scheduler = await setup([soon, later])
+        # Moving `soon` out of the window replaces its token: its old entries go stale
+        moved = {**soon, "starts_at": soon["starts_at"] + timedelta(days=1)}
+        await scheduler.apply_diff([], [moved], [])
+        assert len(scheduler.heap) == 6 and scheduler.live == 4
+
+        due = scheduler._pop_due(time.time(), limit=100)
+        assert [(e[2], e[3]) for e in due] == [(str(later["_id"]), 60)]
+        assert scheduler.live == 3
+        assert scheduler.scheduled[str(later["_id"])][1] == 1
+    asyncio.run(main())
+
+
+def test_dispatch_sends_due_reminders_once():
+    async def main():
+        docs = [appointment(30), appointment(45), appointment(300)]
+        sender = LocalReminderSender()
+        scheduler = await setup(docs, sender, batch_size=1, concurrency=2)
+        assert await scheduler.dispatch_due() == 2
+        assert sent_pairs(sender) == sorted((str(d["_id"]), 60) for d in docs[:2])
+        assert sender.sent[0]["patient_name"] == "Ana Ruiz"
+        assert await scheduler.dispatch_due() == 0
+
+        # A rebuild (e.g. after a restart) finds the delivery log and sends nothing again
+        await scheduler.rebuild()
+        assert await scheduler.dispatch_due() == 0
+        assert len(sender.sent) == 2
+    asyncio.run(main())
+
+
+def test_cancellation_and_removal_drop_pending_reminders():
+    async def main():
+        cancelled, removed, kept = appointment(30), appointment(30), appointment(30)
+        sender = LocalReminderSender()
+        scheduler = await setup([cancelled, removed, kept], sender)
+        await scheduler.repos.overrides.upsert(str(cancelled["_id"]), {"status": "cancelled"})
+        await scheduler.apply_statuses({str(cancelled["_id"]): "cancelled"})
+        await scheduler.apply_diff([], [], [removed])
+        assert scheduler.live == 2
+
+        assert await scheduler.dispatch_due() == 1
+        assert sent_pairs(sender) == [(str(kept["_id"]), 60)]
+    asyncio.run(main())
+
+
+def test_failed_batches_are_retried_with_backoff_then_dropped():
+    async def main():
+        doc = appointment(30)
+        sender = FlakySender(failures=1)
+        scheduler = await setup([doc], sender, base_backoff_seconds=0.01, max_attempts=3)
+        assert await scheduler.dispatch_due() == 0
+        # Pushed back under the same token with one more attempt and a short backoff
+        [entry] = [e for e in scheduler.heap if scheduler._valid(e) and e[3] == 60]
+        assert entry[4] == 1 and entry[0] > time.time() - 0.001
+        assert "gateway down" in scheduler.last_error
+
+        await asyncio.sleep(0.02)
+        assert await scheduler.dispatch_due() == 1
+        assert [r["appointment_id"] for r in sender.sent] == [str(doc["_id"])]
+
+        always_down = FlakySender(failures=10)
+        scheduler = await setup([appointment(30)], always_down, base_backoff_seconds=0.001, max_attempts=2)
+        await scheduler.dispatch_due()
+        await asyncio.sleep(0.01)
+        await scheduler.dispatch_due()
+        # The due reminder is given up after two attempts; only the not-yet-due one is left
+        assert scheduler.live == 1 and always_down.sent == []
+    asyncio.run(main())
+
+
+def test_stale_entries_are_compacted():
+    async def main():
+        docs = [appointment(600 + i) for i in range(600)]
+        scheduler = await setup(docs)
+        for _ in range(3):
+            docs = [{**d, "starts_at": d["starts_at"] + timedelta(minutes=1)} for d in docs]
+            await scheduler.apply_diff([], docs, [])
+        assert scheduler.live == 1200
+        assert len(scheduler.heap) <= 2 * scheduler.live + 1024
+    asyncio.run(main())
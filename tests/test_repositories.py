@@ -0,0 +1,154 @@
+import asyncio
+import copy
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson import ObjectId
+
+mongomock_motor = pytest.importorskip('mongomock_motor')
+
+from appointments_service import GoogleSheetsService, date_range_query
+from repositories import CachedAppointmentRepository, MemoryAppointmentRepository, create_repositories
+from sheet_sources import LocalFileSource
+from synthetic_sheet import csv_text
+
+
+class FakeMongo:
+    def __init__(self):
+        self.client = mongomock_motor.AsyncMongoMockClient()
+        self.db = self.client['test']
+
+
+async def sheet_docs(tmp_path, rows=400):
+    """Appointments as a sync stores them (quarantined rows included)"""
+    path = tmp_path / "citas.csv"
+    path.write_text(csv_text(rows, seed=11, garbage_fraction=0.02), encoding='utf-8')
+    service = GoogleSheetsService(None, create_repositories(None, 'memory'), [LocalFileSource(str(path))])
+    await service.sync_appointments()
+    return await service.repos.appointments.sync_state(None)
+
+
+def normalized(value):
+    """MongoDB hands datetimes back naive (UTC) and ObjectIds as such; compare them all that way"""
+    if isinstance(value, dict):
+        return {k: normalized(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [normalized(v) for v in value]
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+async def reads(repo, docs):
+    """The answer of every read the services make, for the given stored docs"""
+    listed = sorted((d for d in docs if d.get("quarantined") is False), key=lambda d: d["starts_at"])
+    days = sorted({d["date"] for d in listed})
+    week = date_range_query(days[len(days) // 3], days[len(days) // 3 + 6])
+    ids = [str(d["_id"]) for d in docs[::25]] + [str(ObjectId())]
+    keys = sorted({d["patient_key"] for d in listed})[:40]
+    newest = await repo.history(keys, limit=5)
+    out = {
+        "count": await repo.count(),
+        "count_week": await repo.count(week),
+        "count_week_cancelled": await repo.count(week, 'cancelled'),
+        "count_completed": await repo.count(status='completed'),
+        "find_week": await repo.find(week),
+        "find_cancelled": await repo.find(status='cancelled', limit=15),
+        "find_since": await repo.find({"$gte": listed[-30]["starts_at"]}),
+        "get": [await repo.get(i) for i in ids],
+        "get_fields": await repo.get(ids[0], {"status": 1, "starts_at": 1}),
+        "get_many": await repo.get_many(ids, {"status": 1, "patient_key": 1}),
+        "has_rows": (await repo.has_rows(), await repo.has_rows('s9'), await repo.has_rows('s9', include_untagged=True)),
+        "history": newest,
+        "history_after": await repo.history(keys, before=(newest[-1]["starts_at"], str(newest[-1]["_id"])), limit=50),
+    }
+    # Order is only defined for find and history
+    unordered = {
+        "quarantined": repo.quarantined({"external_id": 1, "quarantine_reason": 1}, 100),
+        "sync_state": repo.sync_state({"row_hash": 1, "external_id": 1}),
+        "scan": repo.scan({"status": 1, "date": 1}),
+    }
+    for name, call in unordered.items():
+        out[name] = sorted(await call, key=lambda d: str(d["_id"]))
+    out["scan_all"] = len(await repo.scan({"_id": 1}, include_quarantined=True))
+    return normalized(out)
+
+
+def changes(docs, rng):
+    """A sync's worth of removals, status edits and new rows"""
+    removed = rng.sample(docs, 20)
+    kept = [d for d in docs if d not in removed]
+    updated = [{**d, "status": rng.choice(['cancelled', 'completed', 'no_show']), "row_hash": f"{rng.getrandbits(160):040x}"}
+               for d in rng.sample(kept, 30)]
+    added = [{**d, "_id": ObjectId(), "external_id": f"new-{n}", "starts_at": d["starts_at"] + timedelta(minutes=15)}
+             for n, d in enumerate(rng.sample(kept, 10))]
+    current = {d["_id"]: d for d in kept}
+    current.update((d["_id"], d) for d in updated + added)
+    return removed, updated, added, list(current.values())
+
+
+def test_backends_answer_every_read_alike(tmp_path):
+    async def main():
+        docs = await sheet_docs(tmp_path)
+        mongo = FakeMongo()
+        backends = {
+            "memory": create_repositories(None, 'memory').appointments,
+            "mongo": create_repositories(mongo, 'mongo').appointments,
+            "cached": create_repositories(FakeMongo(), 'cached').appointments,
+        }
+        for repo in backends.values():
+            await repo.apply_sync([], [], copy.deepcopy(docs))
+        expected = await reads(backends["memory"], docs)
+        for name in ("mongo", "cached"):
+            assert await reads(backends[name], docs) == expected, name
+
+        rng = random.Random(3)
+        for _ in range(2):
+            removed, updated, added, docs = changes(docs, rng)
+            for repo in backends.values():
+                await repo.apply_sync(copy.deepcopy(removed), copy.deepcopy(updated), copy.deepcopy(added))
+            expected = await reads(backends["memory"], docs)
+            for name in ("mongo", "cached"):
+                assert await reads(backends[name], docs) == expected, name
+
+        # Another worker's cache over the same database: read through until warmed, then from memory
+        other = CachedAppointmentRepository(create_repositories(mongo, 'mongo').appointments, MemoryAppointmentRepository())
+        assert await reads(other, docs) == expected
+        await other.warm()
+        assert other.cache.loaded and await reads(other, docs) == expected
+    asyncio.run(main())
+
+
+def test_override_backends_agree():
+    async def main():
+        backends = {"memory": create_repositories(None, 'memory'), "mongo": create_repositories(FakeMongo(), 'mongo')}
+        results = {}
+        for name, repos in backends.items():
+            overrides = repos.overrides
+            stamp = datetime(2025, 3, 1, 10)
+            first = await overrides.upsert("a1", {"status": 'cancelled', "estado_cita": 'Anulada', "updated_at": stamp})
+            second = await overrides.upsert("a1", {"status": 'completed', "estado_cita": 'completed', "updated_at": stamp})
+            previous, errors = await overrides.upsert_many({
+                "a1": {"status": 'no_show', "estado_cita": 'No acude', "updated_at": stamp},
+                "a2": {"status": 'confirmed', "estado_cita": 'Confirmada', "updated_at": stamp},
+            })
+            results[name] = normalized({
+                "first": first,
+                "second": second,
+                "previous": previous,
+                "errors": errors,
+                "get_many": await overrides.get_many(["a1", "a2", "a3"]),
+                "all": await overrides.all(),
+            })
+
+        def comparable(value):
+            # Mongo adds its own _id and the clinic partition to each document
+            if isinstance(value, dict):
+                return {k: comparable(v) for k, v in value.items() if k not in ("_id", "clinic_id")}
+            return value
+
+        assert comparable(results["mongo"]) == comparable(results["memory"])
+        assert results["memory"]["first"] is None and results["memory"]["second"]["status"] == 'cancelled'
+        assert results["memory"]["all"]["a1"]["status"] == 'no_show'
+    asyncio.run(main())
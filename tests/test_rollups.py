@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+mongomock_motor = pytest.importorskip('mongomock_motor')
+
+from appointments_service import GoogleSheetsService
+from repositories import create_repositories
+from rollups_service import DailyRollupService
+from sheet_sources import LocalFileSource
+from synthetic_sheet import csv_text
+
+
+class FakeMongo:
+    def __init__(self):
+        self.client = mongomock_motor.AsyncMongoMockClient()
+        self.db = self.client['test']
+
+
+async def buckets(rollups):
+    docs = await rollups.collection.find({"clinic_id": rollups.clinic_id}).to_list(length=None)
+    return {(d["date"], d["doctor"], d["treatment"], d["status"]): (d["count"], d["booked_minutes"]) for d in docs}
+
+
+async def assert_matches_a_rebuild(service):
+    incremental = await buckets(service.rollups)
+    assert all(count > 0 for count, _ in incremental.values())
+    await service.rebuild_rollups()
+    assert incremental == await buckets(service.rollups)
+
+
+def test_deltas_from_syncs_and_overrides_match_a_full_recompute(tmp_path):
+    async def main():
+        mongo = FakeMongo()
+        path = tmp_path / "citas.csv"
+        path.write_text(csv_text(300, seed=5), encoding='utf-8')
+        service = GoogleSheetsService(mongo, create_repositories(mongo, 'mongo'), [LocalFileSource(str(path))])
+        await service.sync_appointments()
+        first = await buckets(service.rollups)
+        # Archived appointments keep their buckets
+        assert sum(count for count, _ in first.values()) == len(await service.scan_history({"_id": 1}))
+
+        # Statuses changed, rows removed, then rows added back
+        for rows, mutate_fraction in ((260, 0.2), (340, 0.1)):
+            path.write_text(csv_text(rows, seed=5, mutate_fraction=mutate_fraction), encoding='utf-8')
+            await service.sync_appointments()
+            await assert_matches_a_rebuild(service)
+
+        hot, archived = await service.repos.appointments.scan({"_id": 1}), await service.repos.archive.scan({"_id": 1})
+        ids = [str(d["_id"]) for d in hot[:3] + archived[:3]]
+        await service.set_status_override(ids[0], 'cancelled')
+        await service.set_status_override(ids[0], 'completed')
+        await service.set_status_overrides([{"appointment_id": i, "status": 'no_show'} for i in ids[1:]])
+        await assert_matches_a_rebuild(service)
+
+        # The sheet changing an overridden row moves its bucket from the override's status
+        path.write_text(csv_text(340, seed=5, mutate_fraction=0.5), encoding='utf-8')
+        await service.sync_appointments()
+        await assert_matches_a_rebuild(service)
+    asyncio.run(main())
+
+
+def test_apply_drops_buckets_that_empty_and_skips_net_zero_changes():
+    async def main():
+        rollups = DailyRollupService(FakeMongo(), lambda doc: doc["duration_minutes"], 'centro')
+        a = {"date": "2025-03-01", "doctor": "Dr. Rubio", "treatment": "Limpieza", "duration_minutes": 30}
+        b = {**a, "duration_minutes": 45}
+        quarantined = {**a, "quarantined": True}
+        assert await rollups.apply([], [(a, 'pending'), (b, 'pending'), (quarantined, 'pending')]) == 1
+        assert await buckets(rollups) == {("2025-03-01", "Dr. Rubio", "Limpieza", "pending"): (2, 75)}
+
+        assert await rollups.apply([(a, 'pending')], [(a, 'pending')]) == 0
+        await rollups.apply([(a, 'pending'), (b, 'pending')], [(b, 'cancelled')])
+        assert await buckets(rollups) == {("2025-03-01", "Dr. Rubio", "Limpieza", "cancelled"): (1, 45)}
+    asyncio.run(main())
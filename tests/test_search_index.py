@@ -0,0 +1,86 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+from search_index import PREFIX_WEIGHT, AppointmentSearchIndex
+
+START = datetime(2025, 1, 1, 9, tzinfo=timezone.utc)
+
+
+def doc(n: int, patient_name: str = "Ana Ruiz", treatment: str = "Limpieza", notes: str = "", **fields):
+    return {"_id": f"a{n}", "starts_at": START + timedelta(days=n), "patient_name": patient_name,
+            "treatment": treatment, "notes": notes, "doctor": "Dra. Vidal", **fields}
+
+
+def index_of(docs):
+    index = AppointmentSearchIndex()
+    index.build(docs)
+    return index
+
+
+def test_terms_match_accent_folded_and_as_prefixes():
+    index = index_of([doc(1, treatment="Revisión anual"), doc(2, treatment="Ortodoncia"), doc(3, notes="revisar")])
+    assert index.search("revision") == (1, [("a1", 2.0)])
+    assert index.search("REVISIÓN")[0] == 1
+    total, page = index.search("revis")
+    assert total == 2
+    assert dict(page) == {"a1": 2.0 * PREFIX_WEIGHT, "a3": 1.0 * PREFIX_WEIGHT}
+    # Every term must match
+    assert index.search("revision ortodoncia") == (0, [])
+
+
+def test_exact_and_boosted_matches_rank_first():
+    index = index_of([
+        doc(1, patient_name="Luis Gomez", notes="llamar a gomezano"),
+        doc(2, patient_name="Pedro Sanz", notes="derivado por Gomez"),
+        doc(3, patient_name="Luis Gomezano"),
+    ])
+    total, page = index.search("gomez")
+    assert total == 3
+    # Exact in the name (3.0), exact in the notes (1.0), prefix in the name (1.5), in that order
+    assert page == [("a1", 3.0), ("a3", 1.5), ("a2", 1.0)]
+
+
+def test_pages_cover_every_match_once_with_a_stable_total():
+    index = index_of([doc(n) for n in range(45)] + [doc(100, treatment="Implante")])
+    seen = []
+    for offset in range(0, 45, 20):
+        total, page = index.search("limpieza", offset=offset, limit=20, order='date')
+        assert total == 45
+        seen.extend(appointment_id for appointment_id, _ in page)
+    # Most recent first, no repeats
+    assert seen == [f"a{n}" for n in range(44, -1, -1)]
+    assert index.search("limpieza", offset=40, limit=20)[1][-1][0] == "a0"
+
+
+def test_diffs_keep_the_index_equal_to_a_fresh_build():
+    rng = random.Random(7)
+    words = ["limpieza", "implante", "revision", "revisar", "ortodoncia", "endodoncia", "urgente"]
+    names = ["Ana Ruiz", "Ángel Núñez", "Carmen Vidal", "Luis Gómez"]
+
+    def random_doc(n):
+        return doc(n, patient_name=rng.choice(names), treatment=rng.choice(words),
+                   notes=" ".join(rng.sample(words, 2)), quarantined=rng.random() < 0.05)
+
+    docs = {f"a{n}": random_doc(n) for n in range(200)}
+    index = index_of(docs.values())
+    for _ in range(5):
+        removed = [docs.pop(i) for i in rng.sample(sorted(docs), 15)]
+        updated = [random_doc(int(i[1:])) for i in rng.sample(sorted(docs), 15)]
+        added = [random_doc(n) for n in range(1000 + len(docs), 1010 + len(docs))]
+        for d in updated + added:
+            docs[d["_id"]] = d
+        index.apply_diff(added, updated, removed)
+
+    fresh = index_of(docs.values())
+    assert index.vocabulary == fresh.vocabulary
+    for query in ["limp", "revis", "angel", "nunez ruiz", "urgente implante", "re"]:
+        for order in ('relevance', 'date'):
+            assert index.search(query, limit=500, order=order) == fresh.search(query, limit=500, order=order)
+
+
+def test_removed_appointments_leave_no_terms_behind():
+    index = index_of([doc(1, treatment="Blanqueamiento"), doc(2)])
+    index.apply_diff([], [], [doc(1)])
+    assert index.search("blanq") == (0, [])
+    assert "blanqueamiento" not in index.vocabulary
+    assert len(index) == 1 and index.stats()["appointments"] == 1
@@ -0,0 +1,122 @@
+import asyncio
+import os
+
+from sheet_sources import FileCursor, SheetSnapshotStore
+
+HEADER = b"Fecha,Hora,Paciente,EstadoCita\n"
+ROWS = [b"2025-01-0%d,10:00,Paciente %d,Confirmada\n" % (i, i) for i in range(1, 6)]
+
+
+def touch_later(path, cursor):
+    # Filesystems with coarse timestamps can give a quick rewrite the old mtime
+    os.utime(path, ns=(cursor.mtime_ns + 10 ** 9, cursor.mtime_ns + 10 ** 9))
+
+
+def test_appended_rows_are_read_incrementally(tmp_path):
+    path = tmp_path / "citas.csv"
+    path.write_bytes(HEADER + b"".join(ROWS[:3]))
+    cursor = FileCursor(path)
+    assert cursor.read() == HEADER + b"".join(ROWS[:3])
+
+    with open(path, 'ab') as f:
+        f.write(b"".join(ROWS[3:]))
+    assert cursor.read() == HEADER + b"".join(ROWS)
+    assert cursor.full_reads == 1
+    assert cursor.last_bytes_read < len(HEADER + b"".join(ROWS))
+
+    # Untouched: nothing new to read, no full read
+    assert cursor.read() == HEADER + b"".join(ROWS)
+    assert cursor.full_reads == 1
+
+
+def test_partial_trailing_line_is_completed(tmp_path):
+    path = tmp_path / "citas.csv"
+    path.write_bytes(HEADER + ROWS[0] + ROWS[1][:10])
+    cursor = FileCursor(path)
+    assert cursor.read() == HEADER + ROWS[0] + ROWS[1][:10]
+    with open(path, 'ab') as f:
+        f.write(ROWS[1][10:])
+    assert cursor.read() == HEADER + ROWS[0] + ROWS[1]
+    assert cursor.full_reads == 1
+
+
+def test_same_size_rewrite_in_place_is_read_again(tmp_path):
+    path = tmp_path / "citas.csv"
+    path.write_bytes(HEADER + b"".join(ROWS))
+    cursor = FileCursor(path)
+    cursor.read()
+
+    # Same inode, same length: only the status of the first row changes
+    rewritten = ROWS[0].replace(b"Confirmada", b"Finalizada")
+    assert len(rewritten) == len(ROWS[0])
+    with open(path, 'r+b') as f:
+        f.seek(len(HEADER))
+        f.write(rewritten)
+    touch_later(path, cursor)
+
+    assert cursor.read() == HEADER + rewritten + b"".join(ROWS[1:])
+    assert cursor.full_reads == 2
+
+
+def test_truncated_file_is_read_again(tmp_path):
+    path = tmp_path / "citas.csv"
+    path.write_bytes(HEADER + b"".join(ROWS))
+    cursor = FileCursor(path)
+    cursor.read()
+
+    with open(path, 'r+b') as f:
+        f.truncate(len(HEADER + ROWS[0]))
+    assert cursor.read() == HEADER + ROWS[0]
+    assert cursor.full_reads == 2
+
+    # Growing again after the truncation is incremental from the new end
+    with open(path, 'ab') as f:
+        f.write(ROWS[1])
+    assert cursor.read() == HEADER + ROWS[0] + ROWS[1]
+    assert cursor.full_reads == 2
+
+
+def test_rewrite_near_the_end_while_growing_is_read_again(tmp_path):
+    path = tmp_path / "citas.csv"
+    path.write_bytes(HEADER + b"".join(ROWS[:3]))
+    cursor = FileCursor(path)
+    cursor.read()
+
+    rewritten = ROWS[2].replace(b"Confirmada", b"Finalizada")
+    path.write_bytes(HEADER + ROWS[0] + ROWS[1] + rewritten + ROWS[3])
+    assert cursor.read() == HEADER + ROWS[0] + ROWS[1] + rewritten + ROWS[3]
+    assert cursor.full_reads == 2
+
+
+def test_rewrite_early_in_the_file_while_growing_is_read_again(tmp_path):
+    path = tmp_path / "citas.csv"
+    path.write_bytes(HEADER + b"".join(ROWS[:4]))
+    cursor = FileCursor(path)
+    cursor.read()
+
+    # The first row changes and a row is appended; everything near the old end is identical
+    rewritten = ROWS[0].replace(b"Confirmada", b"Finalizada")
+    path.write_bytes(HEADER + rewritten + b"".join(ROWS[1:]))
+    assert cursor.read() == HEADER + rewritten + b"".join(ROWS[1:])
+    assert cursor.full_reads == 2
+
+
+def test_invalidated_cursor_reads_in_full(tmp_path):
+    path = tmp_path / "citas.csv"
+    path.write_bytes(HEADER + b"".join(ROWS))
+    cursor = FileCursor(path)
+    cursor.read()
+
+    cursor.invalidate()
+    assert cursor.read() == HEADER + b"".join(ROWS)
+    assert cursor.full_reads == 2
+
+
+def test_snapshot_is_only_restored_for_the_url_it_was_saved_for(tmp_path):
+    store = SheetSnapshotStore(tmp_path)
+    text = (HEADER + b"".join(ROWS)).decode()
+    url = "https://example.test/sheet.csv"
+    assert asyncio.run(store.save("default", url, text, ["Fecha"], len(ROWS)))
+
+    assert asyncio.run(store.load("default", url)).text == text
+    assert asyncio.run(SheetSnapshotStore(tmp_path).load("default", "https://example.test/other.csv")) is None